@@ -0,0 +1,25 @@
+"""posts_cursor_index
+
+Revision ID: 3f1c2a9d7b41
+Revises: 98a9ae1b9778
+Create Date: 2026-10-18 09:12:41.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b41'
+down_revision = '98a9ae1b9778'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # sort key of cursor pagination for GET /posts
+    op.create_index('ix_posts_date_created_id', 'posts', ['date_created', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_posts_date_created_id', table_name='posts')
@@ -0,0 +1,32 @@
+"""posts_like_count
+
+Revision ID: 5d8e31f0c6a2
+Revises: b7e04d5c2a96
+Create Date: 2026-10-18 11:20:05.916472
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d8e31f0c6a2'
+down_revision = 'b7e04d5c2a96'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts',
+        sa.Column('like_count', sa.Integer, nullable=False, server_default='0')
+    )
+    # count existing likes
+    op.execute(
+        "UPDATE posts SET like_count = ("
+        "SELECT count(*) FROM link_user_post WHERE link_user_post.post_id = posts.id"
+        ")"
+    )
+
+
+def downgrade():
+    op.drop_column('posts', 'like_count')
@@ -0,0 +1,36 @@
+"""posts_date_last_activity
+
+Revision ID: a9c3e5f71d24
+Revises: e42a7c19b3d8
+Create Date: 2026-10-18 20:31:44.209518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9c3e5f71d24'
+down_revision = 'e42a7c19b3d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # validator of ETag / Last-Modified of posts, it is bumped on update, like and comment
+    op.add_column('posts',
+        sa.Column('date_last_activity', sa.DateTime, nullable=False, server_default=sa.func.now())
+    )
+    # latest known change of existing posts
+    op.execute(
+        "UPDATE posts SET date_last_activity = COALESCE(("
+        "SELECT max(activity) FROM ("
+        "SELECT posts.date_last_update AS activity "
+        "UNION ALL SELECT comments.date_created FROM comments WHERE comments.post = posts.id"
+        ") AS activities"
+        "), date_last_activity)"
+    )
+
+
+def downgrade():
+    op.drop_column('posts', 'date_last_activity')
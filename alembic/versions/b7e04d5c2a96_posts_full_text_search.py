@@ -0,0 +1,33 @@
+"""posts_full_text_search
+
+Revision ID: b7e04d5c2a96
+Revises: 3f1c2a9d7b41
+Create Date: 2026-10-18 10:02:17.334120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e04d5c2a96'
+down_revision = '3f1c2a9d7b41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # generated column, postgres recompute it on every insert/update of title or content
+    # title has weight A and content has weight B, so searcher can rank and filter by field
+    op.execute(
+        "ALTER TABLE posts ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(content, '')), 'B')"
+        ") STORED"
+    )
+    op.execute("CREATE INDEX ix_posts_search_vector ON posts USING GIN (search_vector)")
+
+
+def downgrade():
+    op.drop_index('ix_posts_search_vector', table_name='posts')
+    op.drop_column('posts', 'search_vector')
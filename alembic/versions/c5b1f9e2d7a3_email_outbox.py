@@ -0,0 +1,40 @@
+"""email_outbox
+
+Revision ID: c5b1f9e2d7a3
+Revises: a9c3e5f71d24
+Create Date: 2026-10-18 22:12:05.381907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5b1f9e2d7a3'
+down_revision = 'a9c3e5f71d24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # emails are written here with the change which need them and sent by blog_api.users.email_worker
+    op.create_table(
+        'email_outbox',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('recipient', sa.String, nullable=False),
+        sa.Column('subject', sa.String, nullable=False),
+        sa.Column('template_name', sa.String, nullable=False),
+        sa.Column('body', sa.JSON),
+        sa.Column('status', sa.String, nullable=False, server_default='pending'),
+        sa.Column('attempts', sa.Integer, nullable=False, server_default='0'),
+        sa.Column('next_attempt_at', sa.DateTime, nullable=False, server_default=sa.func.now()),
+        sa.Column('last_error', sa.String),
+        sa.Column('date_created', sa.DateTime, nullable=False, server_default=sa.func.now()),
+        sa.Column('date_sent', sa.DateTime),
+    )
+    op.create_index('ix_email_outbox_status_next_attempt_at', 'email_outbox', ['status', 'next_attempt_at'])
+
+
+def downgrade():
+    op.drop_index('ix_email_outbox_status_next_attempt_at', table_name='email_outbox')
+    op.drop_table('email_outbox')
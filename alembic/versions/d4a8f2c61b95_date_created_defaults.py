@@ -0,0 +1,40 @@
+"""date_created_defaults
+
+Revision ID: d4a8f2c61b95
+Revises: c5b1f9e2d7a3
+Create Date: 2026-10-19 10:04:27.655310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a8f2c61b95'
+down_revision = 'c5b1f9e2d7a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # (date_created, id) is the sort key of posts and comments cursor pagination, a NULL date_created would never
+    # be reached by a cursor, rows which were inserted without it get the time of their last known change
+    op.execute("UPDATE posts SET date_created = COALESCE(date_last_update, CURRENT_TIMESTAMP) WHERE date_created IS NULL")
+    op.execute("UPDATE posts SET date_last_update = date_created WHERE date_last_update IS NULL")
+    op.execute(
+        "UPDATE comments SET date_created = COALESCE("
+        "(SELECT posts.date_last_activity FROM posts WHERE posts.id = comments.post), CURRENT_TIMESTAMP"
+        ") WHERE date_created IS NULL"
+    )
+    # before this revision the model default was evaluated once per process, so rows which were inserted by the
+    # same process share the start time of that process, the real creation time is lost and it is not backfilled:
+    # those rows keep a stable order (start time of their process, then id), new rows get their own time
+    op.alter_column('posts', 'date_created', server_default=sa.func.now())
+    op.alter_column('posts', 'date_last_update', server_default=sa.func.now())
+    op.alter_column('comments', 'date_created', server_default=sa.func.now())
+
+
+def downgrade():
+    op.alter_column('comments', 'date_created', server_default=None)
+    op.alter_column('posts', 'date_last_update', server_default=None)
+    op.alter_column('posts', 'date_created', server_default=None)
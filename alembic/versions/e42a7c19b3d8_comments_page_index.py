@@ -0,0 +1,27 @@
+"""comments_page_index
+
+Revision ID: e42a7c19b3d8
+Revises: 5d8e31f0c6a2
+Create Date: 2026-10-18 19:52:07.384115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e42a7c19b3d8'
+down_revision = '5d8e31f0c6a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # sort key of cursor pagination for GET /posts/{post_id}/comment and replies of a comment
+    op.create_index(
+        'ix_comments_post_parent_id_date_created_id', 'comments', ['post', 'parent_id', 'date_created', 'id']
+    )
+
+
+def downgrade():
+    op.drop_index('ix_comments_post_parent_id_date_created_id', table_name='comments')
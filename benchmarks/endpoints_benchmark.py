@@ -0,0 +1,318 @@
+# Benchmark of every route of posts_apis and users_apis
+# requests are sent in process through httpx ASGI transport (no network), redis is the in memory fake of tests
+# and emails are not sent, so only the application and its database are measured
+# Run from project root:
+#   python -m benchmarks.endpoints_benchmark --requests 200 --concurrency 10 > benchmarks/baseline.json
+#   python -m benchmarks.endpoints_benchmark --requests 200 --concurrency 10 --baseline benchmarks/baseline.json
+# with --baseline the run exit with code 1 when p95 latency of a route grew more than --max-regression
+# or a route execute more queries per request than in baseline
+# Note: latency is only comparable between runs on the same machine with the same dataset and concurrency
+# by default the dataset is seeded into a fresh local sqlite file, use --database-url to run against postgres
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+from collections import Counter
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+import httpx
+import sqlalchemy.orm as _orm
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from blog_api import query_counter, redis_client, services
+from blog_api.databases import Base
+from blog_api.helper import create_access_token
+from blog_api.main import app
+from blog_api.users import send_email_services
+from tests import helper
+
+DEFAULT_DATABASE_URL = "sqlite+aiosqlite:///benchmarks/endpoints_benchmark.db"
+PAGE_SIZE = 20
+BULK_SIZE = 100
+# every imported user cost a bcrypt hash
+BULK_USERS_SIZE = 20
+
+
+class Scenario(NamedTuple):
+    name: str
+    method: str
+    # build keyword arguments of httpx request from the number of request inside this scenario
+    build: Callable[[int], dict]
+    # status codes which are not counted as errors
+    expected: Tuple[int, ...] = (200,)
+    # requests which change data are not repeated for warm up
+    warm_up: bool = True
+    # upper bound of requests, for routes which consume rows of the dataset (delete)
+    max_requests: Optional[int] = None
+    # upper bound of concurrency, bulk import use every core for one request and answer 503 to the others
+    max_concurrency: Optional[int] = None
+
+
+# read only routes first, then writes, deletes are last because they remove rows used by other routes
+def build_scenarios(dataset: helper.Dataset, admin: dict, user: dict) -> List[Scenario]:
+    posts = dataset.post_ids
+    threads = dataset.comment_threads
+    emails = dataset.user_emails
+    # first user is admin, second one is used by user token, the others can be modified
+    others = emails[2:]
+
+    def post(i: int) -> int:
+        return posts[i * 7919 % len(posts)]
+
+    def thread(i: int) -> Tuple[int, int, int]:
+        return threads[i * 7919 % len(threads)]
+
+    def bulk_posts(i: int):
+        return [{"title": f"Bulk post {i} {number}", "content": "bulk content"} for number in range(BULK_SIZE)]
+
+    def bulk_users(i: int):
+        return [{"email": f"bulk{i}x{number}@mailinator.com", "password": "password"} for number in range(BULK_USERS_SIZE)]
+
+    return [
+        Scenario("GET /posts", "GET", lambda i: {"url": "/posts", "params": {"size": PAGE_SIZE, "page": i % 10 + 1}}),
+        Scenario("GET /posts cursor", "GET", lambda i: {"url": "/posts", "params": {"size": PAGE_SIZE, "paging": "cursor"}}),
+        Scenario("GET /posts fields", "GET", lambda i: {
+            "url": "/posts", "params": {"size": PAGE_SIZE, "fields": "id,title,like_count"}
+        }),
+        Scenario("GET /posts fast", "GET", lambda i: {"url": "/posts", "params": {"size": PAGE_SIZE, "fast": "true"}}),
+        Scenario("GET /posts search", "GET", lambda i: {
+            "url": "/posts", "params": {"size": PAGE_SIZE, "search_field": "title", "search_value": f"word{i % 1000 + 1}"}
+        }),
+        Scenario("GET /posts/export", "GET", lambda i: {"url": "/posts/export"}),
+        Scenario("GET /posts/export csv", "GET", lambda i: {"url": "/posts/export", "params": {"format": "csv"}}),
+        Scenario("GET /posts/{user_email}/posts/", "GET", lambda i: {"url": f"/posts/{emails[i % len(emails)]}/posts/"}),
+        Scenario("GET /posts/{post_id}", "GET", lambda i: {"url": f"/posts/{post(i)}"}),
+        Scenario("GET /posts/{post_id} fields", "GET", lambda i: {"url": f"/posts/{post(i)}", "params": {"fields": "id,title"}}),
+        Scenario("GET /posts/{post_id}/likes", "GET", lambda i: {"url": f"/posts/{post(i)}/likes"}),
+        Scenario("GET /posts/{post_id}/comment", "GET", lambda i: {"url": f"/posts/{post(i)}/comment"}),
+        Scenario("GET /posts/{post_id}/comment cursor", "GET", lambda i: {
+            "url": f"/posts/{post(i)}/comment", "params": {"paging": "cursor"}
+        }),
+        Scenario("GET /posts/{post_id}/comment/{comment_id}/replies", "GET", lambda i: {
+            "url": "/posts/{}/comment/{}/replies".format(*thread(i)[:2])
+        }),
+        Scenario("GET /users/", "GET", lambda i: {"url": "/users/", "params": {"size": PAGE_SIZE}}),
+        Scenario("GET /users/ embed", "GET", lambda i: {
+            "url": "/users/", "params": {"size": PAGE_SIZE, "embed": ["posts", "posts_like"]}
+        }),
+        Scenario("GET /users/{user_email}/", "GET", lambda i: {"url": f"/users/{emails[i % len(emails)]}/"}),
+        Scenario("POST /users/login", "POST", lambda i: {
+            "url": "/users/login", "data": {"username": emails[i % len(emails)], "password": helper.DATASET_PASSWORD}
+        }),
+        Scenario("POST /posts", "POST", lambda i: {
+            "url": "/posts", "json": {"title": f"New post {i}", "content": "content"}, "headers": user
+        }, warm_up=False),
+        Scenario("POST /posts/bulk", "POST", lambda i: {"url": "/posts/bulk", "json": bulk_posts(i), "headers": user}, (201,), False),
+        Scenario("PATCH /posts/{post_id}", "PATCH", lambda i: {
+            "url": f"/posts/{post(i)}", "json": {"title": f"Updated {i}", "content": "updated"}, "headers": admin
+        }, warm_up=False),
+        Scenario("POST /posts/{post_id}/like", "POST", lambda i: {"url": f"/posts/{post(i)}/like", "headers": user}, warm_up=False),
+        Scenario("POST /posts/{post_id}/comment", "POST", lambda i: {
+            "url": f"/posts/{thread(i)[0]}/comment", "params": {"body": f"new comment {i}", "parent_id": thread(i)[2]},
+            "headers": user,
+        }, (201,), False),
+        Scenario("PATCH /posts/{post_id}/comment/{comment_id}", "PATCH", lambda i: {
+            "url": "/posts/{}/comment/{}".format(*thread(i)[:2]), "params": {"comment_body": f"edited {i}"}, "headers": admin
+        }, warm_up=False),
+        Scenario("POST /users/", "POST", lambda i: {
+            "url": "/users/", "json": {"email": f"new{i}@mailinator.com", "password": "password"}
+        }, (201,), False),
+        Scenario("POST /users/bulk", "POST", lambda i: {
+            "url": "/users/bulk", "json": bulk_users(i), "headers": admin
+        }, (201,), False, max_concurrency=1),
+        Scenario("POST /users/changepass", "POST", lambda i: {
+            "url": "/users/changepass", "params": {"password": "password", "confirm_password": "password"}, "headers": user
+        }, warm_up=False),
+        Scenario("POST /users/{user_email}/forgotpass", "POST", lambda i: {
+            "url": f"/users/{others[i % len(others)]}/forgotpass"
+        }, warm_up=False),
+        # verification codes are only in redis of the request which created the user, so a wrong code is measured
+        Scenario("POST /users/{user_email}/active/{verify_code}", "POST", lambda i: {
+            "url": f"/users/{others[i % len(others)]}/active/wrong"
+        }, (400,), False),
+        Scenario("POST /users/{user_mail}/admin_active_user", "POST", lambda i: {
+            "url": f"/users/{others[i % len(others)]}/admin_active_user",
+            "params": {"user_email": others[i % len(others)]},
+            "headers": admin,
+        }, warm_up=False),
+        Scenario("DELETE /posts/{post_id}/comment/{comment_id}", "DELETE", lambda i: {
+            "url": "/posts/{}/comment/{}".format(threads[-i - 1][0], threads[-i - 1][1]), "headers": admin
+        }, warm_up=False, max_requests=len(threads)),
+        Scenario("DELETE /posts/{post_id}", "DELETE", lambda i: {"url": f"/posts/{posts[-i - 1]}", "headers": admin},
+                 warm_up=False, max_requests=len(posts)),
+        Scenario("DELETE /users/{user_email}/delete", "DELETE", lambda i: {
+            "url": f"/users/{others[-i - 1]}/delete", "headers": admin
+        }, warm_up=False, max_requests=len(others)),
+    ]
+
+
+def _percentile(ordered: List[float], percent: float) -> float:
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+async def run_scenario(client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int) -> dict:
+    if scenario.max_requests is not None:
+        requests = min(requests, scenario.max_requests)
+    if scenario.max_concurrency is not None:
+        concurrency = min(concurrency, scenario.max_concurrency)
+
+    if scenario.warm_up:
+        await client.request(scenario.method, **scenario.build(requests))
+
+    latencies, queries, statuses = [], [], Counter()
+    numbers = iter(range(requests))
+
+    async def worker():
+        # numbers is shared by workers, every request number is sent once
+        for number in numbers:
+            kwargs = scenario.build(number)
+            with query_counter.count_queries() as counter:
+                start = time.perf_counter()
+                response = await client.request(scenario.method, **kwargs)
+                latencies.append(time.perf_counter() - start)
+            queries.append(len(counter))
+            statuses[response.status_code] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    ordered = sorted(latencies)
+    return {
+        "requests": requests,
+        "errors": sum(count for status, count in statuses.items() if status not in scenario.expected),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "p50_ms": round(_percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(_percentile(ordered, 95) * 1000, 3),
+        "p99_ms": round(_percentile(ordered, 99) * 1000, 3),
+        "mean_ms": round(statistics.mean(ordered) * 1000, 3),
+        "throughput_rps": round(requests / elapsed, 2),
+        "queries_per_request": round(statistics.mean(queries), 2),
+        "queries_max": max(queries),
+    }
+
+
+# routes whose p95 grew more than max_regression or which run more queries than in baseline
+def compare(report: dict, baseline: dict, max_regression: float) -> List[str]:
+    regressions = []
+    for name, result in report["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if previous is None:
+            continue
+        if result["p95_ms"] > previous["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{name}: p95 {previous['p95_ms']} ms -> {result['p95_ms']} ms")
+        if result["queries_per_request"] > previous["queries_per_request"]:
+            regressions.append(
+                f"{name}: queries per request {previous['queries_per_request']} -> {result['queries_per_request']}"
+            )
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args) -> int:
+    # sqlite lock the whole database while a write transaction is open, wait for it instead of failing at once
+    connect_args = {"timeout": 60} if args.database_url.startswith("sqlite") else {}
+    engine = create_async_engine(args.database_url, connect_args=connect_args)
+    session_local = _orm.sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
+    query_counter.instrument_engine(engine)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with session_local() as session:
+        dataset = await helper.populate_dataset(
+            session, args.users, args.posts_per_user, args.likes_per_post, args.comments_per_post, args.reply_depth, args.seed
+        )
+
+    async def get_db():
+        async with session_local() as session:
+            yield session
+
+    app.dependency_overrides[services.get_db] = get_db
+    app.dependency_overrides[services.get_read_db] = get_db
+    redis_client.set_redis(helper.FakeAsyncRedis())
+    send_email_services.conf.SUPPRESS_SEND = 1
+
+    admin_token = await create_access_token({"sub": dataset.admin_email, "scopes": ["admin"]})
+    user_token = await create_access_token({"sub": dataset.user_emails[1], "scopes": ["user"]})
+    admin = {"Authorization": f"Bearer {admin_token}"}
+    user = {"Authorization": f"Bearer {user_token}"}
+
+    selected = args.route
+    results = {}
+    # unhandled errors of application are answered by 500 and counted, they don't stop the run
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for scenario in build_scenarios(dataset, admin, user):
+            if selected and not any(part in scenario.name for part in selected):
+                continue
+            results[scenario.name] = await run_scenario(client, scenario, args.requests, args.concurrency)
+            print(f"{scenario.name}: {results[scenario.name]['p95_ms']} ms p95", file=sys.stderr)
+
+    app.dependency_overrides.pop(services.get_db)
+    app.dependency_overrides.pop(services.get_read_db)
+    redis_client.set_redis(None)
+    await engine.dispose()
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "database": engine.url.get_backend_name(),
+            "python": platform.python_version(),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "dataset": {
+                "users": args.users,
+                "posts_per_user": args.posts_per_user,
+                "likes_per_post": args.likes_per_post,
+                "comments_per_post": args.comments_per_post,
+                "reply_depth": args.reply_depth,
+                "seed": args.seed,
+            },
+        },
+        "scenarios": results,
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["dataset"] != report["meta"]["dataset"]:
+            print("Warning: dataset of baseline is different, results are not comparable", file=sys.stderr)
+        regressions = compare(report, baseline, args.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every route of posts and users apis")
+    parser.add_argument("--users", type=int, default=100, help="Number of users")
+    parser.add_argument("--posts-per-user", type=int, default=10, help="Number of posts of every user")
+    parser.add_argument("--likes-per-post", type=int, default=5, help="Number of likes of every post")
+    parser.add_argument("--comments-per-post", type=int, default=3, help="Number of top level comments of every post")
+    parser.add_argument("--reply-depth", type=int, default=2, help="Number of nested replies under every top level comment")
+    parser.add_argument("--seed", type=int, default=2021, help="Random seed of dataset")
+    parser.add_argument("--requests", type=int, default=200, help="Number of requests per route")
+    parser.add_argument("--concurrency", type=int, default=10, help="Number of requests in flight")
+    parser.add_argument("--route", action="append", help="Only run routes whose name contain this text, can be repeated")
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL, help="Async SQLAlchemy database url")
+    parser.add_argument("--baseline", help="Report of a previous run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed growth of p95 latency, 0.2 is 20%%")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,84 @@
+# Measure the overhead of blog_api.metrics: ASGI middleware per request and engine events per SQL statement
+# Run from project root:
+#   python -m benchmarks.metrics_benchmark --requests 20000 --statements 20000
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+from sqlalchemy import create_engine, text
+
+from blog_api import metrics
+
+
+# smallest ASGI app, so the difference is only the middleware
+async def _plain_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+class _RouterApp:
+    routes = []
+
+
+async def _receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def _send(message):
+    pass
+
+
+async def _time_requests(app, count: int):
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": []}
+    start = time.perf_counter()
+    for _ in range(count):
+        await app(dict(scope), _receive, _send)
+    return time.perf_counter() - start
+
+
+# sync sqlite in memory, aiosqlite hand every statement to a thread and its noise hide the overhead
+def _time_statements(engine, count: int):
+    with engine.connect() as conn:
+        statement = text("SELECT 1")
+        start = time.perf_counter()
+        for _ in range(count):
+            conn.execute(statement)
+        return time.perf_counter() - start
+
+
+async def main(args):
+    plain_seconds = await _time_requests(_plain_app, args.requests)
+    measured_seconds = await _time_requests(metrics.MetricsMiddleware(_plain_app, _RouterApp()), args.requests)
+
+    plain_engine = create_engine("sqlite://")
+    instrumented_engine = create_engine("sqlite://")
+    metrics.instrument_engine(instrumented_engine)
+    plain_statements_seconds = _time_statements(plain_engine, args.statements)
+    instrumented_statements_seconds = _time_statements(instrumented_engine, args.statements)
+
+    report = {
+        "requests": args.requests,
+        "request_overhead_us": round((measured_seconds - plain_seconds) / args.requests * 1e6, 3),
+        "statements": args.statements,
+        "statement_overhead_us": round(
+            (instrumented_statements_seconds - plain_statements_seconds) / args.statements * 1e6, 3
+        ),
+        "render_ms": round(_time_render() * 1000, 3),
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+def _time_render():
+    start = time.perf_counter()
+    metrics.render()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure overhead of metrics middleware and database instrumentation")
+    parser.add_argument("--requests", type=int, default=20000, help="Number of requests sent through the middleware")
+    parser.add_argument("--statements", type=int, default=20000, help="Number of SQL statements executed")
+    asyncio.run(main(parser.parse_args()))
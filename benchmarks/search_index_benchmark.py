@@ -0,0 +1,156 @@
+# Benchmark in process search index against ilike search of posts_services.searcher
+# Run from project root:
+#   python -m benchmarks.search_index_benchmark --posts 1000000
+# by default synthetic posts are written into a local sqlite file, use --database-url to run against postgres
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from itertools import accumulate
+
+# index must be enabled before posts_services is imported
+os.environ["POST_SEARCH_INDEX_ENABLED"] = "1"
+
+import sqlalchemy.orm as _orm
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from blog_api.databases import Base
+from blog_api.models import Post
+from blog_api.posts import posts_services, search_index
+
+DEFAULT_DATABASE_URL = "sqlite+aiosqlite:///benchmarks/search_index_benchmark.db"
+VOCABULARY_SIZE = 20000
+TITLE_WORDS = 6
+CONTENT_WORDS = 40
+INSERT_BATCH_SIZE = 5000
+PAGE_SIZE = 100
+
+
+def _vocabulary():
+    return [f"word{rank}" for rank in range(1, VOCABULARY_SIZE + 1)]
+
+
+# word popularity follow zipf distribution, like real text
+def _synthetic_posts(count: int, seed: int):
+    rnd = random.Random(seed)
+    vocabulary = _vocabulary()
+    cum_weights = list(accumulate(1 / rank for rank in range(1, VOCABULARY_SIZE + 1)))
+
+    for _ in range(count):
+        yield {
+            "title": " ".join(rnd.choices(vocabulary, cum_weights=cum_weights, k=TITLE_WORDS)),
+            "content": " ".join(rnd.choices(vocabulary, cum_weights=cum_weights, k=CONTENT_WORDS)),
+            "owner_email": "benchmark@mailinator.com",
+        }
+
+
+async def _populate(session_local, count: int, seed: int):
+    async with session_local() as session:
+        existing = (await session.execute(select(Post.id).limit(1))).scalar()
+        if existing:
+            return False
+
+        batch = []
+        for post in _synthetic_posts(count, seed):
+            batch.append(post)
+            if len(batch) == INSERT_BATCH_SIZE:
+                await session.execute(insert(Post), batch)
+                batch = []
+        if batch:
+            await session.execute(insert(Post), batch)
+        await session.commit()
+
+    return True
+
+
+# same path as GET /posts page 1: search, hydrate the page then load likes and comments
+async def _timed_query(session_local, search_mode, search_field, search_value, operation, repeat):
+    timings = []
+    for _ in range(repeat):
+        async with session_local() as session:
+            start = time.perf_counter()
+            records = await posts_services.get_all_posts(
+                session, PAGE_SIZE, 1, search_field, search_value, operation, search_mode
+            )
+            timings.append(time.perf_counter() - start)
+
+    return {
+        "rows": len(records or []),
+        "median_ms": round(statistics.median(timings) * 1000, 3),
+        "min_ms": round(min(timings) * 1000, 3),
+    }
+
+
+async def main(args):
+    engine = create_async_engine(args.database_url)
+    session_local = _orm.sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    start = time.perf_counter()
+    populated = await _populate(session_local, args.posts, args.seed)
+    populate_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    async with session_local() as session:
+        index = await search_index.build_post_search_index(session)
+    build_seconds = time.perf_counter() - start
+
+    posting_bytes = sum(
+        posting.itemsize * len(posting)
+        for field_postings in index.postings.values()
+        for posting in field_postings.values()
+    )
+
+    # common, medium and rare words
+    queries = [
+        ("title", "word1", posts_services.OperatorEnum.OR),
+        ("title", "word100", posts_services.OperatorEnum.OR),
+        ("content", "word5000", posts_services.OperatorEnum.OR),
+        ("title", "word100 + word5000", posts_services.OperatorEnum.OR),
+        ("content", "word2 + word300", posts_services.OperatorEnum.AND),
+        ("content", "word1000 + word5000", posts_services.OperatorEnum.AND),
+    ]
+
+    results = []
+    for search_field, search_value, operation in queries:
+        results.append({
+            "search_field": search_field,
+            "search_value": search_value,
+            "operation": operation.value,
+            "ilike": await _timed_query(
+                session_local, posts_services.SearchModeEnum.ILIKE, search_field, search_value, operation, args.repeat
+            ),
+            "index": await _timed_query(
+                session_local, posts_services.SearchModeEnum.INDEX, search_field, search_value, operation, args.repeat
+            ),
+        })
+
+    await engine.dispose()
+
+    report = {
+        "database": engine.url.get_backend_name(),
+        "posts": len(index),
+        "populate_seconds": round(populate_seconds, 3) if populated else None,
+        "index_build_seconds": round(build_seconds, 3),
+        "index_tokens": sum(len(field_postings) for field_postings in index.postings.values()),
+        "index_posting_bytes": posting_bytes,
+        "queries": results,
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark in process post search index against ilike search")
+    parser.add_argument("--posts", type=int, default=1000000, help="Number of synthetic posts")
+    parser.add_argument("--seed", type=int, default=2021, help="Random seed of synthetic posts")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs per query")
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL, help="Async SQLAlchemy database url")
+    asyncio.run(main(parser.parse_args()))
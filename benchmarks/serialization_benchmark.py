@@ -0,0 +1,156 @@
+# Benchmark GET /posts serialized by response_model (pydantic from_orm) against the fast path (?fast=true)
+# Run from project root:
+#   python -m benchmarks.serialization_benchmark --posts 1000 --comments 5
+# by default synthetic posts are written into a local sqlite file, use --database-url to run against postgres
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from datetime import datetime, timedelta
+
+import httpx
+import sqlalchemy.orm as _orm
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from blog_api import services
+from blog_api.databases import Base
+from blog_api.main import app
+from blog_api.models import Post, Comments
+
+DEFAULT_DATABASE_URL = "sqlite+aiosqlite:///benchmarks/serialization_benchmark.db"
+INSERT_BATCH_SIZE = 5000
+PAGE_SIZE = 100
+
+
+def _synthetic_posts(count: int, rnd: random.Random):
+    start = datetime(2021, 1, 1)
+    for number in range(count):
+        yield {
+            "title": f"Post number {number}",
+            "content": " ".join(f"word{rnd.randint(1, 5000)}" for _ in range(60)),
+            "owner_email": "benchmark@mailinator.com",
+            "date_created": start + timedelta(seconds=number),
+            "date_last_update": start + timedelta(seconds=number),
+            "like_count": rnd.randint(0, 1000),
+        }
+
+
+# every post get a few top level comments and one reply under each of them
+def _synthetic_comments(post_ids, per_post: int, first_comment_id: int, rnd: random.Random):
+    comment_id = first_comment_id
+    for post_id in post_ids:
+        for _ in range(per_post):
+            yield {"id": comment_id, "post": post_id, "name": "benchmark@mailinator.com", "body": f"comment {rnd.random()}"}
+            yield {
+                "id": comment_id + 1,
+                "post": post_id,
+                "name": "benchmark@mailinator.com",
+                "body": f"reply {rnd.random()}",
+                "parent_id": comment_id,
+            }
+            comment_id += 2
+
+
+async def _insert_batches(session, model, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == INSERT_BATCH_SIZE:
+            await session.execute(insert(model), batch)
+            batch = []
+    if batch:
+        await session.execute(insert(model), batch)
+
+
+async def _populate(session_local, posts: int, comments: int, seed: int):
+    rnd = random.Random(seed)
+    async with session_local() as session:
+        existing = (await session.execute(select(Post.id).limit(1))).scalar()
+        if existing:
+            return False
+
+        await _insert_batches(session, Post, _synthetic_posts(posts, rnd))
+        post_ids = (await session.execute(select(Post.id).order_by(Post.id))).scalars().all()
+        await _insert_batches(session, Comments, _synthetic_comments(post_ids, comments, 1, rnd))
+        await session.commit()
+
+    return True
+
+
+async def _timed_get(client: httpx.AsyncClient, params: dict, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = await client.get("/posts", params=params)
+        timings.append(time.perf_counter() - start)
+        response.raise_for_status()
+
+    return response.content, {
+        "median_ms": round(statistics.median(timings) * 1000, 3),
+        "min_ms": round(min(timings) * 1000, 3),
+        "bytes": len(response.content),
+    }
+
+
+async def main(args):
+    engine = create_async_engine(args.database_url)
+    session_local = _orm.sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    await _populate(session_local, args.posts, args.comments, args.seed)
+
+    async def get_db():
+        async with session_local() as session:
+            yield session
+
+    app.dependency_overrides[services.get_db] = get_db
+    app.dependency_overrides[services.get_read_db] = get_db
+
+    results = []
+    async with httpx.AsyncClient(app=app, base_url="http://benchmark") as client:
+        for params in (
+            {"size": PAGE_SIZE},
+            {"size": PAGE_SIZE, "paging": "cursor"},
+            {"size": PAGE_SIZE, "fields": "id,title,like_count"},
+        ):
+            # warm up connection pool and caches of both paths
+            await _timed_get(client, params, 1)
+            await _timed_get(client, {**params, "fast": "true"}, 1)
+
+            default_content, default_timing = await _timed_get(client, params, args.repeat)
+            fast_content, fast_timing = await _timed_get(client, {**params, "fast": "true"}, args.repeat)
+            results.append({
+                "params": params,
+                "default": default_timing,
+                "fast": fast_timing,
+                "identical": default_content == fast_content,
+            })
+
+    app.dependency_overrides.pop(services.get_db)
+    app.dependency_overrides.pop(services.get_read_db)
+    await engine.dispose()
+
+    report = {
+        "database": engine.url.get_backend_name(),
+        "posts": args.posts,
+        "comments_per_post": args.comments * 2,
+        "requests": results,
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark default and fast serialization of GET /posts")
+    parser.add_argument("--posts", type=int, default=1000, help="Number of synthetic posts")
+    parser.add_argument("--comments", type=int, default=5, help="Number of top level comments per post, each one has a reply")
+    parser.add_argument("--seed", type=int, default=2021, help="Random seed of synthetic data")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of requests per case")
+    parser.add_argument("--database-url", default=DEFAULT_DATABASE_URL, help="Async SQLAlchemy database url")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,165 @@
+import time
+import logging
+from enum import Enum
+from collections import OrderedDict
+
+import aioredis
+
+from blog_api.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackendEnum(str, Enum):
+    MEMORY = "memory"
+    REDIS = "redis"
+    NONE = "none"
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def dict(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+# in process LRU cache, every value expire after ttl seconds
+# when cache is full, the least recently used value is evicted
+class MemoryCache:
+    backend = CacheBackendEnum.MEMORY
+
+    def __init__(self, name: str, ttl: int, max_size: int):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.stats = CacheStats()
+        # key => (expire time, value)
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    async def get(self, key: str):
+        item = self._items.get(key)
+        if item is None:
+            self.stats.misses += 1
+            return None
+
+        expire_at, value = item
+        if expire_at < time.monotonic():
+            del self._items[key]
+            self.stats.misses += 1
+            return None
+
+        self._items.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    async def set(self, key: str, value):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.stats.evictions += 1
+
+    async def delete(self, key: str):
+        self._items.pop(key, None)
+
+    async def clear(self):
+        self._items.clear()
+
+
+# cache shared by every worker, values must be str or bytes
+# redis expire keys by itself, so evictions are not counted here
+# when redis is not reachable, cache behave like a miss and request go to database
+class RedisCache:
+    backend = CacheBackendEnum.REDIS
+
+    def __init__(self, name: str, ttl: int):
+        self.name = name
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+    # shared pooled client, see blog_api.redis_client
+    @property
+    def client(self):
+        return get_redis()
+
+    def _key(self, key: str):
+        return f"cache:{self.name}:{key}"
+
+    async def get(self, key: str):
+        try:
+            value = await self.client.get(self._key(key))
+        except aioredis.RedisError:
+            logger.warning("Unable to read key %s from %s cache", key, self.name, exc_info=True)
+            value = None
+
+        if value is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return value
+
+    async def set(self, key: str, value):
+        try:
+            await self.client.set(self._key(key), value, ex=self.ttl)
+        except aioredis.RedisError:
+            logger.warning("Unable to write key %s to %s cache", key, self.name, exc_info=True)
+
+    async def delete(self, key: str):
+        try:
+            await self.client.delete(self._key(key))
+        except aioredis.RedisError:
+            logger.warning("Unable to delete key %s from %s cache", key, self.name, exc_info=True)
+
+    async def clear(self):
+        keys = [key async for key in self.client.scan_iter(match=self._key("*"))]
+        if keys:
+            await self.client.delete(*keys)
+
+
+# cache which never store anything, used when cache is turned off
+class NoCache:
+    backend = CacheBackendEnum.NONE
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stats = CacheStats()
+
+    async def get(self, key: str):
+        self.stats.misses += 1
+        return None
+
+    async def set(self, key: str, value):
+        pass
+
+    async def delete(self, key: str):
+        pass
+
+    async def clear(self):
+        pass
+
+
+def create_cache(name: str, backend: str, ttl: int, max_size: int):
+    if backend == CacheBackendEnum.MEMORY:
+        return MemoryCache(name, ttl, max_size)
+    if backend == CacheBackendEnum.REDIS:
+        return RedisCache(name, ttl)
+    if backend == CacheBackendEnum.NONE:
+        return NoCache(name)
+
+    raise ValueError(f"Cache backend {backend} is not supported!")
+
+
+def cache_stats(cache) -> dict:
+    stats = cache.stats.dict()
+    stats["name"] = cache.name
+    stats["backend"] = cache.backend
+    if isinstance(cache, MemoryCache):
+        stats["size"] = len(cache)
+        stats["max_size"] = cache.max_size
+    return stats
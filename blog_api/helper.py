@@ -12,7 +12,7 @@ from jose import JWTError, jwt
 from pydantic import BaseModel, ValidationError
 
 from .services import get_db
-from .users.users_services import get_single_user
+from .users.users_services import get_single_user, get_principal
 from .users.send_email_services import Envs
 
 # initialize authication
@@ -81,7 +81,8 @@ async def get_current_user(
     except (JWTError, ValidationError):
         raise credentials_exception
 
-    user = await get_single_user(db, user_name)
+    # only id, email, role and is_active are loaded, see get_current_user_full for the whole user
+    user = await get_principal(db, user_name)
     if not user:
         raise credentials_exception
 
@@ -96,6 +97,19 @@ async def get_current_user(
     return user
 
 
+# use this dependency instead of get_current_user in case api need posts and posts_like of current user
+async def get_current_user_full(
+    security_scopes: SecurityScopes,
+    token: str = Depends(oauth2_scheme),
+    db: Session = Depends(get_db)):
+
+    principal = await get_current_user(security_scopes, token, db)
+    if not principal:
+        return None
+
+    return await get_single_user(db, principal.email)
+
+
 # this access token doesn't saved anywhere, all data need to validate are inside token itself
 # expire is include inside token and OAuth2PasswordBearer will validate it
 async def create_access_token(data: dict, expire_delta: Optional[timedelta] = None):
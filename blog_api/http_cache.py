@@ -0,0 +1,64 @@
+import json
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+
+from fastapi import Request, Response
+
+# conditional GET, response carry ETag / Last-Modified and client send them back by If-None-Match / If-Modified-Since
+# when nothing changed we answer 304 without body, so post is neither loaded nor serialized
+
+
+# ETag is a digest of everything the response depend on, for example (post id, date_last_activity, query string)
+# weak ETag (W/"...") mean the response is semantically the same, it is used by list endpoints
+def make_etag(*parts, weak: bool = False) -> str:
+    digest = hashlib.md5(json.dumps(parts, default=str).encode("utf-8")).hexdigest()
+    return f'W/"{digest}"' if weak else f'"{digest}"'
+
+
+# datetimes of database are naive UTC
+def http_date(value: datetime) -> str:
+    return format_datetime(_to_utc(value).replace(microsecond=0), usegmt=True)
+
+
+def cache_headers(etag: str, last_modified: Optional[datetime] = None) -> dict:
+    headers = {"ETag": etag}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+# If-None-Match take precedence over If-Modified-Since (RFC 7232 section 6)
+# ETags are compared by weak comparison, which is the only one allowed for If-None-Match
+def is_not_modified(request: Request, etag: str, last_modified: Optional[datetime] = None) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {_opaque_tag(tag) for tag in if_none_match.split(",")}
+        return "*" in tags or _opaque_tag(etag) in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        # Last-Modified has one second precision
+        return _to_utc(last_modified).replace(microsecond=0) <= _to_utc(since)
+
+    return False
+
+
+def not_modified_response(headers: dict) -> Response:
+    return Response(status_code=304, headers=headers)
+
+
+def _opaque_tag(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def _to_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
@@ -3,14 +3,16 @@ import fastapi
 from fastapi import Request, Security
 from fastapi.param_functions import Depends
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from blog_api import cache, databases, metrics, query_counter, redis_client, replicas, services
 from blog_api.models import User
-from blog_api.users import users_apis, send_email_apis
-from blog_api.posts import posts_apis
+from blog_api.users import users_apis, send_email_apis, send_email_services, hashing_services
+from blog_api.posts import posts_apis, posts_services, search_index
 from blog_api.helper import get_current_user, templates, test_scope
 # from blog_api.posts import posts_apis
-# from blog_api.users import users_apis, send_email_apis
+# from blog_api.users import users_apis, send_email_apis, hashing_services
 
 # Initialize app
 app = fastapi.FastAPI(
@@ -20,9 +22,61 @@ app = fastapi.FastAPI(
 
 app.mount("/static", StaticFiles(directory="blog_api/static"), name="static")
 
+# request latency, database and redis usage are recorded by metrics, see GET /metrics
+if metrics.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware, router_app=app)
+    for engine in [databases.async_engine, *databases.replica_engines]:
+        metrics.instrument_engine(engine)
+
+# read your writes of replicas, only needed when there are replicas
+if databases.replica_engines:
+    app.add_middleware(replicas.ReplicaStickyMiddleware)
+
+# dev mode, log statements which are repeated inside one request (N+1 queries)
+if query_counter.N_PLUS_ONE_DETECTION:
+    app.add_middleware(query_counter.QueryCounterMiddleware)
+
+# statements are only recorded inside query_counter.count_queries(), tests use it to check query budgets
+for engine in [databases.async_engine, *databases.replica_engines]:
+    query_counter.instrument_engine(engine)
+
+metrics.registry.add_collector(lambda: metrics.observe_cache_stats(cache.cache_stats(posts_services.post_cache)))
+metrics.registry.add_collector(lambda: metrics.observe_hashing_stats(hashing_services.hashing_stats()))
+
 # Initialize DB
 # asyncio.run(create_db())
 
+# build in process search index of posts, only when it is enabled
+@app.on_event("startup")
+async def build_post_search_index():
+    if not search_index.POST_SEARCH_INDEX_ENABLED:
+        return
+
+    async with databases.async_session_local() as session:
+        await search_index.build_post_search_index(session)
+
+
+# health checks of read replicas, it does nothing when there is no replica
+@app.on_event("startup")
+def start_replica_health_checks():
+    replicas.db_router.start()
+
+
+@app.on_event("shutdown")
+async def stop_replica_health_checks():
+    await replicas.db_router.stop()
+
+
+@app.on_event("shutdown")
+def shutdown_password_hasher():
+    hashing_services.password_hasher.shutdown()
+    hashing_services.bulk_password_hasher.shutdown()
+
+
+@app.on_event("shutdown")
+async def close_redis_connections():
+    await redis_client.close_redis()
+
 # include routers
 app.include_router(
     users_apis.router,
@@ -51,6 +105,12 @@ async def test_template(request: Request, current_user: User = Depends(get_curre
     else:
         return templates.TemplateResponse("home.html", {"request": request, "signedin": signed_in})
 
+# metrics of this worker in Prometheus text format, email metrics are read from the outbox of the database
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics(db: AsyncSession = Depends(services.get_read_db)):
+    await send_email_services.observe_outbox(db)
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.post("/test_scopes")
 async def test_scopes(
     scopes = Security(test_scope, scopes=["me"])
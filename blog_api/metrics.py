@@ -0,0 +1,381 @@
+import os
+import time
+import contextvars
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# metrics in Prometheus text format, they are exposed by GET /metrics (see main.py)
+# Note: like caches, every uvicorn worker has its own metrics, Prometheus should scrape every worker
+# set METRICS_ENABLED=0 to turn off the middleware and database/redis instrumentation
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+STATEMENTS_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+REDIS_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# a metric keep one value per tuple of label values
+# updates are plain python operations, the event loop is single threaded so they don't need a lock
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        # metric without labels is reported as 0 before its first update
+        if not self.labelnames and self.type != "histogram":
+            self.values[()] = 0
+
+    def samples(self) -> List[Tuple[str, str, object]]:
+        return [(self.name, _labels_text(self.labelnames, labels), value) for labels, value in self.values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    # for totals which are already counted by other modules, for example cache stats
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+
+# buckets are counted separately and only summed up when metrics are rendered, so observe is a bisect and two additions
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, labels: tuple = ()):
+        state = self.values.get(labels)
+        if state is None:
+            # [count of every bucket and +Inf, sum]
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self):
+        samples = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_number(float(bound))}"'
+                samples.append((f"{self.name}_bucket", _labels_text(self.labelnames, labels, le), cumulative))
+            samples.append((f"{self.name}_sum", _labels_text(self.labelnames, labels), total))
+            samples.append((f"{self.name}_count", _labels_text(self.labelnames, labels), cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        # functions which update gauges right before metrics are rendered, for values owned by other modules
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], None]):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests_total = registry.counter(
+    "http_requests_total", "Number of HTTP requests", ("method", "route", "status")
+)
+http_request_duration_seconds = registry.histogram(
+    "http_request_duration_seconds", "Time until the last byte of response was sent", ("method", "route")
+)
+http_requests_in_flight = registry.gauge("http_requests_in_flight", "Number of HTTP requests being processed")
+http_request_db_statements = registry.histogram(
+    "http_request_db_statements", "Number of SQL statements executed by one request", ("route",), STATEMENTS_BUCKETS
+)
+http_request_db_seconds = registry.histogram(
+    "http_request_db_seconds", "Total time of SQL statements executed by one request", ("route",), DB_LATENCY_BUCKETS
+)
+db_statement_duration_seconds = registry.histogram(
+    "db_statement_duration_seconds", "Time of one SQL statement", ("engine",), DB_LATENCY_BUCKETS
+)
+db_pool_checkouts_total = registry.counter(
+    "db_pool_checkouts_total", "Number of connections checked out from pool", ("engine",)
+)
+db_pool_wait_seconds = registry.histogram(
+    "db_pool_wait_seconds", "Time spent waiting for a connection from pool", ("engine",), DB_LATENCY_BUCKETS
+)
+db_pool_checked_out = registry.gauge("db_pool_checked_out", "Number of connections in use", ("engine",))
+db_pool_overflow = registry.gauge(
+    "db_pool_overflow", "Number of connections opened above pool size, negative when pool is not full yet", ("engine",)
+)
+redis_command_duration_seconds = registry.histogram(
+    "redis_command_duration_seconds", "Time of one redis command or pipeline", ("command",), REDIS_LATENCY_BUCKETS
+)
+redis_command_errors_total = registry.counter("redis_command_errors_total", "Number of failed redis commands", ("command",))
+email_queue_depth = registry.gauge("email_queue_depth", "Number of pending emails in the outbox")
+email_send_failures_total = registry.counter("email_send_failures_total", "Number of emails of the outbox which could not be sent after all attempts")
+cache_requests_total = registry.counter("cache_requests_total", "Number of cache lookups", ("cache", "result"))
+cache_evictions_total = registry.counter("cache_evictions_total", "Number of values evicted from cache", ("cache",))
+cache_size = registry.gauge("cache_size", "Number of values in in process cache", ("cache",))
+password_hashing_calls_total = registry.counter(
+    "password_hashing_calls_total", "Number of hashing jobs done by password hasher pool", ("pool",)
+)
+password_hashing_rejected_total = registry.counter(
+    "password_hashing_rejected_total", "Number of hashing jobs rejected because pool queue was full", ("pool",)
+)
+password_hashing_wait_seconds_total = registry.counter(
+    "password_hashing_wait_seconds_total", "Time hashing jobs waited for a worker", ("pool",)
+)
+password_hashing_seconds_total = registry.counter(
+    "password_hashing_seconds_total", "Time spent hashing passwords", ("pool",)
+)
+password_hashing_pending = registry.gauge("password_hashing_pending", "Number of hashing jobs running or queued")
+
+
+# database usage of the current request, it is a mutable object so it is also updated from
+# sync dependencies (they run in a copy of the context) and from SQLAlchemy greenlets
+class RequestDbStats:
+    __slots__ = ("statements", "seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+
+_request_db_stats: contextvars.ContextVar[Optional[RequestDbStats]] = contextvars.ContextVar(
+    "request_db_stats", default=None
+)
+
+
+def current_request_db_stats() -> Optional[RequestDbStats]:
+    return _request_db_stats.get()
+
+
+# route template (for example /posts/{post_id}) of an endpoint, raw path would give one time series per post
+_route_names: Dict[object, str] = {}
+
+
+def _route_name(app, scope) -> str:
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+
+    name = _route_names.get(endpoint)
+    if name is None:
+        name = "unmatched"
+        for route in app.routes:
+            if getattr(route, "endpoint", None) is endpoint or getattr(route, "app", None) is endpoint:
+                name = route.path
+                break
+        _route_names[endpoint] = name
+    return name
+
+
+# plain ASGI middleware, it doesn't wrap request and response like @app.middleware("http") does
+# latency is measured until the last body chunk was sent, so background tasks (emails) are not counted in
+class MetricsMiddleware:
+    def __init__(self, app, router_app=None):
+        self.app = app
+        # the FastAPI application, its routes are used to name endpoints
+        self.router_app = router_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        db_stats = RequestDbStats()
+        token = _request_db_stats.set(db_stats)
+        status = [500]
+        finished = [False]
+
+        def finish():
+            if finished[0]:
+                return
+            finished[0] = True
+            http_requests_in_flight.dec()
+            route = _route_name(self.router_app, scope)
+            http_request_duration_seconds.observe(time.perf_counter() - start, (scope["method"], route))
+            http_requests_total.inc((scope["method"], route, status[0]))
+            http_request_db_statements.observe(db_stats.statements, (route,))
+            http_request_db_seconds.observe(db_stats.seconds, (route,))
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finish()
+            _request_db_stats.reset(token)
+
+
+def _engine_label(engine: Union[AsyncEngine, Engine]) -> str:
+    url = engine.url
+    return f"{url.get_backend_name()}://{url.host or ''}/{url.database or ''}"
+
+
+# statements are timed by cursor events, pool usage by pool events
+# waiting time for a connection has no event, so _do_get of the pool is wrapped
+# engine is an AsyncEngine, sync Engine works as well (benchmark use it)
+def instrument_engine(engine: Union[AsyncEngine, Engine]):
+    label = (_engine_label(engine),)
+    sync_engine = getattr(engine, "sync_engine", engine)
+    pool = sync_engine.pool
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["metrics_query_start"].pop()
+        db_statement_duration_seconds.observe(seconds, label)
+        db_stats = _request_db_stats.get()
+        if db_stats is not None:
+            db_stats.statements += 1
+            db_stats.seconds += seconds
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(context):
+        starts = context.connection.info.get("metrics_query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+    @event.listens_for(pool, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        db_pool_checkouts_total.inc(label)
+
+    do_get = pool._do_get
+
+    def _timed_do_get():
+        start = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            db_pool_wait_seconds.observe(time.perf_counter() - start, label)
+
+    pool._do_get = _timed_do_get
+
+    def _collect_pool():
+        if hasattr(pool, "checkedout"):
+            db_pool_checked_out.set(pool.checkedout(), label)
+        if hasattr(pool, "overflow"):
+            db_pool_overflow.set(pool.overflow(), label)
+
+    registry.add_collector(_collect_pool)
+
+
+# time of one redis call, command is the redis command name or "pipeline"
+class RedisTimer:
+    __slots__ = ("command", "start")
+
+    def __init__(self, command: str):
+        self.command = command
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        redis_command_duration_seconds.observe(time.perf_counter() - self.start, (self.command,))
+        if exc_type is not None:
+            redis_command_errors_total.inc((self.command,))
+        return False
+
+
+# stats owned by other modules are copied into metrics when metrics are rendered (see main.py)
+# stats is the dict of cache.cache_stats
+def observe_cache_stats(stats: dict):
+    label = (stats["name"],)
+    cache_requests_total.set(stats["hits"], (stats["name"], "hit"))
+    cache_requests_total.set(stats["misses"], (stats["name"], "miss"))
+    cache_evictions_total.set(stats["evictions"], label)
+    if "size" in stats:
+        cache_size.set(stats["size"], label)
+
+
+# stats is the dict of hashing_services.hashing_stats
+def observe_hashing_stats(stats: dict):
+    password_hashing_pending.set(stats["pending"])
+    for pool, pool_stats in (("default", stats), ("bulk", stats["bulk"])):
+        password_hashing_calls_total.set(pool_stats["calls"], (pool,))
+        password_hashing_rejected_total.set(pool_stats["rejected"], (pool,))
+        password_hashing_wait_seconds_total.set(pool_stats["wait_seconds_total"], (pool,))
+        password_hashing_seconds_total.set(pool_stats["hash_seconds_total"], (pool,))
+
+
+def render() -> str:
+    return registry.render()
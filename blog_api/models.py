@@ -5,10 +5,12 @@ from sqlalchemy import (
     Integer,
     String,
     Boolean,
-    DateTime
+    DateTime,
+    Index,
+    JSON
 )
-from sqlalchemy import orm
-from sqlalchemy.sql.expression import select
+from sqlalchemy import orm, event, DDL, func
+from sqlalchemy.sql.expression import select, literal_column
 from sqlalchemy.sql.schema import ForeignKey
 from blog_api.databases import Base
 
@@ -33,8 +35,15 @@ class Post(Base):
     title = Column(String, index=True)
     content = Column(String, index=True)
     owner_email = Column(String, ForeignKey("users.email", ondelete='CASCADE'))
-    date_created = Column(DateTime, default=datetime.utcnow())
-    date_last_update = Column(DateTime, default=datetime.utcnow())
+    # default is the function, not its result, utcnow() would be evaluated once at import for every post of the process
+    # (date_created, id) is the sort key of cursor pagination
+    date_created = Column(DateTime, default=datetime.utcnow, server_default=func.now())
+    date_last_update = Column(DateTime, default=datetime.utcnow, server_default=func.now())
+    # number of rows in link_user_post of this post, it is updated in the same transaction as like/unlike
+    like_count = Column(Integer, default=0, server_default="0", nullable=False)
+    # last time post, its likes or its comments changed, it is the validator of ETag / Last-Modified
+    # every write which change the response of GET /posts/{post_id} must bump it, see posts_services.touch_post
+    date_last_activity = Column(DateTime, default=datetime.utcnow, server_default=func.now(), nullable=False)
 
     # like field is associated with User model through link_user_post table
     # and back_populate mean we are explicit User instance can refer to Post instance through posts_like field
@@ -43,6 +52,32 @@ class Post(Base):
     comments = orm.relationship("Comments", lazy='selectin')
     # comments = orm.relationship("Comments")
 
+    __table_args__ = (
+        # sort key of cursor pagination, see posts_services.get_all_posts_cursor
+        Index("ix_posts_date_created_id", "date_created", "id"),
+    )
+
+# full text search column of posts, it's a postgres generated column so database keep it up to date by itself
+# title has weight A, content has weight B, that way we can rank and filter by field, see posts_services.searcher
+# it is not mapped into Post model, because we never want to load it and other database (sqlite) doesn't have tsvector
+POST_SEARCH_CONFIG = "english"
+POST_SEARCH_VECTOR = literal_column("posts.search_vector")
+event.listen(
+    Post.__table__,
+    "after_create",
+    DDL(
+        "ALTER TABLE posts ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+        f"setweight(to_tsvector('{POST_SEARCH_CONFIG}', coalesce(title, '')), 'A') || "
+        f"setweight(to_tsvector('{POST_SEARCH_CONFIG}', coalesce(content, '')), 'B')"
+        ") STORED"
+    ).execute_if(dialect="postgresql")
+)
+event.listen(
+    Post.__table__,
+    "after_create",
+    DDL("CREATE INDEX ix_posts_search_vector ON posts USING GIN (search_vector)").execute_if(dialect="postgresql")
+)
+
 # https://www.tutorialspoint.com/sqlalchemy/sqlalchemy_orm_many_to_many_relationships.htm
 class Link_User_Post(Base):
     __tablename__ = "link_user_post"
@@ -55,9 +90,40 @@ class Comments(Base):
     post = Column(Integer, ForeignKey("posts.id", ondelete='CASCADE'))
     name = Column(String)
     body = Column(String)
-    date_created = Column(DateTime, default=datetime.utcnow())
+    # sort key of comment pagination with id, see Post.date_created for why default is not utcnow()
+    date_created = Column(DateTime, default=datetime.utcnow, server_default=func.now())
 
     # https://docs.sqlalchemy.org/en/14/orm/self_referential.html#self-referential
     parent_id = Column(Integer, ForeignKey("comments.id"))
+
+    __table_args__ = (
+        # sort key of comment pagination, see posts_services.get_comment_page
+        Index("ix_comments_post_parent_id_date_created_id", "post", "parent_id", "date_created", "id"),
+    )
     # why lazy='selectin' don't work in self reference model
     children = orm.relationship("Comments", lazy='selectin')
+
+
+# emails waiting for blog_api.users.email_worker, rows are added in the same transaction as the change which need
+# the email (register, forgot password, bulk import), so an email is not lost on restart nor sent for a rolled back change
+class EmailOutbox(Base):
+    __tablename__ = "email_outbox"
+    id = Column(Integer, primary_key=True)
+    recipient = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    template_name = Column(String, nullable=False)
+    # template body, it is cleared once the email is sent because it can hold a temporary password
+    body = Column(JSON)
+    # pending, sent or failed (given up after EMAIL_MAX_ATTEMPTS), see send_email_services.EmailStatusEnum
+    status = Column(String, default="pending", server_default="pending", nullable=False)
+    attempts = Column(Integer, default=0, server_default="0", nullable=False)
+    # a pending email is sent once this time is reached, every failed attempt push it back (exponential backoff)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, server_default=func.now(), nullable=False)
+    last_error = Column(String)
+    date_created = Column(DateTime, default=datetime.utcnow, server_default=func.now(), nullable=False)
+    date_sent = Column(DateTime)
+
+    __table_args__ = (
+        # the worker pick due pending emails in this order, see email_worker.claim_batch
+        Index("ix_email_outbox_status_next_attempt_at", "status", "next_attempt_at"),
+    )
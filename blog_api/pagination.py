@@ -0,0 +1,41 @@
+import base64
+import json
+from datetime import datetime
+from enum import Enum
+
+
+class PagingEnum(str, Enum):
+    OFFSET = "offset"
+    CURSOR = "cursor"
+
+
+# cursor is opaque for client, it only need to send back "next_cursor" value which was received from previous page
+# internally it's just the sort key of the last row on the page, for example (date_created, id)
+# example: [datetime(2021, 8, 7), 15] => "WyIyMDIxLTA4LTA3VDAwOjAwOjAwIiwgMTVd"
+def encode_cursor(*values) -> str:
+    raw_values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    raw = json.dumps(raw_values).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("utf-8")
+
+
+# raise ValueError in case client send us a cursor which was not created by encode_cursor
+def decode_cursor(cursor: str, *types) -> list:
+    try:
+        raw_values = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+    except (ValueError, TypeError):
+        raise ValueError(f"Cursor {cursor} is invalid!")
+
+    if not isinstance(raw_values, list) or len(raw_values) != len(types):
+        raise ValueError(f"Cursor {cursor} is invalid!")
+
+    values = []
+    try:
+        for value, value_type in zip(raw_values, types):
+            if value_type is datetime:
+                values.append(datetime.fromisoformat(value))
+            else:
+                values.append(value_type(value))
+    except (ValueError, TypeError):
+        raise ValueError(f"Cursor {cursor} is invalid!")
+
+    return values
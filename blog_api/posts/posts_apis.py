@@ -1,31 +1,80 @@
 # We will run this file by uvicorn
-from typing import List, Optional
+import json
+from typing import List, Optional, Union
+from pydantic import ValidationError
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.status import HTTP_400_BAD_REQUEST
-from fastapi import Depends, HTTPException, APIRouter, Security, Query
+from fastapi import Depends, HTTPException, APIRouter, Security, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 
 from blog_api.schemas import(
     PostCreate
 )
 from blog_api.models import User as User_db
-from blog_api import services
+from blog_api import services, http_cache
 from blog_api.users import users_services
 from blog_api.posts import posts_services
 from blog_api.helper import CREDENTIAL_EXCEPTION, get_current_user
-from blog_api.schemas import Post, Comments
+from blog_api.schemas import Post, Comments, CommentPage, PostPage, PostSummary, UserPage
 from blog_api.exceptions import ItemDoesNotExsit
+from blog_api.pagination import PagingEnum
 
 PREFIX = "/posts"
 TAGS = ["posts api"]
 # Initialize app
 router = APIRouter()
 
+# it read database, not post_cache, a cached copy of another worker may still exist after the post was deleted
 async def __validate_post_by_id(db: AsyncSession, post_id: int):
-    post_check = await posts_services.get_post_single(db, post_id)
+    post_check = await posts_services.get_post_owner(db, post_id)
     if not post_check:
         ItemDoesNotExsit(f"Post with ID {post_id} does not exsit!")
 
+    return post_check
+
+
+# search_field and search_value only work together, one of them alone is rejected with 422
+def __validate_search(search_field: Optional[str], search_value: Optional[str]):
+    if (search_field is None) != (search_value is None):
+        raise HTTPException(status_code=422, detail="search_field and search_value must be given together!")
+
+
+# parse "fields" query parameter, unknown fields are rejected with 400
+def __parse_fields(fields: Optional[str], schema):
+    try:
+        return posts_services.parse_post_fields(fields, schema)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+# posts with only requested fields are validated by a model built for those fields
+# JSONResponse bypass response_model of the route, which would require every field
+# fast skip pydantic: dicts built from rows are only reordered like the schema then encoded by orjson
+# output is the same bytes as JSONResponse, datetime of both are encoded by isoformat
+def __fields_response(schema, fields, records, next_cursor=None, page=False, fast=False):
+    if fast:
+        names = [name for name in schema.__fields__ if name in fields]
+        to_content = lambda record: {name: record[name] for name in names}
+    else:
+        to_content = lambda record: posts_services.post_fields_model(schema, fields)(**record)
+
+    if records is None:
+        content = None
+    elif isinstance(records, list):
+        content = [to_content(record) for record in records]
+    else:
+        content = to_content(records)
+
+    if page:
+        content = {"items": content, "next_cursor": next_cursor}
+
+    if fast:
+        return ORJSONResponse(content=content)
+
+    return JSONResponse(content=jsonable_encoder(content))
+
 # Security is actually a subclass of Depends
 # You can use Security to declare dependencies (just like Depends), but Security also receives a parameter scopes with a list of scopes (strings).
 @router.post("")
@@ -41,51 +90,259 @@ async def create_post(
     return await posts_services.create_post(db, current_user.email, post)
 
 
-@router.get("", response_model=List[Post])
+# read posts from body of bulk api, body is a JSON array or NDJSON (one post per line)
+# NDJSON is parsed while it is streamed, so big batches don't need to be loaded into memory
+async def __read_bulk_posts(request: Request):
+    def parse_post(number: int, item):
+        try:
+            return PostCreate.parse_obj(item)
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=f"Post number {number} is invalid: {e.errors()}")
+
+    def parse_line(number: int, line: bytes):
+        try:
+            return parse_post(number, json.loads(line))
+        except ValueError:
+            raise HTTPException(status_code=422, detail=f"Post number {number} is not a valid JSON!")
+
+    content_type = request.headers.get("content-type", "")
+
+    if content_type.startswith("application/x-ndjson"):
+        number = 0
+        buffer = b""
+        async for data in request.stream():
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    number += 1
+                    yield parse_line(number, line)
+        if buffer.strip():
+            yield parse_line(number + 1, buffer)
+        return
+
+    try:
+        items = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Body is not a valid JSON!")
+
+    if not isinstance(items, list):
+        raise HTTPException(status_code=422, detail="Body must be a JSON array of posts!")
+
+    for number, item in enumerate(items, start=1):
+        yield parse_post(number, item)
+
+
+@router.post("/bulk", status_code=201)
+async def bulk_create_posts(
+    request: Request,
+    chunk_size: Optional[int] = Query(
+        posts_services.BULK_INSERT_CHUNK_SIZE,
+        gt=0,
+        le=posts_services.MAX_BULK_INSERT_CHUNK_SIZE,
+        description="Number of posts per INSERT statement"
+    ),
+    current_user: User_db = Security(get_current_user, scopes=["admin", "user"]),
+    db: AsyncSession = Depends(services.get_db)
+):
+    if not current_user:
+        raise CREDENTIAL_EXCEPTION
+    await users_services.verify_user(current_user.email, db)
+
+    post_ids, chunks = await posts_services.bulk_create_posts(
+        db, current_user.email, __read_bulk_posts(request), chunk_size
+    )
+
+    return {"count": len(post_ids), "ids": post_ids, "chunks": chunks}
+
+
+@router.get("", response_model=Union[PostPage, List[PostSummary]])
 async def get_all_post(
+    request: Request,
+    response: Response,
     # size and page is query parameters and need to greater than 0
     size: Optional[int] = Query(posts_services.DEFAULT_PAGING_SIZE, gt=0, description = "Page size"),
     page: Optional[int] = Query(posts_services.DEFAULT_PAGING_PAGE_NUMBER, gt=0, description = "Page number"),
+    # cursor params, in cursor mode page is ignored and response contain next_cursor
+    paging: Optional[PagingEnum] = Query(
+        PagingEnum.OFFSET, description="Paging mode. Cursor mode cost the same for every page"
+    ),
+    after: Optional[str] = Query(None, description="Cursor received from previous page (cursor mode only)"),
     # seacher params
     search_field: Optional[str] = Query(None, description="Field need to search"),
     search_value: Optional[str] = Query(None, description="Value need to search. Example value1 + value2"),
     operation: Optional[posts_services.OperatorEnum] = Query(
         posts_services.OperatorEnum.OR, description="Operator was used when seacch multiple field"
     ),
-    db: AsyncSession = Depends(services.get_db)
+    search_mode: Optional[posts_services.SearchModeEnum] = Query(
+        posts_services.DEFAULT_SEARCH_MODE,
+        description="Full text search is ranked by relevance, full text and index search are only available for title and content, other fields (and full text search on other database than postgres, index search in cursor mode) use ilike"
+    ),
+    fields: Optional[str] = Query(None, description="Comma separated fields to return, example title,like_count"),
+    fast: Optional[bool] = Query(False, description="Build response from database rows without pydantic validation"),
+    db: AsyncSession = Depends(services.get_read_db)
 ):
-    try:
-        reccords = await posts_services.get_all_posts(
-            db,
-            size,
-            page,
-            search_field,
-            search_value,
-            operation
-        )
-    except ValueError:
-        raise HTTPException(
-            status_code=400, detail="Number of page is out of range, please choose lower number!"
-        )
+    __validate_search(search_field, search_value)
+    fields = __parse_fields(fields, PostSummary)
+    # fast path read columns like sparse fieldsets, by default it contain every field
+    if fast and fields is None:
+        fields = frozenset(PostSummary.__fields__)
+
+    cursor_mode = paging == PagingEnum.CURSOR or bool(after)
+
+    async def load_posts(load_fields):
+        try:
+            if cursor_mode:
+                return await posts_services.get_all_posts_cursor(
+                    db,
+                    size,
+                    after,
+                    search_field,
+                    search_value,
+                    operation,
+                    search_mode,
+                    load_fields
+                )
+
+            reccords = await posts_services.get_all_posts(
+                db,
+                size,
+                page,
+                search_field,
+                search_value,
+                operation,
+                search_mode,
+                load_fields
+            )
+            return reccords, None
+        except ValueError as e:
+            if cursor_mode:
+                raise HTTPException(status_code=400, detail=str(e))
+            raise HTTPException(
+                status_code=400, detail="Number of page is out of range, please choose lower number!"
+            )
+
+    # weak ETag of the page, a conditional request is answered by a query of (id, date_last_activity) of the page
+    query = str(request.query_params)
+    if request.headers.get("if-none-match"):
+        validators, _ = await load_posts(frozenset())
+        etag = posts_services.posts_etag(validators, query)
+        if http_cache.is_not_modified(request, etag):
+            return http_cache.not_modified_response(http_cache.cache_headers(etag))
 
-    return reccords
+    records, next_cursor = await load_posts(fields)
+    headers = http_cache.cache_headers(posts_services.posts_etag(records, query))
+
+    if fields is not None:
+        fields_response = __fields_response(PostSummary, fields, records, next_cursor, page=cursor_mode, fast=fast)
+        fields_response.headers.update(headers)
+        return fields_response
+
+    response.headers.update(headers)
+    if cursor_mode:
+        return PostPage(items=records, next_cursor=next_cursor)
+
+    return records
+
+
+# it must be declared before "/{post_id}", otherwise "export" is matched as a post id
+# db session stay open until the response is fully sent, code after yield of get_db only run after that
+@router.get("/export")
+async def export_posts(
+    format: Optional[posts_services.ExportFormatEnum] = Query(
+        posts_services.ExportFormatEnum.NDJSON, description="Format of exported posts"
+    ),
+    after_id: Optional[int] = Query(None, description="Only export posts with greater id, use it to resume an export"),
+    # seacher params
+    search_field: Optional[str] = Query(None, description="Field need to search"),
+    search_value: Optional[str] = Query(None, description="Value need to search. Example value1 + value2"),
+    operation: Optional[posts_services.OperatorEnum] = Query(
+        posts_services.OperatorEnum.OR, description="Operator was used when seacch multiple field"
+    ),
+    search_mode: Optional[posts_services.SearchModeEnum] = Query(
+        posts_services.DEFAULT_SEARCH_MODE, description="Search mode, see GET /posts"
+    ),
+    db: AsyncSession = Depends(services.get_read_db)
+):
+    __validate_search(search_field, search_value)
+    rows = posts_services.export_posts(db, search_field, search_value, operation, search_mode, after_id)
+
+    if format == posts_services.ExportFormatEnum.CSV:
+        content, media_type = posts_services.export_posts_csv(rows), "text/csv"
+    else:
+        content, media_type = posts_services.export_posts_ndjson(rows), "application/x-ndjson"
+
+    return StreamingResponse(
+        content,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=posts.{format.value}"},
+    )
 
 
 @router.get("/{user_email}/posts/")
-async def get_all_posts_from_one_user(user_email: str, db: AsyncSession = Depends(services.get_db)):
+async def get_all_posts_from_one_user(
+    user_email: str,
+    request: Request,
+    response: Response,
+    fields: Optional[str] = Query(None, description="Comma separated fields to return, example title,like_count"),
+    db: AsyncSession = Depends(services.get_read_db)
+):
+    fields = __parse_fields(fields, Post)
+
     await users_services.verify_user(user_email, db)
 
-    return await posts_services.get_all_posts_from_one_user(db, user_email)
+    records = await posts_services.get_all_posts_from_one_user(db, user_email, fields)
+
+    # posts are already loaded, 304 only save serialization and bandwidth
+    etag = posts_services.posts_etag(records, str(request.query_params))
+    headers = http_cache.cache_headers(etag)
+    if http_cache.is_not_modified(request, etag):
+        return http_cache.not_modified_response(headers)
+
+    if fields is not None:
+        fields_response = __fields_response(Post, fields, records)
+        fields_response.headers.update(headers)
+        return fields_response
+
+    response.headers.update(headers)
+    return records
 
 
 @router.get("/{post_id}", response_model=Post)
-async def get_post_single(post_id: int, db: AsyncSession = Depends(services.get_db)):
+async def get_post_single(
+    post_id: int,
+    request: Request,
+    response: Response,
+    fields: Optional[str] = Query(None, description="Comma separated fields to return, example title,like_count"),
+    db: AsyncSession = Depends(services.get_read_db)
+):
+    fields = __parse_fields(fields, Post)
+
+    # date_last_activity is bumped by every change of post, its likes and its comments
+    # so it is enough to validate the cached copy of client without loading the post
+    last_activity = await posts_services.get_post_last_activity(db, post_id)
+    if last_activity is None:
+        ItemDoesNotExsit(f"Post with id = {post_id} is not exsit!")
 
-    record = await posts_services.get_post_single(db, post_id)
+    etag = http_cache.make_etag(post_id, last_activity, str(request.query_params))
+    headers = http_cache.cache_headers(etag, last_activity)
+    if http_cache.is_not_modified(request, etag, last_activity):
+        return http_cache.not_modified_response(headers)
+
+    if fields is not None:
+        record = await posts_services.get_post_single(db, post_id, fields)
+    else:
+        record = await posts_services.get_post_single_cached(db, post_id, last_activity)
 
     if not record:
         ItemDoesNotExsit(f"Post with id = {post_id} is not exsit!")
 
+    if fields is not None:
+        fields_response = __fields_response(Post, fields, record)
+        fields_response.headers.update(headers)
+        return fields_response
+
+    response.headers.update(headers)
     return record
 
 
@@ -97,7 +354,7 @@ async def update_post(
     db: AsyncSession = Depends(services.get_db)
 ):
 
-    post_record: Post = await get_post_single(post_id, db)
+    post_record: Post = await __validate_post_by_id(db, post_id)
 
     # only owner of comment or admin can update it
     if post_record.owner_email != current_user.email and current_user.role != "admin":
@@ -117,7 +374,7 @@ async def delete_post(
     current_user: User_db = Security(get_current_user, scopes=["admin", "user"]),
     db: AsyncSession = Depends(services.get_db)
 ):
-    post_record: Post = await get_post_single(post_id, db)
+    post_record: Post = await __validate_post_by_id(db, post_id)
 
     # only owner of comment or admin can delete it
     if post_record.owner_email != current_user.email and current_user.role != "admin":
@@ -126,9 +383,7 @@ async def delete_post(
             detail="you are not allow to delete this post!"
         )
 
-    user = await users_services.get_single_user(db, current_user.email)
-
-    status = await posts_services.delete_post(user.id, post_id, db)
+    status = await posts_services.delete_post(post_id, db)
 
     if status:
         return f"Delete Post with id {post_id} successfully!"
@@ -149,7 +404,7 @@ async def create_post_like(
         raise CREDENTIAL_EXCEPTION
     
     # validate post by id
-    await get_post_single(post_id, db)
+    await __validate_post_by_id(db, post_id)
 
     status = await posts_services.create_post_like(current_user.id, post_id, db)
     if status:
@@ -158,6 +413,23 @@ async def create_post_like(
         return f"User with email {current_user.email} was unlike post with id {post_id}!"
 
 
+@router.get("/{post_id}/likes", response_model=UserPage)
+async def get_post_likes(
+    post_id: int,
+    size: Optional[int] = Query(posts_services.DEFAULT_PAGING_SIZE, gt=0, description = "Page size"),
+    after: Optional[str] = Query(None, description="Cursor received from previous page"),
+    db: AsyncSession = Depends(services.get_read_db)
+):
+    await __validate_post_by_id(db, post_id)
+
+    try:
+        records, next_cursor = await posts_services.get_post_likes(post_id, db, size, after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return UserPage(items=records, next_cursor=next_cursor)
+
+
 @router.post("/{post_id}/comment", status_code=201)
 async def create_post_comment(
     post_id: int,
@@ -168,7 +440,7 @@ async def create_post_comment(
 ):
 
         # validate post by id
-    await get_post_single(post_id, db)
+    await __validate_post_by_id(db, post_id)
 
     if not current_user:
         raise CREDENTIAL_EXCEPTION
@@ -187,16 +459,57 @@ async def create_post_comment(
         )
 
 
-@router.get("/{post_id}/comment")
+@router.get("/{post_id}/comment", response_model=Union[CommentPage, List[Comments]])
 async def get_all_comments(
     post_id: int,
-    db: AsyncSession = Depends(services.get_db)
+    # without cursor mode, every comment thread of post is returned at once
+    paging: Optional[PagingEnum] = Query(
+        PagingEnum.OFFSET, description="Paging mode. Cursor mode return a page of top level comments"
+    ),
+    size: Optional[int] = Query(posts_services.DEFAULT_COMMENT_PAGING_SIZE, gt=0, le=100, description="Page size (cursor mode only)"),
+    after: Optional[str] = Query(None, description="Cursor received from previous page (cursor mode only)"),
+    replies_size: Optional[int] = Query(
+        posts_services.DEFAULT_COMMENT_REPLIES_SIZE, ge=0, le=100, description="Number of inline replies per comment (cursor mode only)"
+    ),
+    db: AsyncSession = Depends(services.get_read_db)
 ):
+    if paging == PagingEnum.CURSOR or after:
+        try:
+            items, next_cursor = await posts_services.get_comment_page(db, post_id, None, size, after, replies_size)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return CommentPage(items=items, next_cursor=next_cursor)
+
     record = await posts_services.get_all_comment(post_id, db)
 
     return record
 
 
+@router.get("/{post_id}/comment/{comment_id}/replies", response_model=CommentPage)
+async def get_comment_replies(
+    post_id: int,
+    comment_id: int,
+    size: Optional[int] = Query(posts_services.DEFAULT_COMMENT_PAGING_SIZE, gt=0, le=100, description="Page size"),
+    after: Optional[str] = Query(None, description="Cursor received from previous page or replies_cursor of comment"),
+    replies_size: Optional[int] = Query(
+        posts_services.DEFAULT_COMMENT_REPLIES_SIZE, ge=0, le=100, description="Number of inline replies per reply"
+    ),
+    db: AsyncSession = Depends(services.get_read_db)
+):
+    await __validate_post_by_id(db, post_id)
+    # comment must belong to this post, like the other comment apis an unknown comment is a 400
+    if await posts_services.get_comment_post_id(db, comment_id) != post_id:
+        ItemDoesNotExsit(f"Comment with ID {comment_id} was not found!")
+
+    try:
+        items, next_cursor = await posts_services.get_comment_page(db, post_id, comment_id, size, after, replies_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return CommentPage(items=items, next_cursor=next_cursor)
+
+
 @router.patch("/{post_id}/comment/{comment_id}", response_model=Comments)
 async def update_comment(
     post_id: int,
@@ -209,7 +522,7 @@ async def update_comment(
         raise CREDENTIAL_EXCEPTION
 
     # validate post by id
-    await get_post_single(post_id, db)
+    await __validate_post_by_id(db, post_id)
 
     try:
         comment = await posts_services.get_single_comment(comment_id, db)
@@ -241,7 +554,7 @@ async def delete_comment(
         raise CREDENTIAL_EXCEPTION
 
     # validate post by id
-    await get_post_single(post_id, db)
+    await __validate_post_by_id(db, post_id)
 
     try:
         comment = await posts_services.get_single_comment(comment_id, db)
@@ -1,34 +1,94 @@
+import os
+import io
+import csv
+import json
+import time
 from datetime import datetime
 import operator
-from typing import Optional
+from bisect import bisect_right
+from typing import AsyncIterable, AsyncIterator, Dict, FrozenSet, List, Optional, Type
 from enum import Enum
+from functools import lru_cache
+from pydantic import BaseModel, create_model
 from sqlalchemy.engine import create
-from sqlalchemy.sql.expression import delete, select, update
+from sqlalchemy.sql.expression import delete, select, update, insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
-from sqlalchemy import or_, cast, and_
-from sqlalchemy.types import String
-
-from blog_api.models import Post, Link_User_Post, Comments, Base
-from blog_api.schemas import PostCreate
+from sqlalchemy.orm import selectinload, noload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import or_, cast, and_, tuple_, func, literal_column
+from sqlalchemy.types import String, Integer
+from sqlalchemy.exc import NoResultFound
+
+from blog_api.models import Post, User, Link_User_Post, Comments, Base, POST_SEARCH_CONFIG, POST_SEARCH_VECTOR
+from blog_api.schemas import PostCreate, Post as PostSchema, UserBase, CommentThread
+from blog_api import cache, services, http_cache
+from blog_api.pagination import encode_cursor, decode_cursor
+from blog_api.posts import search_index
 
 DEFAULT_PAGING_SIZE = 100
 DEFAULT_PAGING_PAGE_NUMBER = 1
 
+# number of posts per multi row INSERT of bulk_create_posts
+# postgres accept at most 32767 bind parameters per statement, each post use 5 of them
+BULK_INSERT_CHUNK_SIZE = 1000
+MAX_BULK_INSERT_CHUNK_SIZE = 5000
+
+# read through cache of single post, backend can be "memory", "redis" or "none"
+# every function which modify a post, it likes or it comments must call invalidate_post_cache
+POST_CACHE_BACKEND = os.getenv("POST_CACHE_BACKEND", cache.CacheBackendEnum.MEMORY)
+POST_CACHE_TTL = int(os.getenv("POST_CACHE_TTL", 60))
+POST_CACHE_MAX_SIZE = int(os.getenv("POST_CACHE_MAX_SIZE", 10000))
+
+# comments are threads of any depth, those guards bound the size of a comment tree in response
+# MAX_COMMENT_DEPTH is number of levels (top level comment is level 1), deeper replies are refused
+# MAX_COMMENT_TREE_NODES is number of comments loaded per post, shallow comments are kept first
+MAX_COMMENT_DEPTH = int(os.getenv("MAX_COMMENT_DEPTH", 10))
+MAX_COMMENT_TREE_NODES = int(os.getenv("MAX_COMMENT_TREE_NODES", 500))
+
+# paging of comments, number of comments per page and number of inline replies per comment
+DEFAULT_COMMENT_PAGING_SIZE = 20
+DEFAULT_COMMENT_REPLIES_SIZE = 3
+
+post_cache = cache.create_cache("post", POST_CACHE_BACKEND, POST_CACHE_TTL, POST_CACHE_MAX_SIZE)
+
 class OperatorEnum(str, Enum):
     AND = "and"
     OR = "or"
 
 
-async def __validate_like(user_id: int, post_id: int, db: AsyncSession):
-    stmt = (
-        select(Link_User_Post)
-        .where(Link_User_Post.user_id == user_id)
-        .where(Link_User_Post.post_id == post_id)
-    )
-    q = await db.execute(stmt)
-    # with scalar() you return result of None
-    return q.scalar()
+class SearchModeEnum(str, Enum):
+    ILIKE = "ilike"
+    FULLTEXT = "fulltext"
+    INDEX = "index"
+
+
+class ExportFormatEnum(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
+# columns of exported posts, in the same order as csv header
+EXPORT_COLUMNS = ("id", "owner_email", "title", "content", "date_created", "date_last_update", "like_count")
+# number of rows fetched per round trip of server side cursor, every batch is sent as one chunk of response
+EXPORT_BATCH_SIZE = 1000
+
+
+# sparse fieldsets, client can ask for a subset of post fields by "fields=title,like_count"
+# column fields are selected by a column only select(), relationship fields cost one more query each
+POST_COLUMN_FIELDS = ("id", "owner_email", "title", "content", "date_created", "date_last_update", "like_count")
+POST_RELATIONSHIP_FIELDS = ("comments", "like")
+
+
+# in process search index become the default search mode when it is enabled
+DEFAULT_SEARCH_MODE = SearchModeEnum.INDEX if search_index.POST_SEARCH_INDEX_ENABLED else SearchModeEnum.ILIKE
+
+
+# fields which are indexed by posts.search_vector and their weight inside that vector
+# other fields always use ilike search
+FULLTEXT_FIELD_WEIGHTS = {
+    "title": "a",
+    "content": "b",
+}
 
 
 async def searcher(
@@ -36,7 +96,10 @@ async def searcher(
     model: Base,
     search_field: str = None,
     search_value: str = None,
-    operation: OperatorEnum = OperatorEnum.OR
+    operation: OperatorEnum = OperatorEnum.OR,
+    mode: SearchModeEnum = SearchModeEnum.ILIKE,
+    rank: bool = True,
+    dialect: str = "postgresql"
 ):
     filters = []
     filter_list = []
@@ -44,17 +107,24 @@ async def searcher(
     if search_field is None and search_value is None:
         return base_query
 
-    # https://www.kite.com/python/docs/sqlalchemy.cast
-    # attr = CAST(posts.title AS VARCHAR)
-    # we wanna take (posts.title AS VARCHAR) part
-    attr = cast(getattr(model, search_field), String)
-
     # split from 1 long string into smaller string
     # example search value = "ahihi1 + ahihi2" => ["ahihi1", "ahihi2"]
     search_value_split = search_value.split("+")
     for item in search_value_split:
         filter_list.append(item.strip())
 
+    # search_vector only exist on postgres, other database (sqlite of tests) fall back to ilike search
+    if mode == SearchModeEnum.FULLTEXT and model is Post and search_field in FULLTEXT_FIELD_WEIGHTS and dialect == "postgresql":
+        return _fulltext_searcher(base_query, search_field, filter_list, operation, rank)
+
+    # index mode is answered by get_all_posts and export_posts themselves, they only hydrate ids of one page/batch
+    # a query which need every matched id (cursor pagination) use ilike, a common word would match the whole table
+
+    # https://www.kite.com/python/docs/sqlalchemy.cast
+    # attr = CAST(posts.title AS VARCHAR)
+    # we wanna take (posts.title AS VARCHAR) part
+    attr = cast(getattr(model, search_field), String)
+
     for item in filter_list:
         # because attr now equal to "model.search_field", for example "Post.title"
         # so we can use ilike method, which will make our sql statement search for approximate value
@@ -76,6 +146,49 @@ async def searcher(
     return base_query
 
 
+# sorted ids of posts which match search_value, answered by in process search index
+def _search_post_ids(search_field: str, search_value: str, operation: OperatorEnum, limit: Optional[int] = None):
+    filter_list = [item.strip() for item in search_value.split("+")]
+    return search_index.post_search_index.search(search_field, filter_list, operation == OperatorEnum.AND, limit)
+
+
+# full text search version of searcher, it use GIN index of posts.search_vector instead of sequential scan
+# example search_field = "title", search_value = "ahihi1 + ahihi2", operation = "and"
+# => search_vector @@ plainto_tsquery('ahihi1') AND ts_filter(search_vector, '{a}') @@ plainto_tsquery('ahihi1')
+#    AND search_vector @@ plainto_tsquery('ahihi2') AND ts_filter(search_vector, '{a}') @@ plainto_tsquery('ahihi2')
+# the first condition is answered by the index, ts_filter only recheck that matched words come from search_field
+def _fulltext_searcher(base_query: select, search_field: str, filter_list: list, operation: OperatorEnum, rank: bool):
+    config = literal_column(f"'{POST_SEARCH_CONFIG}'::regconfig")
+    field_vector = func.ts_filter(
+        POST_SEARCH_VECTOR, literal_column(f"'{{{FULLTEXT_FIELD_WEIGHTS[search_field]}}}'::\"char\"[]")
+    )
+
+    filters = []
+    queries = []
+    for item in filter_list:
+        query = func.plainto_tsquery(config, item)
+        queries.append(query)
+        filters.append(and_(POST_SEARCH_VECTOR.op("@@")(query), field_vector.op("@@")(query)))
+
+    if operation == OperatorEnum.OR:
+        filter_expression = or_(*filters)
+        tsquery_operator = "||"
+    else:
+        filter_expression = and_(*filters)
+        tsquery_operator = "&&"
+
+    base_query = base_query.filter(filter_expression)
+
+    # most relevant posts come first, cursor pagination has it own order so it turn ranking off
+    if rank:
+        combined_query = queries[0]
+        for query in queries[1:]:
+            combined_query = combined_query.op(tsquery_operator)(query)
+        base_query = base_query.order_by(func.ts_rank(field_vector, combined_query).desc(), Post.id)
+
+    return base_query
+
+
 async def create_post(db: AsyncSession, user_email: str, post: PostCreate):
     db_post = Post(**post.dict(), owner_email=user_email)
     # add that instance object to your database session.
@@ -84,18 +197,154 @@ async def create_post(db: AsyncSession, user_email: str, post: PostCreate):
     await db.commit()
     # refresh your instance (so that it contains any new data from the database, like the generated ID).
     await db.refresh(db_post)
+    search_index.index_post(db_post)
     return db_post
 
 
-async def get_all_posts_from_one_user(db: AsyncSession, user_email: str):
+# insert many posts of one user, posts are sent to database by multi row INSERT of chunk_size rows
+# the whole batch is committed at once, so it is all or nothing
+# return ids of new posts (in the same order as input) and timing of every chunk
+async def bulk_create_posts(
+    db: AsyncSession,
+    user_email: str,
+    posts: AsyncIterable[PostCreate],
+    chunk_size: int = BULK_INSERT_CHUNK_SIZE
+):
+    post_ids = []
+    chunks = []
+    new_posts = []
+    chunk = []
+
+    async def insert_chunk():
+        started_at = time.perf_counter()
+        chunk_ids = await _insert_posts_chunk(db, chunk)
+        post_ids.extend(chunk_ids)
+        chunks.append({"rows": len(chunk), "seconds": round(time.perf_counter() - started_at, 6)})
+        new_posts.extend(zip(chunk_ids, chunk))
+
+    now = datetime.utcnow()
+    async for post in posts:
+        chunk.append({
+            "title": post.title,
+            "content": post.content,
+            "owner_email": user_email,
+            "date_created": now,
+            "date_last_update": now,
+            "date_last_activity": now,
+        })
+        if len(chunk) >= chunk_size:
+            await insert_chunk()
+            chunk = []
+
+    if chunk:
+        await insert_chunk()
+
+    await db.commit()
+
+    for post_id, post in new_posts:
+        search_index.index_post_fields(post_id, post["title"], post["content"])
+
+    return post_ids, chunks
+
+
+async def _insert_posts_chunk(db: AsyncSession, rows: List[dict]):
+    stmt = insert(Post).values(rows)
+
+    if services.dialect_name(db) == "sqlite":
+        # sqlite of SQLAlchemy 1.4 doesn't support RETURNING
+        # rowid of a multi row INSERT are consecutive, so ids are calculated back from the last one
+        result = await db.execute(stmt)
+        last_id = result.lastrowid
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+    result = await db.execute(stmt.returning(Post.id))
+    return result.scalars().all()
+
+
+# "title, content" => frozenset({"title", "content"}), None means every field
+# raise ValueError when a field is unknown or it is not a field of schema
+def parse_post_fields(fields: Optional[str], schema: Type[BaseModel] = PostSchema) -> Optional[FrozenSet[str]]:
+    if fields is None:
+        return None
+
+    parsed = frozenset(field.strip() for field in fields.split(",") if field.strip())
+    if not parsed:
+        raise ValueError("Fields must not be empty!")
+
+    unknown = parsed - set(schema.__fields__)
+    if unknown:
+        raise ValueError(f"Fields {', '.join(sorted(unknown))} are not supported, please choose from {', '.join(schema.__fields__)}!")
+
+    return parsed
+
+
+# response model which only contain requested fields, it is created once per combination of fields
+@lru_cache(maxsize=256)
+def post_fields_model(schema: Type[BaseModel], fields: FrozenSet[str]) -> Type[BaseModel]:
+    definitions = {
+        name: (field.outer_type_, ... if field.required else field.default)
+        for name, field in schema.__fields__.items()
+        if name in fields
+    }
+    return create_model(f"{schema.__name__}Fields", __config__=schema.__config__, **definitions)
+
+
+# select only columns of requested fields, id and date_created are always selected because they are sort keys
+# date_last_activity is always selected because it is the ETag validator of lists
+def _post_fields_select(fields: FrozenSet[str]):
+    columns = ["id", "date_created", "date_last_activity"]
+    columns += [column for column in POST_COLUMN_FIELDS if column in fields and column not in columns]
+    return select(*(getattr(Post, column) for column in columns))
+
+
+# turn rows of _post_fields_select into dicts, then load relationship fields which are requested
+# comments and like of every post on the page are loaded by one query each
+async def load_post_fields(rows, fields: FrozenSet[str], db: AsyncSession) -> List[dict]:
+    records = [dict(row._mapping) for row in rows]
+    if not records:
+        return records
+
+    post_ids = [record["id"] for record in records]
+
+    if "comments" in fields:
+        comments_by_post = await load_comment_tree_dicts(
+            and_(Comments.post.in_(post_ids), Comments.parent_id == None), db
+        )
+        for record in records:
+            record["comments"] = comments_by_post.get(record["id"], [])
+
+    if "like" in fields:
+        stmt = (
+            select(Link_User_Post.post_id, User.email)
+            .join(User, User.id == Link_User_Post.user_id)
+            .where(Link_User_Post.post_id.in_(post_ids))
+            .order_by(Link_User_Post.post_id, User.id)
+        )
+        q = await db.execute(stmt)
+        likes_by_post = {post_id: [] for post_id in post_ids}
+        for post_id, email in q.all():
+            likes_by_post[post_id].append({"email": email})
+        for record in records:
+            record["like"] = likes_by_post[record["id"]]
+
+    return records
+
+
+async def get_all_posts_from_one_user(db: AsyncSession, user_email: str, fields: Optional[FrozenSet[str]] = None):
     # old style of SQLAchemy(<1.4)
     # return db.query(Post).filter(Post.owner_email == user_email).all()
 
+    if fields is not None:
+        stmt = _post_fields_select(fields).filter(Post.owner_email == user_email)
+        records = await db.execute(stmt)
+        return await load_post_fields(records.all(), fields, db)
+
     # new style of SQLAchemy(>=1.4)
-    stmt = select(Post).filter(Post.owner_email == user_email)
+    # selectin load of Post.comments would run one query per level of replies, comment trees are loaded at once instead
+    stmt = select(Post).options(noload(Post.comments)).filter(Post.owner_email == user_email)
     records = await db.execute(stmt)
     records = records.scalars().all()
-    return records
+    return await load_comments_for_posts(records, db)
 
 
 async def get_all_posts(
@@ -104,35 +353,51 @@ async def get_all_posts(
     page: int = DEFAULT_PAGING_PAGE_NUMBER,
     search_field: str = None,
     search_value: str = None,
-    operation: OperatorEnum = OperatorEnum.OR
+    operation: OperatorEnum = OperatorEnum.OR,
+    search_mode: SearchModeEnum = DEFAULT_SEARCH_MODE,
+    fields: Optional[FrozenSet[str]] = None
 ):
     # old style of SQLAchemy(<1.4)
     # return db.query(Post).filter(Post.owner_email == user_email).all()
     # new style of SQLAchemy(>=1.4)
-    stmt = select(Post)
-
-    stmt = await searcher(
-        stmt,
-        Post,
-        search_field,
-        search_value,
-        operation
-    )
+    # comments are loaded by load_comments_for_posts for the whole page, so skip selectin load of Post.comments
+    # list response only contain like_count, so skip selectin load of Post.like
+    if fields is not None:
+        stmt = _post_fields_select(fields)
+    else:
+        stmt = select(Post).options(noload(Post.comments), noload(Post.like))
+
+    if search_mode == SearchModeEnum.INDEX and search_value is not None and search_index.is_available(search_field):
+        # index return sorted post ids, so we can cut the requested page from them
+        # and only hydrate ids of that page, instead of sending every matched id to database
+        offset = size * (page - 1)
+        post_ids = _search_post_ids(search_field, search_value, operation, limit=offset + size)
+        stmt = stmt.filter(Post.id.in_(list(post_ids[offset:offset + size]))).order_by(Post.id)
+    else:
+        stmt = await searcher(
+            stmt,
+            Post,
+            search_field,
+            search_value,
+            operation,
+            search_mode,
+            dialect=services.dialect_name(db)
+        )
 
-    # processing pagination for get all post api
-    if size:
-        stmt = stmt.limit(size)
-    if page:
-        stmt = stmt.offset(size * (page - 1))
+        # processing pagination for get all post api
+        if size:
+            stmt = stmt.limit(size)
+        if page:
+            stmt = stmt.offset(size * (page - 1))
 
     records = await db.execute(stmt)
+    if fields is not None:
+        return await load_post_fields(records.all(), fields, db) or None
+
     records = records.scalars().all()
     if not records:
         return None
-    # Only work around Todo investigate about lazy in model with self reference
-    for record in records:
-        comments_record = await get_all_comment(record.id, db)
-        record.comments = comments_record
+    await load_comments_for_posts(records, db)
 
     '''
     OlD WAY TO processing pagination for get all post api
@@ -156,25 +421,212 @@ async def get_all_posts(
     return records
 
 
-async def get_post_single(db: AsyncSession, post_id: int):
-    stmt = select(Post).filter(Post.id == post_id)
+async def get_all_posts_cursor(
+    db: AsyncSession,
+    size: int = DEFAULT_PAGING_SIZE,
+    after: Optional[str] = None,
+    search_field: str = None,
+    search_value: str = None,
+    operation: OperatorEnum = OperatorEnum.OR,
+    search_mode: SearchModeEnum = DEFAULT_SEARCH_MODE,
+    fields: Optional[FrozenSet[str]] = None
+):
+    # keyset pagination, instead of skip N rows by OFFSET, we continue from the last row of previous page
+    # with the index on (date_created, id) database jump directly to that row, so page 10000 cost the same as page 1
+    # id is added into sort key because date_created is not unique, it make the order stable
+    if fields is not None:
+        stmt = _post_fields_select(fields)
+    else:
+        stmt = select(Post).options(noload(Post.comments), noload(Post.like))
+    stmt = stmt.order_by(Post.date_created, Post.id)
+
+    stmt = await searcher(
+        stmt,
+        Post,
+        search_field,
+        search_value,
+        operation,
+        search_mode,
+        rank=False,
+        dialect=services.dialect_name(db)
+    )
+
+    if after:
+        last_date_created, last_id = decode_cursor(after, datetime, int)
+        stmt = stmt.filter(tuple_(Post.date_created, Post.id) > tuple_(last_date_created, last_id))
+
+    # fetch one more record to know whether next page is exist or not
+    stmt = stmt.limit(size + 1)
+
+    records = await db.execute(stmt)
+    # rows of column only select have the same attributes as Post for id and date_created
+    records = records.all() if fields is not None else records.scalars().all()
+
+    next_cursor = None
+    if len(records) > size:
+        records = records[:size]
+        next_cursor = encode_cursor(records[-1].date_created, records[-1].id)
+
+    if fields is not None:
+        return await load_post_fields(records, fields, db), next_cursor
+
+    await load_comments_for_posts(records, db)
+
+    return records, next_cursor
+
+
+# stream every post (optionally filtered by searcher) ordered by id, in batches of EXPORT_BATCH_SIZE rows
+# rows are read by a server side cursor, so memory doesn't grow with the size of posts table
+# after_id resume an interrupted export from the last id which was received
+async def export_posts(
+    db: AsyncSession,
+    search_field: str = None,
+    search_value: str = None,
+    operation: OperatorEnum = OperatorEnum.OR,
+    search_mode: SearchModeEnum = DEFAULT_SEARCH_MODE,
+    after_id: Optional[int] = None
+) -> AsyncIterator[List[dict]]:
+    stmt = select(*(getattr(Post, column) for column in EXPORT_COLUMNS))
+
+    # index return sorted ids, they are hydrated by batches of EXPORT_BATCH_SIZE ids after after_id
+    if search_mode == SearchModeEnum.INDEX and search_value is not None and search_index.is_available(search_field):
+        post_ids = _search_post_ids(search_field, search_value, operation)
+        start = bisect_right(post_ids, after_id) if after_id is not None else 0
+        for offset in range(start, len(post_ids), EXPORT_BATCH_SIZE):
+            batch_ids = list(post_ids[offset:offset + EXPORT_BATCH_SIZE])
+            q = await db.execute(stmt.where(Post.id.in_(batch_ids)).order_by(Post.id))
+            rows = q.mappings().all()
+            if rows:
+                yield rows
+        return
+
+    # export is ordered by id, so full text rank is not needed
+    stmt = await searcher(
+        stmt, Post, search_field, search_value, operation, search_mode, rank=False, dialect=services.dialect_name(db)
+    )
+    if after_id is not None:
+        stmt = stmt.where(Post.id > after_id)
+    stmt = stmt.order_by(Post.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+    result = await db.stream(stmt)
+    async for rows in result.mappings().partitions(EXPORT_BATCH_SIZE):
+        yield rows
+
+
+async def export_posts_ndjson(rows: AsyncIterator[List[dict]]) -> AsyncIterator[str]:
+    async for batch in rows:
+        yield "".join(
+            json.dumps({column: _export_value(row[column]) for column in EXPORT_COLUMNS}) + "\n" for row in batch
+        )
+
+
+async def export_posts_csv(rows: AsyncIterator[List[dict]]) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+
+    async for batch in rows:
+        writer.writerows([_export_value(row[column]) for column in EXPORT_COLUMNS] for row in batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    # header of an empty export
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+async def get_post_single(db: AsyncSession, post_id: int, fields: Optional[FrozenSet[str]] = None):
+    if fields is not None:
+        q = await db.execute(_post_fields_select(fields).filter(Post.id == post_id))
+        records = await load_post_fields(q.all(), fields, db)
+        return records[0] if records else None
+
+    stmt = select(Post).filter(Post.id == post_id).options(noload(Post.comments))
     q = await db.execute(stmt)
     record: Post = q.scalar()
 
     if not record:
         return None
 
-    # Only work around Todo investigate about lazy in model with self reference
-    comments_record = await get_all_comment(post_id, db)
-    record.comments = comments_record
+    await load_comments_for_posts([record], db)
 
     return record
 
 
+# same as get_post_single but the serialized post is cached, return schemas.Post instead of Post model
+# the cached value is "<date_last_activity>|<post json>", one key per post so invalidate_post_cache remove it.
+# version is date_last_activity of the post when caller already know it, a cached copy of another version
+# (for example read from a lagging replica) is a miss and it is replaced
+async def get_post_single_cached(db: AsyncSession, post_id: int, version: Optional[datetime] = None):
+    key = str(post_id)
+    value = await post_cache.get(key)
+    if value is not None:
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        cached_version, payload = value.split("|", 1)
+        if version is None or cached_version == version.isoformat():
+            return PostSchema.parse_raw(payload)
+
+    record = await get_post_single(db, post_id)
+    if not record:
+        return None
+
+    post = PostSchema.from_orm(record)
+    await post_cache.set(key, f"{record.date_last_activity.isoformat()}|{post.json()}")
+
+    return post
+
+
+# bump posts.date_last_activity, it change ETag and Last-Modified of the post
+# call it inside the transaction of every write to the post, its likes or its comments
+async def touch_post(db: AsyncSession, post_id: int):
+    stmt = (
+        update(Post)
+        .where(Post.id == post_id)
+        .values(date_last_activity=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    await db.execute(stmt)
+
+
+# validator of conditional GET, a single row and single column query, return None when post doesn't exist
+async def get_post_last_activity(db: AsyncSession, post_id: int) -> Optional[datetime]:
+    q = await db.execute(select(Post.date_last_activity).where(Post.id == post_id))
+    return q.scalar()
+
+
+# id and owner of a post, or None when post doesn't exist, write endpoints check the post by it
+async def get_post_owner(db: AsyncSession, post_id: int):
+    q = await db.execute(select(Post.id, Post.owner_email).where(Post.id == post_id))
+    return q.first()
+
+
+# weak ETag of a list of posts, it change whenever a post of the list change or the list itself change
+# records are Post models or dicts of sparse fieldsets, both carry id and date_last_activity
+def posts_etag(records, *parts) -> str:
+    keys = [
+        (record["id"], record["date_last_activity"]) if isinstance(record, dict) else (record.id, record.date_last_activity)
+        for record in records or []
+    ]
+    return http_cache.make_etag(keys, *parts, weak=True)
+
+
+async def invalidate_post_cache(post_id: int):
+    await post_cache.delete(str(post_id))
+
+
 async def update_post(post_id: int, post_data: PostCreate, db: AsyncSession):
     if not (patch_data := post_data.dict(exclude_unset=True)):
         raise ValueError("No changes submitted.")
-    post_record: Post = await db.get(Post, post_id)
+    # selectin load of Post.comments stop after the first level of replies, comment trees are loaded after commit
+    post_record: Post = await db.get(Post, post_id, options=[noload(Post.comments)])
 
     if post_data.title:
         post_record.title = post_data.title
@@ -182,18 +634,25 @@ async def update_post(post_id: int, post_data: PostCreate, db: AsyncSession):
     if post_data.content:
         post_record.content = post_data.content
 
-    post_record.date_last_update = datetime.now()
+    # every date column is UTC, like date_last_activity which is the source of Last-Modified
+    now = datetime.utcnow()
+    post_record.date_last_update = now
+    post_record.date_last_activity = now
 
     await db.commit()
+    await invalidate_post_cache(post_id)
+    search_index.index_post(post_record)
 
+    await load_comments_for_posts([post_record], db)
     return post_record
 
 
-async def delete_post(user_id: int, post_id: int, db: AsyncSession):
+# link_user_post has no ON DELETE CASCADE, every like of the post is removed in the same transaction
+async def delete_post(post_id: int, db: AsyncSession):
     stmt = (
         delete(Link_User_Post)
         .where(Link_User_Post.post_id == post_id)
-        .where(Link_User_Post.user_id == user_id)
+        .execution_options(synchronize_session=False)
     )
     await db.execute(stmt)
 
@@ -203,30 +662,105 @@ async def delete_post(user_id: int, post_id: int, db: AsyncSession):
     )
     await db.execute(stmt)
     await db.commit()
+    await invalidate_post_cache(post_id)
+    search_index.unindex_post(post_id)
 
     return True
 
 
+# like/unlike in one transaction, without reading link_user_post first
+# DELETE tell us by it rowcount whether user already liked this post, in that case it is an unlike
+# otherwise INSERT ... ON CONFLICT DO NOTHING, so two concurrent clicks never create duplicated like
+# posts.like_count is changed by the number of rows which were really deleted/inserted
 async def create_post_like(user_id: int, post_id: int, db: AsyncSession):
-    like_check = await __validate_like(user_id, post_id, db)
-    if like_check:
+    stmt = (
+        delete(Link_User_Post)
+        .where(Link_User_Post.user_id == user_id)
+        .where(Link_User_Post.post_id == post_id)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+
+    if result.rowcount:
+        liked = False
+        like_delta = -result.rowcount
+    else:
+        stmt = (
+            services.dialect_insert(db)(Link_User_Post)
+            .values(user_id=user_id, post_id=post_id)
+            .on_conflict_do_nothing()
+        )
+        result = await db.execute(stmt)
+        liked = True
+        like_delta = result.rowcount
+
+    if like_delta:
         stmt = (
-            delete(Link_User_Post)
-            .where(Link_User_Post.user_id == user_id)
-            .where(Link_User_Post.post_id == post_id)
+            update(Post)
+            .where(Post.id == post_id)
+            .values(like_count=Post.like_count + like_delta, date_last_activity=datetime.utcnow())
+            .execution_options(synchronize_session=False)
         )
         await db.execute(stmt)
-        await db.commit()
-        return False
 
-    like = Link_User_Post(user_id = user_id, post_id = post_id)
-    db.add(like)
     await db.commit()
+    await invalidate_post_cache(post_id)
+
+    return liked
 
-    return True
+
+# users who liked a post, keyset pagination by user id
+async def get_post_likes(
+    post_id: int,
+    db: AsyncSession,
+    size: int = DEFAULT_PAGING_SIZE,
+    after: Optional[str] = None
+):
+    stmt = (
+        select(User.id, User.email)
+        .join(Link_User_Post, Link_User_Post.user_id == User.id)
+        .where(Link_User_Post.post_id == post_id)
+        .order_by(User.id)
+    )
+
+    if after:
+        last_user_id, = decode_cursor(after, int)
+        stmt = stmt.where(User.id > last_user_id)
+
+    # fetch one more record to know whether next page is exist or not
+    q = await db.execute(stmt.limit(size + 1))
+    records = q.all()
+
+    next_cursor = None
+    if len(records) > size:
+        records = records[:size]
+        next_cursor = encode_cursor(records[-1].id)
+
+    return [UserBase(email=record.email) for record in records], next_cursor
 
 
 async def create_post_comment(user_email: str, post_id: int, body: str, parent_id: Optional[int], db: AsyncSession):
+    if parent_id is not None:
+        # walk up from parent comment to top level comment, to know the level of new comment
+        ancestors = (
+            select(Comments.id, Comments.parent_id, Comments.post, literal_column("1", Integer).label("level"))
+            .where(Comments.id == parent_id)
+            .cte("comment_ancestors", recursive=True)
+        )
+        ancestors = ancestors.union_all(
+            select(Comments.id, Comments.parent_id, Comments.post, (ancestors.c.level + 1).label("level"))
+            .join(ancestors, Comments.id == ancestors.c.parent_id)
+            .where(ancestors.c.level < MAX_COMMENT_DEPTH)
+        )
+        q = await db.execute(select(ancestors.c.post, ancestors.c.level).order_by(ancestors.c.level))
+        rows = q.all()
+        if not rows:
+            raise NoResultFound(f"Comment with ID {parent_id} was not found!")
+
+        # reply must belong to the same post as its parent and stay inside the depth limit
+        if rows[0].post != post_id or len(rows) >= MAX_COMMENT_DEPTH:
+            return False
+
     new_comment = Comments(
         name = user_email,
         post = post_id,
@@ -234,61 +768,253 @@ async def create_post_comment(user_email: str, post_id: int, body: str, parent_i
         parent_id = parent_id
     )
 
-    if parent_id:
-        parent_comment: Comments = await get_single_comment(parent_id, db)
-        if parent_comment.parent_id:
-            return False
-
-        parent_comment.children.append(new_comment)
-
-        await db.commit()
-        return True
-    
     db.add(new_comment)
+    await touch_post(db, post_id)
     await db.commit()
+    await invalidate_post_cache(post_id)
     # await db.refresh(new_comment)
 
     return new_comment
 
 
+# id of the post of a comment, or None when comment doesn't exist
+async def get_comment_post_id(db: AsyncSession, comment_id: int) -> Optional[int]:
+    q = await db.execute(select(Comments.post).where(Comments.id == comment_id))
+    return q.scalar()
+
+
 async def get_all_comment(post_id: int, db: AsyncSession):
     # Comments.parent_id == None because we just wanna get parent contain children, not parent and children at the same level
-    stmt = select(Comments).filter(Comments.post == post_id, Comments.parent_id == None).options(selectinload(Comments.children))
+    return await load_comment_trees(and_(Comments.post == post_id, Comments.parent_id == None), db)
+
+
+# page of comments of a post ordered by (date_created, id), parent_id None means top level comments
+# every comment on the page come with its first replies_size replies, ordered the same way
+# it cost 3 queries regardless of page size: comments, their first replies, number of replies of those replies
+# all of them are served by index (post, parent_id, date_created, id)
+async def get_comment_page(
+    db: AsyncSession,
+    post_id: int,
+    parent_id: Optional[int] = None,
+    size: int = DEFAULT_COMMENT_PAGING_SIZE,
+    after: Optional[str] = None,
+    replies_size: int = DEFAULT_COMMENT_REPLIES_SIZE
+):
+    stmt = (
+        select(Comments.id, Comments.name, Comments.body, Comments.date_created)
+        .where(Comments.post == post_id, Comments.parent_id == parent_id)
+        .order_by(Comments.date_created, Comments.id)
+    )
+    if after:
+        # raise ValueError when cursor is invalid
+        last_date_created, last_id = decode_cursor(after, datetime, int)
+        stmt = stmt.where(tuple_(Comments.date_created, Comments.id) > tuple_(last_date_created, last_id))
+
+    # fetch one more record to know whether next page is exist or not
+    q = await db.execute(stmt.limit(size + 1))
+    records = q.all()
+
+    next_cursor = None
+    if len(records) > size:
+        records = records[:size]
+        next_cursor = encode_cursor(records[-1].date_created, records[-1].id)
+
+    items = [CommentThread(id=record.id, name=record.name, body=record.body, date_created=record.date_created) for record in records]
+    await _load_comment_replies(db, post_id, items, replies_size)
+
+    return items, next_cursor
+
+
+# attach first replies_size replies to every comment, number of replies is counted by a window function on the same scan
+async def _load_comment_replies(db: AsyncSession, post_id: int, items: List[CommentThread], replies_size: int):
+    if not items:
+        return items
+
+    items_by_id = {item.id: item for item in items}
+    ranked = (
+        select(
+            Comments.id,
+            Comments.name,
+            Comments.body,
+            Comments.date_created,
+            Comments.parent_id,
+            func.row_number().over(
+                partition_by=Comments.parent_id, order_by=(Comments.date_created, Comments.id)
+            ).label("position"),
+            func.count().over(partition_by=Comments.parent_id).label("total"),
+        )
+        .where(Comments.post == post_id, Comments.parent_id.in_(list(items_by_id)))
+        .subquery()
+    )
+    stmt = (
+        select(ranked)
+        .where(ranked.c.position <= max(replies_size, 1))
+        .order_by(ranked.c.parent_id, ranked.c.position)
+    )
     q = await db.execute(stmt)
-    record = q.scalars().all()
 
-    return record
+    replies = []
+    for record in q.all():
+        item = items_by_id[record.parent_id]
+        item.replies_count = record.total
+        if record.position > replies_size:
+            # row is only fetched to know number of replies
+            continue
+        reply = CommentThread(id=record.id, name=record.name, body=record.body, date_created=record.date_created)
+        item.children.append(reply)
+        replies.append(reply)
+
+    for item in items:
+        if item.children and item.replies_count > len(item.children):
+            item.replies_cursor = encode_cursor(item.children[-1].date_created, item.children[-1].id)
+
+    # inline replies don't contain their own replies, only their number
+    if replies:
+        stmt = (
+            select(Comments.parent_id, func.count())
+            .where(Comments.post == post_id, Comments.parent_id.in_([reply.id for reply in replies]))
+            .group_by(Comments.parent_id)
+        )
+        q = await db.execute(stmt)
+        replies_by_id = {reply.id: reply for reply in replies}
+        for reply_parent_id, replies_count in q.all():
+            replies_by_id[reply_parent_id].replies_count = replies_count
 
+    return items
 
-async def get_single_comment(comment_id: int, db: AsyncSession):
-    stmt = select(Comments).filter(Comments.id == comment_id).options(selectinload(Comments.children))
+
+# load comment trees whose top comments match roots_filter, by one recursive query
+# the whole tree is fetched level by level (depth, id) then children are attached in python in O(n)
+# children are set by set_committed_value, so Comments.children is never lazy loaded while response is serialized
+async def load_comment_trees(roots_filter, db: AsyncSession) -> List[Comments]:
+    ranked = _comment_tree_ranked(roots_filter)
+    stmt = (
+        select(Comments)
+        .join(ranked, Comments.id == ranked.c.id)
+        .where(ranked.c.position <= MAX_COMMENT_TREE_NODES)
+        .options(noload(Comments.children))
+        .order_by(ranked.c.depth, Comments.id)
+    )
     q = await db.execute(stmt)
-    record = q.scalar_one()
 
-    return record
+    comments = q.scalars().all()
+
+    roots = []
+    children = {}
+    for comment in comments:
+        # parents always come before their children, because rows are sorted by depth
+        if comment.parent_id in children:
+            children[comment.parent_id].append(comment)
+        else:
+            roots.append(comment)
+        children[comment.id] = []
+
+    for comment in comments:
+        set_committed_value(comment, "children", children[comment.id])
+
+    return roots
+
+
+# same as load_comment_trees but comments are plain dicts built from rows, no ORM object is created
+# keys are in the same order as schemas.Comments, so the dicts can be encoded directly
+# return top level comments grouped by post id
+async def load_comment_tree_dicts(roots_filter, db: AsyncSession) -> Dict[int, List[dict]]:
+    ranked = _comment_tree_ranked(roots_filter)
+    stmt = (
+        select(Comments.id, Comments.name, Comments.body, Comments.date_created, Comments.parent_id, Comments.post)
+        .join(ranked, Comments.id == ranked.c.id)
+        .where(ranked.c.position <= MAX_COMMENT_TREE_NODES)
+        .order_by(ranked.c.depth, Comments.id)
+    )
+    q = await db.execute(stmt)
+
+    roots_by_post = {}
+    children = {}
+    for comment_id, name, body, date_created, parent_id, post_id in q.all():
+        comment = {"id": comment_id, "name": name, "body": body, "date_created": date_created, "children": []}
+        if parent_id in children:
+            children[parent_id].append(comment)
+        else:
+            roots_by_post.setdefault(post_id, []).append(comment)
+        children[comment_id] = comment["children"]
+
+    return roots_by_post
+
+
+# comment trees are fetched level by level (depth, id) by a recursive CTE
+# comments of each post are numbered level by level, so a truncated tree never lose the parent of a kept comment
+def _comment_tree_ranked(roots_filter):
+    tree = (
+        select(Comments.id, Comments.post, literal_column("0", Integer).label("depth"))
+        .where(roots_filter)
+        .cte("comment_tree", recursive=True)
+    )
+    tree = tree.union_all(
+        select(Comments.id, Comments.post, (tree.c.depth + 1).label("depth"))
+        .join(tree, Comments.parent_id == tree.c.id)
+        .where(tree.c.depth < MAX_COMMENT_DEPTH - 1)
+    )
+    return select(
+        tree.c.id,
+        tree.c.depth,
+        func.row_number().over(partition_by=tree.c.post, order_by=(tree.c.depth, tree.c.id)).label("position"),
+    ).subquery()
+
+
+# load comment tree of many posts at once, instead of calling get_all_comment for each post (N+1 queries)
+# it cost 1 recursive query regardless number of posts and depth of threads
+# then attach comments into each post, set_committed_value don't mark post as modified so nothing is flushed later
+async def load_comments_for_posts(records: List[Post], db: AsyncSession):
+    if not records:
+        return records
+
+    post_ids = [record.id for record in records]
+    roots = await load_comment_trees(and_(Comments.post.in_(post_ids), Comments.parent_id == None), db)
+
+    comments_by_post = {post_id: [] for post_id in post_ids}
+    for comment in roots:
+        comments_by_post[comment.post].append(comment)
+
+    for record in records:
+        set_committed_value(record, "comments", comments_by_post[record.id])
+
+    return records
+
+
+# return comment with its whole thread of replies
+async def get_single_comment(comment_id: int, db: AsyncSession):
+    roots = await load_comment_trees(Comments.id == comment_id, db)
+    if not roots:
+        raise NoResultFound(f"Comment with ID {comment_id} was not found!")
+
+    return roots[0]
 
 
 async def update_comment(comment_id: int, commnent_body: str, db: AsyncSession):
-    record: Comments = await db.get(Comments, comment_id)
+    record: Comments = await db.get(Comments, comment_id, options=[noload(Comments.children)])
 
     record.body = commnent_body
+    await touch_post(db, record.post)
 
     await db.commit()
+    await invalidate_post_cache(record.post)
 
-    return record
+    return await get_single_comment(comment_id, db)
 
 
+# delete comment and every reply under it by one statement
 async def delete_comment(comment_id: int, db: AsyncSession):
-    comments = await get_single_comment(comment_id, db)
-    comment_childrens = comments.children
-    for comment in comment_childrens:
-        stmt = delete(Comments).filter(Comments.id == comment.id)
-        await db.execute(stmt)
+    q = await db.execute(select(Comments.post).filter(Comments.id == comment_id))
+    post_id = q.scalar_one()
 
-    stmt = delete(Comments).filter(Comments.id == comment_id)
+    subtree = select(Comments.id).where(Comments.id == comment_id).cte("comment_subtree", recursive=True)
+    subtree = subtree.union_all(select(Comments.id).join(subtree, Comments.parent_id == subtree.c.id))
+    stmt = delete(Comments).where(Comments.id.in_(select(subtree.c.id))).execution_options(synchronize_session=False)
 
     await db.execute(stmt)
+    await touch_post(db, post_id)
     await db.commit()
+    await invalidate_post_cache(post_id)
 
     return True
 
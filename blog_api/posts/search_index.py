@@ -0,0 +1,195 @@
+import os
+import re
+import heapq
+import logging
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql.expression import select
+
+from blog_api.models import Post
+
+logger = logging.getLogger(__name__)
+
+# in process search engine for posts, it's an alternative of ilike/full text search when database is the bottleneck
+# enable it by environment variable POST_SEARCH_INDEX_ENABLED=1, index is built at startup (see main.py)
+# Note: every uvicorn worker has it own index, it's only kept up to date by writes which go through the same worker
+POST_SEARCH_INDEX_ENABLED = os.getenv("POST_SEARCH_INDEX_ENABLED", "0") == "1"
+# number of rows fetched per round trip while scanning posts table at startup
+BUILD_BATCH_SIZE = 10000
+
+INDEXED_FIELDS = ("title", "content")
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+EMPTY_POSTING = array("i")
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    if not text:
+        return []
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+# intersection of sorted posting lists, start from the shortest one
+# for each candidate we bisect into the other lists, so cost is O(len(shortest) * log(len(other)))
+# with limit we stop as soon as enough ids were matched, it's enough to answer the first pages
+def _intersect(posting_lists: List[Sequence[int]], limit: Optional[int] = None) -> Sequence[int]:
+    posting_lists = sorted(posting_lists, key=len)
+    shortest, others = posting_lists[0], posting_lists[1:]
+
+    if not others:
+        return shortest[:limit]
+
+    result = []
+    lows = [0] * len(others)
+    for post_id in shortest:
+        matched = True
+        for position, posting in enumerate(others):
+            low = bisect_left(posting, post_id, lows[position])
+            lows[position] = low
+            if low == len(posting) or posting[low] != post_id:
+                matched = False
+                break
+        if matched:
+            result.append(post_id)
+            if limit is not None and len(result) >= limit:
+                break
+
+    return result
+
+
+# union of sorted posting lists, k-way merge then drop duplicated ids
+def _union(posting_lists: List[Sequence[int]], limit: Optional[int] = None) -> Sequence[int]:
+    if len(posting_lists) == 1:
+        return _intersect(posting_lists, limit)
+
+    result = []
+    for post_id in heapq.merge(*posting_lists):
+        if not result or result[-1] != post_id:
+            result.append(post_id)
+            if limit is not None and len(result) >= limit:
+                break
+    return result
+
+
+# inverted index over post title and content
+# every token maps to a posting list, which is an array of post ids kept in ascending order
+# array("i") cost 4 bytes per id, much smaller than a set of python int
+# ids are only appended in the common case (new post has the biggest id), updates and deletes bisect into the list
+class PostSearchIndex:
+    def __init__(self):
+        # {"title": {"ahihi": array("i", [1, 5, 9])}, "content": {...}}
+        self.postings: Dict[str, Dict[str, array]] = {field: {} for field in INDEXED_FIELDS}
+        # tokens of every indexed post, we need them to find posting lists when post is updated or deleted
+        self.documents: Dict[int, Tuple[Tuple[str, ...], ...]] = {}
+        self.ready = False
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, post_id: int, title: Optional[str], content: Optional[str]):
+        if post_id in self.documents:
+            self.remove(post_id)
+
+        document = []
+        for field, text in zip(INDEXED_FIELDS, (title, content)):
+            tokens = tuple(sorted(set(tokenize(text))))
+            field_postings = self.postings[field]
+            for token in tokens:
+                posting = field_postings.get(token)
+                if posting is None:
+                    field_postings[token] = array("i", (post_id,))
+                elif posting[-1] < post_id:
+                    posting.append(post_id)
+                else:
+                    posting.insert(bisect_left(posting, post_id), post_id)
+            document.append(tokens)
+
+        self.documents[post_id] = tuple(document)
+
+    def update(self, post_id: int, title: Optional[str], content: Optional[str]):
+        self.add(post_id, title, content)
+
+    def remove(self, post_id: int):
+        document = self.documents.pop(post_id, None)
+        if document is None:
+            return
+
+        for field, tokens in zip(INDEXED_FIELDS, document):
+            field_postings = self.postings[field]
+            for token in tokens:
+                posting = field_postings[token]
+                del posting[bisect_left(posting, post_id)]
+                if not posting:
+                    del field_postings[token]
+
+    def clear(self):
+        self.postings = {field: {} for field in INDEXED_FIELDS}
+        self.documents = {}
+        self.ready = False
+
+    # same input as posts_services.searcher: terms were split by "+" and are combined by AND/OR
+    # a term with many words (for example "hello world") match posts which contain all of those words
+    # Note: unlike ilike, a word must match a whole token, "ahihi" doesn't match "ahihi1"
+    # limit only keep the smallest matched ids, it is used when caller only need the first pages
+    def search(self, field: str, terms: List[str], use_and: bool, limit: Optional[int] = None) -> Sequence[int]:
+        field_postings = self.postings[field]
+        term_postings = []
+
+        for term in terms:
+            tokens = tokenize(term)
+            if not tokens:
+                continue
+            posting_lists = [field_postings.get(token, EMPTY_POSTING) for token in set(tokens)]
+            term_postings.append(posting_lists)
+
+        if not term_postings:
+            return []
+        # AND of terms is AND of all their words
+        if use_and:
+            return _intersect([posting for posting_lists in term_postings for posting in posting_lists], limit)
+        return _union([_intersect(posting_lists, limit) for posting_lists in term_postings], limit)
+
+
+post_search_index = PostSearchIndex()
+
+
+# only a search of one of INDEXED_FIELDS can be answered by the index
+def is_available(field: Optional[str]) -> bool:
+    if not (POST_SEARCH_INDEX_ENABLED and post_search_index.ready):
+        return False
+    return field in INDEXED_FIELDS
+
+
+# scan posts table by server side cursor, only id, title, content are fetched
+async def build_post_search_index(db: AsyncSession, index: PostSearchIndex = post_search_index):
+    index.clear()
+
+    stmt = select(Post.id, Post.title, Post.content).order_by(Post.id).execution_options(yield_per=BUILD_BATCH_SIZE)
+    result = await db.stream(stmt)
+    async for rows in result.partitions(BUILD_BATCH_SIZE):
+        for post_id, title, content in rows:
+            index.add(post_id, title, content)
+
+    index.ready = True
+    logger.info("Post search index was built with %s posts", len(index))
+
+    return index
+
+
+# hooks for posts_services, they do nothing when index is disabled
+def index_post(post: Post):
+    index_post_fields(post.id, post.title, post.content)
+
+
+def index_post_fields(post_id: int, title: Optional[str], content: Optional[str]):
+    if POST_SEARCH_INDEX_ENABLED:
+        post_search_index.add(post_id, title, content)
+
+
+def unindex_post(post_id: int):
+    if POST_SEARCH_INDEX_ENABLED:
+        post_search_index.remove(post_id)
@@ -0,0 +1,108 @@
+import os
+import re
+import logging
+import contextvars
+from contextlib import contextmanager
+from collections import Counter
+from typing import List, Optional, Tuple, Union
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+# record SQL statements executed while a QueryCounter is active, tests use it to assert query budgets
+# in dev mode (N_PLUS_ONE_DETECTION=1) every request is counted and a statement shape which is repeated
+# at least N_PLUS_ONE_THRESHOLD times in one request is logged as a N+1 query
+N_PLUS_ONE_DETECTION = os.getenv("N_PLUS_ONE_DETECTION", "0") == "1"
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", 3))
+
+# bind parameters of postgres ($1, asyncpg may add a cast like $1::INTEGER), sqlite (?) and pyformat (%(name)s),
+# and number literals
+PARAMETER_PATTERN = re.compile(r"\$\d+(?:::\w+)?|\?|%\(\w+\)s|\b\d+\b")
+# expanded IN lists, "IN (?, ?, ?)" and "IN (?)" have the same shape
+PARAMETER_LIST_PATTERN = re.compile(r"\?(?:\s*,\s*\?)+")
+SPACE_PATTERN = re.compile(r"\s+")
+
+
+# shape of a statement: same statement with other parameters or longer IN list has the same shape
+def statement_shape(statement: str) -> str:
+    shape = PARAMETER_PATTERN.sub("?", statement)
+    shape = PARAMETER_LIST_PATTERN.sub("?", shape)
+    return SPACE_PATTERN.sub(" ", shape).strip()
+
+
+class QueryCounter:
+    def __init__(self, parent: Optional["QueryCounter"] = None):
+        # counters can be nested, for example a test counter around a request counter, statements go to all of them
+        self.parent = parent
+        self.statements: List[str] = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def record(self, statement: str):
+        counter = self
+        while counter is not None:
+            counter.statements.append(statement)
+            counter = counter.parent
+
+    # shapes executed at least threshold times, most repeated first
+    def repeated(self, threshold: int = N_PLUS_ONE_THRESHOLD) -> List[Tuple[str, int]]:
+        shapes = Counter(statement_shape(statement) for statement in self.statements)
+        return [(shape, count) for shape, count in shapes.most_common() if count >= threshold]
+
+
+_query_counter: contextvars.ContextVar[Optional[QueryCounter]] = contextvars.ContextVar("query_counter", default=None)
+
+
+def current_query_counter() -> Optional[QueryCounter]:
+    return _query_counter.get()
+
+
+# with count_queries() as counter:
+#     await posts_services.get_all_posts(db, ...)
+# assert len(counter) <= 4
+@contextmanager
+def count_queries():
+    counter = QueryCounter(_query_counter.get())
+    token = _query_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _query_counter.reset(token)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter.record(statement)
+
+
+# engine is an AsyncEngine or sync Engine, main.py instrument databases.async_engine and tests their own engine
+def instrument_engine(engine: Union[AsyncEngine, Engine]):
+    sync_engine = getattr(engine, "sync_engine", engine)
+    if not event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+
+
+# dev mode middleware, it log repeated statement shapes of every request
+class QueryCounterMiddleware:
+    def __init__(self, app, threshold: int = N_PLUS_ONE_THRESHOLD):
+        self.app = app
+        self.threshold = threshold
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with count_queries() as counter:
+            await self.app(scope, receive, send)
+
+        for shape, count in counter.repeated(self.threshold):
+            logger.warning(
+                "Possible N+1 query: %s %s executed %s times the statement: %s",
+                scope["method"], scope["path"], count, shape
+            )
@@ -0,0 +1,56 @@
+import os
+from typing import Optional
+
+import aioredis
+from aioredis.client import Pipeline
+
+from blog_api import metrics
+
+# redis instance which is run by docker compose, in order to work without docker, use redis://localhost:6380/0
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+
+_redis_client: Optional[aioredis.Redis] = None
+
+
+# clients which report latency of every command and pipeline to metrics
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        with metrics.RedisTimer("pipeline"):
+            return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(aioredis.Redis):
+    async def execute_command(self, *args, **options):
+        with metrics.RedisTimer(str(args[0])):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str = None) -> Pipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+# every caller share one asyncio client and it connection pool
+# pool is created at first call and connections are opened on demand, so importing this module never touch redis
+def get_redis() -> aioredis.Redis:
+    global _redis_client
+    if _redis_client is None:
+        pool = aioredis.ConnectionPool.from_url(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS)
+        client_class = InstrumentedRedis if metrics.METRICS_ENABLED else aioredis.Redis
+        _redis_client = client_class(connection_pool=pool)
+    return _redis_client
+
+
+# replace the shared client, tests use it to install a fake redis
+def set_redis(client) -> None:
+    global _redis_client
+    _redis_client = client
+
+
+async def close_redis() -> None:
+    global _redis_client
+    if _redis_client is not None:
+        await _redis_client.close()
+        connection_pool = getattr(_redis_client, "connection_pool", None)
+        if connection_pool is not None:
+            await connection_pool.disconnect()
+        _redis_client = None
@@ -0,0 +1,182 @@
+import os
+import asyncio
+import hashlib
+import logging
+import contextvars
+from typing import List, Optional
+
+from fastapi import Request
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from blog_api import databases
+from blog_api.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# read only endpoints use get_read_db, which pick a healthy replica by round robin (see services.get_read_db)
+# when there is no replica or none of them is healthy, reads go to primary
+REPLICA_HEALTH_CHECK_INTERVAL = float(os.getenv("REPLICA_HEALTH_CHECK_INTERVAL", 5))
+REPLICA_HEALTH_CHECK_TIMEOUT = float(os.getenv("REPLICA_HEALTH_CHECK_TIMEOUT", 2))
+# read your writes: after a client committed a write, its reads go to primary during this window
+# it should be longer than the usual replication lag. The marker is a redis key with this ttl, so it is seen
+# by every worker and instance, not only by the one which handled the write
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", 5))
+REPLICA_STICKY_KEY_PREFIX = "replica_sticky:"
+
+
+class ReplicaRouter:
+    def __init__(self, primary: AsyncEngine, replicas: List[AsyncEngine], sticky_seconds: float):
+        self.primary = primary
+        self.replicas = replicas
+        self.sticky_seconds = sticky_seconds
+        # replicas are healthy until a check or a dropped connection says otherwise
+        self.healthy = {engine: True for engine in replicas}
+        self._next = 0
+        self._health_check_task: Optional[asyncio.Task] = None
+
+        for engine in replicas:
+            event.listen(engine.sync_engine, "handle_error", self._on_engine_error)
+
+    # round robin over healthy replicas, primary when there is none
+    def choose(self) -> AsyncEngine:
+        for _ in range(len(self.replicas)):
+            engine = self.replicas[self._next % len(self.replicas)]
+            self._next += 1
+            if self.healthy[engine]:
+                return engine
+        return self.primary
+
+    async def engine_for(self, client_key: Optional[str]) -> AsyncEngine:
+        if not self.replicas:
+            return self.primary
+        if client_key is not None and await self.is_sticky(client_key):
+            return self.primary
+        return self.choose()
+
+    async def mark_write(self, client_key: str):
+        try:
+            await get_redis().set(REPLICA_STICKY_KEY_PREFIX + client_key, 1, px=int(self.sticky_seconds * 1000))
+        except Exception:
+            logger.warning("Unable to mark client as sticky to primary", exc_info=True)
+
+    async def is_sticky(self, client_key: str) -> bool:
+        try:
+            return bool(await get_redis().exists(REPLICA_STICKY_KEY_PREFIX + client_key))
+        except Exception:
+            # without redis we can't know, primary is always up to date
+            logger.warning("Unable to read sticky marker of client", exc_info=True)
+            return True
+
+    async def check_health(self):
+        for engine in self.replicas:
+            try:
+                async with engine.connect() as conn:
+                    await asyncio.wait_for(conn.execute(text("SELECT 1")), REPLICA_HEALTH_CHECK_TIMEOUT)
+                healthy = True
+            except Exception:
+                healthy = False
+
+            if healthy != self.healthy[engine]:
+                logger.warning("Replica %s is %s", engine.url, "healthy" if healthy else "unhealthy")
+            self.healthy[engine] = healthy
+
+    async def _health_check_loop(self, interval: float):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float = REPLICA_HEALTH_CHECK_INTERVAL):
+        if self.replicas and self._health_check_task is None:
+            self._health_check_task = asyncio.get_running_loop().create_task(self._health_check_loop(interval))
+
+    async def stop(self):
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+            try:
+                await self._health_check_task
+            except asyncio.CancelledError:
+                pass
+            self._health_check_task = None
+
+        for engine in self.replicas:
+            await engine.dispose()
+
+    # a dropped connection take replica out of rotation until next successful health check
+    def _on_engine_error(self, context):
+        if context.is_disconnect and context.engine is not None:
+            for engine in self.replicas:
+                if engine.sync_engine is context.engine:
+                    self.healthy[engine] = False
+
+
+db_router = ReplicaRouter(databases.async_engine, databases.replica_engines, REPLICA_STICKY_SECONDS)
+
+
+# client of stickiness is the bearer token (hashed, we don't want to keep tokens in memory) or the client address
+def client_key(request: Request) -> Optional[str]:
+    authorization = request.headers.get("authorization")
+    if authorization:
+        return hashlib.sha1(authorization.encode("utf-8")).hexdigest()
+    if request.client:
+        return request.client.host
+    return None
+
+
+# writes of the current request, set by ReplicaStickyMiddleware and flagged by sessions of get_db on commit
+_request_writes: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("request_writes", default=None)
+
+
+def _flag_flush(session, flush_context):
+    session.info["wrote"] = True
+
+
+def _flag_dml(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+
+def _flag_commit(session):
+    request_writes = _request_writes.get()
+    if session.info.pop("wrote", False) and request_writes is not None:
+        request_writes["wrote"] = True
+
+
+def _clear_flag(session):
+    session.info.pop("wrote", None)
+
+
+# listeners are added to this session only, other sessions (tests, email worker, scripts) are not watched
+def track_writes(session: AsyncSession):
+    sync_session = session.sync_session
+    event.listen(sync_session, "after_flush", _flag_flush)
+    event.listen(sync_session, "do_orm_execute", _flag_dml)
+    event.listen(sync_session, "after_commit", _flag_commit)
+    event.listen(sync_session, "after_rollback", _clear_flag)
+
+
+# a request which committed a write make its client sticky to primary, the marker is written before the
+# response start, so the next read of the client can't run before it
+class ReplicaStickyMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_writes = {"wrote": False}
+        token = _request_writes.set(request_writes)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and request_writes["wrote"]:
+                key = client_key(Request(scope))
+                if key is not None:
+                    await db_router.mark_write(key)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_writes.reset(token)
@@ -22,6 +22,12 @@ class UserBase(BaseModel):
 class UserCreated(UserBase):
     password: str
 
+# minimum information of authenticated user, it is what get_current_user return
+class UserPrincipal(UserBase):
+    id: int
+    role: Optional[str] = None
+    is_active: Optional[bool] = None
+
 class CommentsBase(BaseModel):
     id: int
     name: str
@@ -31,8 +37,9 @@ class CommentsBase(BaseModel):
     class Config:
         orm_mode = True
 
+# thread of replies, it can be nested at any depth (bounded by MAX_COMMENT_DEPTH of posts_services)
 class Comments(CommentsBase):
-    children: Optional[List[CommentsBase]] = Field(
+    children: Optional[List["Comments"]] = Field(
         None,
         title="Comments",
     )
@@ -40,14 +47,42 @@ class Comments(CommentsBase):
     class Config:
         orm_mode = True
 
-class Post(PostBase):
+Comments.update_forward_refs()
+
+# comment inside a page of comments, only the first replies are inline
+# the rest are loaded by GET /posts/{post_id}/comment/{comment_id}/replies?after={replies_cursor}
+class CommentThread(CommentsBase):
+    children: List["CommentThread"] = Field(
+        [],
+        title="First replies of this comment",
+    )
+    replies_count: int = Field(
+        0,
+        title="Number of direct replies of this comment",
+    )
+    replies_cursor: Optional[str] = Field(
+        None,
+        title="Cursor of next replies, send it back as 'after' parameter of replies api. Null in case every reply or no reply is inline",
+    )
+
+CommentThread.update_forward_refs()
+
+class CommentPage(BaseModel):
+    items: List[CommentThread]
+    next_cursor: Optional[str] = Field(
+        None,
+        title="Cursor of next page, send it back as 'after' parameter. Null in case there is no next page",
+    )
+
+# post inside list response, only number of likes is included, users who liked it are served by GET /posts/{id}/likes
+class PostSummary(PostBase):
     id: int
     owner_email: str
     title: str
     content: str
     date_created: datetime
     date_last_update: datetime
-    like: List[UserBase]
+    like_count: int
     comments: List[Comments]
 
     # change default behaviour of BaseModel
@@ -57,6 +92,26 @@ class Post(PostBase):
         # with this config => fetch orm field also
         orm_mode = True
 
+class Post(PostSummary):
+    like: List[UserBase]
+
+    class Config:
+        orm_mode = True
+
+class PostPage(BaseModel):
+    items: List[PostSummary]
+    next_cursor: Optional[str] = Field(
+        None,
+        title="Cursor of next page, send it back as 'after' parameter. Null in case there is no next page",
+    )
+
+class UserPage(BaseModel):
+    items: List[UserBase]
+    next_cursor: Optional[str] = Field(
+        None,
+        title="Cursor of next page, send it back as 'after' parameter. Null in case there is no next page",
+    )
+
 class User(BaseModel):
     id: Optional[int] = Field(
         None,
@@ -79,7 +134,39 @@ class User(BaseModel):
         None,
         title="Posts was like by User",
     )
+    posts_count: Optional[int] = Field(
+        None,
+        title="Number of posts belong to User, only in list response with embedded posts",
+    )
+    posts_like_count: Optional[int] = Field(
+        None,
+        title="Number of posts was like by User, only in list response with embedded posts_like",
+    )
 
     class Config:
         # Pydantic's orm_mode will tell the Pydantic model to read the data even if it is not a dict, but an ORM model (or any other arbitrary object with attributes).
-        orm_mode=True
\ No newline at end of file
+        orm_mode=True
+class UserImportRow(BaseModel):
+    row: int = Field(..., title="Position of user in request body, start from 0")
+    email: str
+    success: bool
+    id: Optional[int] = Field(
+        None,
+        title="ID of created User",
+    )
+    detail: Optional[str] = Field(
+        None,
+        title="Reason of failure",
+    )
+
+class UserImportReport(BaseModel):
+    created: int
+    failed: int
+    rows: List[UserImportRow]
+
+class UserListPage(BaseModel):
+    items: List[User]
+    next_cursor: Optional[str] = Field(
+        None,
+        title="Cursor of next page, send it back as 'after' parameter. Null in case there is no next page",
+    )
@@ -1,5 +1,8 @@
 from sqlalchemy.ext.asyncio.session import AsyncSession
-from blog_api import databases
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from fastapi import Request
+from blog_api import databases, replicas
 
 from passlib.context import CryptContext
 
@@ -32,4 +35,27 @@ def get_db():
 # Asynchronous version
 async def get_db() -> AsyncSession:
     async with databases.async_session_local() as session:
+        # a commit with writes make following reads of this client go to primary, see blog_api.replicas
+        if replicas.db_router.replicas:
+            replicas.track_writes(session)
         yield session
+
+
+# session of read only endpoints, it is bound to a healthy replica or to primary
+# primary is used when there is no healthy replica or client wrote something a few seconds ago
+async def get_read_db(request: Request) -> AsyncSession:
+    engine = await replicas.db_router.engine_for(replicas.client_key(request))
+    async with databases.async_session_local(bind=engine) as session:
+        yield session
+
+
+# name of database behind the session, for example "postgresql" or "sqlite"
+def dialect_name(db: AsyncSession) -> str:
+    return db.sync_session.get_bind().dialect.name
+
+
+# INSERT construct which support ON CONFLICT, postgres and sqlite have their own version of it
+def dialect_insert(db: AsyncSession):
+    if dialect_name(db) == "sqlite":
+        return sqlite_insert
+    return postgresql_insert
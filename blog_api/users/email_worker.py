@@ -0,0 +1,232 @@
+import os
+import signal
+import asyncio
+import logging
+from enum import Enum
+from datetime import datetime, timedelta
+from email.message import EmailMessage, Message
+from email.utils import formataddr, formatdate, make_msgid
+from typing import List, Optional
+
+import aiosmtplib
+from fastapi_mail.config import ConnectionConfig
+from jinja2 import Environment
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from blog_api import databases
+from blog_api.models import EmailOutbox
+from blog_api.users.send_email_services import EmailStatusEnum, conf
+
+logger = logging.getLogger(__name__)
+
+# send emails of email_outbox, it runs in its own process:
+#   python -m blog_api.users.email_worker
+# - due pending emails are claimed by batches with SELECT ... FOR UPDATE SKIP LOCKED, so many workers can run
+#   and never send the same email twice, rows stay locked until the batch is sent and its result committed
+# - emails of a batch are sent over EMAIL_SMTP_POOL_SIZE SMTP connections which stay open between batches
+# - a failed email is retried after EMAIL_RETRY_BACKOFF * 2 ** (attempts - 1) seconds (at most EMAIL_RETRY_MAX_BACKOFF),
+#   after EMAIL_MAX_ATTEMPTS attempts it is marked failed
+# - EMAIL_TRANSPORT=memory keep emails in memory instead of sending them, it needs no mail server
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", 50))
+EMAIL_POLL_INTERVAL = float(os.getenv("EMAIL_POLL_INTERVAL", 1))
+EMAIL_SMTP_POOL_SIZE = int(os.getenv("EMAIL_SMTP_POOL_SIZE", 2))
+EMAIL_SMTP_TIMEOUT = float(os.getenv("EMAIL_SMTP_TIMEOUT", 30))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", 5))
+EMAIL_RETRY_BACKOFF = float(os.getenv("EMAIL_RETRY_BACKOFF", 30))
+EMAIL_RETRY_MAX_BACKOFF = float(os.getenv("EMAIL_RETRY_MAX_BACKOFF", 3600))
+
+
+class EmailTransportEnum(str, Enum):
+    SMTP = "smtp"
+    MEMORY = "memory"
+
+
+EMAIL_TRANSPORT = os.getenv("EMAIL_TRANSPORT", EmailTransportEnum.SMTP)
+
+
+# SMTP connections are opened on first use and kept open, a connection closed by the server is opened again
+class SMTPTransport:
+    def __init__(self, config: ConnectionConfig, pool_size: int = EMAIL_SMTP_POOL_SIZE):
+        self.config = config
+        self._connections = [
+            aiosmtplib.SMTP(
+                hostname=config.MAIL_SERVER,
+                port=config.MAIL_PORT,
+                use_tls=config.MAIL_SSL,
+                start_tls=config.MAIL_TLS,
+                validate_certs=config.VALIDATE_CERTS,
+                timeout=EMAIL_SMTP_TIMEOUT,
+            )
+            for _ in range(pool_size)
+        ]
+        # connections which are not sending an email right now
+        self._idle: asyncio.Queue = asyncio.Queue()
+        for smtp in self._connections:
+            self._idle.put_nowait(smtp)
+
+    async def _ensure_connected(self, smtp: aiosmtplib.SMTP):
+        if smtp.is_connected:
+            return
+        await smtp.connect()
+        if self.config.USE_CREDENTIALS:
+            await smtp.login(self.config.MAIL_USERNAME, self.config.MAIL_PASSWORD)
+
+    async def send(self, message: Message):
+        smtp = await self._idle.get()
+        try:
+            try:
+                await self._ensure_connected(smtp)
+                await smtp.send_message(message)
+            except aiosmtplib.SMTPServerDisconnected:
+                # servers close idle connections after a while, open it again once
+                smtp.close()
+                await self._ensure_connected(smtp)
+                await smtp.send_message(message)
+        except aiosmtplib.SMTPResponseException:
+            # the server refused this email, the connection is still fine
+            raise
+        except Exception:
+            # state of the connection is unknown, it is opened again by the next email
+            smtp.close()
+            raise
+        finally:
+            self._idle.put_nowait(smtp)
+
+    async def close(self):
+        for smtp in self._connections:
+            if not smtp.is_connected:
+                continue
+            try:
+                await smtp.quit()
+            except aiosmtplib.SMTPException:
+                smtp.close()
+
+
+# local stand in of a SMTP server, emails are only kept in messages, tests read them there
+class MemoryTransport:
+    def __init__(self):
+        self.messages: List[Message] = []
+
+    async def send(self, message: Message):
+        self.messages.append(message)
+        logger.info("Email %r to %s kept in memory", message["Subject"], message["To"])
+
+    async def close(self):
+        pass
+
+
+def create_transport(name: str = EMAIL_TRANSPORT):
+    if name == EmailTransportEnum.MEMORY:
+        return MemoryTransport()
+    if name == EmailTransportEnum.SMTP:
+        return SMTPTransport(conf)
+    raise ValueError(f"Email transport {name} is not supported!")
+
+
+_template_environment: Optional[Environment] = None
+
+
+# one jinja environment for the whole worker, so templates are loaded and compiled only once
+def template_environment() -> Environment:
+    global _template_environment
+    if _template_environment is None:
+        _template_environment = conf.template_engine()
+    return _template_environment
+
+
+# recipient was validated by queue_email, the message is built by the standard library
+# instead of private API of fastapi_mail
+def build_message(email: EmailOutbox) -> Message:
+    html = template_environment().get_template(email.template_name).render(body=email.body)
+
+    message = EmailMessage()
+    message["Date"] = formatdate(localtime=True)
+    message["Message-ID"] = make_msgid()
+    message["From"] = formataddr((conf.MAIL_FROM_NAME, conf.MAIL_FROM))
+    message["To"] = email.recipient
+    message["Subject"] = email.subject
+    message.set_content(html, subtype="html")
+    return message
+
+
+def retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=min(EMAIL_RETRY_BACKOFF * 2 ** (attempts - 1), EMAIL_RETRY_MAX_BACKOFF))
+
+
+async def _send(transport, email: EmailOutbox):
+    await transport.send(build_message(email))
+
+
+# send one batch of due emails and record results, return number of claimed emails
+async def process_batch(db: AsyncSession, transport, batch_size: int = EMAIL_BATCH_SIZE) -> int:
+    record = await db.execute(
+        select(EmailOutbox)
+        .where(EmailOutbox.status == EmailStatusEnum.pending.value, EmailOutbox.next_attempt_at <= datetime.utcnow())
+        .order_by(EmailOutbox.next_attempt_at, EmailOutbox.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    emails = record.scalars().all()
+    if not emails:
+        await db.commit()
+        return 0
+
+    results = await asyncio.gather(*(_send(transport, email) for email in emails), return_exceptions=True)
+
+    now = datetime.utcnow()
+    for email, error in zip(emails, results):
+        email.attempts += 1
+        if error is None:
+            email.status = EmailStatusEnum.sent.value
+            email.date_sent = now
+            email.body = None
+            email.last_error = None
+        elif email.attempts >= EMAIL_MAX_ATTEMPTS:
+            email.status = EmailStatusEnum.failed.value
+            email.last_error = repr(error)
+            logger.error("Give up email %s to %s after %s attempts: %r", email.id, email.recipient, email.attempts, error)
+        else:
+            email.next_attempt_at = now + retry_delay(email.attempts)
+            email.last_error = repr(error)
+            logger.warning("Unable to send email %s to %s, retry at %s: %r", email.id, email.recipient, email.next_attempt_at, error)
+
+    await db.commit()
+    return len(emails)
+
+
+async def run_worker(transport, stop: asyncio.Event, poll_interval: float = EMAIL_POLL_INTERVAL):
+    while not stop.is_set():
+        try:
+            async with databases.async_session_local() as db:
+                processed = await process_batch(db, transport)
+        except Exception:
+            logger.exception("Unable to process email outbox")
+            processed = 0
+
+        # a full batch means more emails are probably waiting, take the next one right away
+        if processed < EMAIL_BATCH_SIZE:
+            try:
+                await asyncio.wait_for(stop.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    transport = create_transport()
+    logger.info("Email worker started with %s transport", EMAIL_TRANSPORT)
+    try:
+        await run_worker(transport, stop)
+    finally:
+        await transport.close()
+        await databases.async_engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
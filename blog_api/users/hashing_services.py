@@ -0,0 +1,173 @@
+import os
+import time
+import asyncio
+from typing import List, Optional
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# bcrypt take a few hundred ms of CPU, if it run inside async handler it block the whole event loop
+# so hashing is sent to a pool, "thread" is enough because bcrypt release the GIL, "process" use every core
+PASSWORD_HASHING_POOL = os.getenv("PASSWORD_HASHING_POOL", "thread")
+PASSWORD_HASHING_POOL_SIZE = int(os.getenv("PASSWORD_HASHING_POOL_SIZE", os.cpu_count() or 1))
+# number of hashing jobs which can wait for a free worker, when it is full new request get 503
+PASSWORD_HASHING_MAX_QUEUE = int(os.getenv("PASSWORD_HASHING_MAX_QUEUE", 64))
+# bulk import hash thousands of passwords at once, it has its own process pool on every core
+# so it doesn't starve login and register requests which use password_hasher
+BULK_PASSWORD_HASHING_POOL_SIZE = int(os.getenv("BULK_PASSWORD_HASHING_POOL_SIZE", os.cpu_count() or 1))
+
+
+def hash_password(password: str):
+    return pwd_context.hash(password)
+
+
+def verify_password(plain_password: str, hashed_password: str):
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def hash_passwords(passwords: List[str]):
+    return [pwd_context.hash(password) for password in passwords]
+
+
+# it run inside the pool, so it must be a module level function (process pool need to pickle it)
+# return how long the job waited for a worker and how long the hashing took
+def _timed_call(function, submitted_at: float, *args):
+    started_at = time.monotonic()
+    result = function(*args)
+    return started_at - submitted_at, time.monotonic() - started_at, result
+
+
+class HashingStats:
+    def __init__(self):
+        self.calls = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.hash_seconds_total = 0.0
+        self.hash_seconds_max = 0.0
+
+    def observe(self, wait_seconds: float, hash_seconds: float):
+        self.calls += 1
+        self.wait_seconds_total += wait_seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+        self.hash_seconds_total += hash_seconds
+        self.hash_seconds_max = max(self.hash_seconds_max, hash_seconds)
+
+    def dict(self):
+        return {
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+            "hash_seconds_total": self.hash_seconds_total,
+            "hash_seconds_max": self.hash_seconds_max,
+        }
+
+
+class PasswordHasher:
+    def __init__(self, pool: str, pool_size: int, max_queue: int):
+        if pool not in ("thread", "process"):
+            raise ValueError(f"Password hashing pool {pool} is not supported!")
+
+        self.pool = pool
+        self.pool_size = pool_size
+        self.max_queue = max_queue
+        self.pending = 0
+        self.stats = HashingStats()
+        self._executor = None
+
+    # pool is created at first use, not at import time
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.pool == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.pool_size)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="password-hasher")
+        return self._executor
+
+    async def _run(self, function, *args):
+        if self.pending >= self.pool_size + self.max_queue:
+            self.stats.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy, please try again later!",
+                headers={"Retry-After": "1"},
+            )
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            wait_seconds, hash_seconds, result = await loop.run_in_executor(
+                self.executor, _timed_call, function, time.monotonic(), *args
+            )
+        finally:
+            self.pending -= 1
+
+        self.stats.observe(wait_seconds, hash_seconds)
+        return result
+
+    async def hash(self, password: str):
+        return await self._run(hash_password, password)
+
+    async def verify(self, plain_password: str, hashed_password: str):
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    # passwords are split into one slice per worker, so one job only cost one round trip to the pool
+    # result keep the same order as passwords
+    async def hash_many(self, passwords: List[str]):
+        if not passwords:
+            return []
+
+        slice_size = -(-len(passwords) // self.pool_size)
+        slices = [passwords[i:i + slice_size] for i in range(0, len(passwords), slice_size)]
+        results = await asyncio.gather(*(self._run(hash_passwords, passwords_slice) for passwords_slice in slices))
+
+        return [hashed_password for result in results for hashed_password in result]
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(PASSWORD_HASHING_POOL, PASSWORD_HASHING_POOL_SIZE, PASSWORD_HASHING_MAX_QUEUE)
+# queue is not needed, hash_many never submit more jobs than workers and imports run one at a time
+bulk_password_hasher = PasswordHasher("process", BULK_PASSWORD_HASHING_POOL_SIZE, 0)
+
+_bulk_hashing_lock: Optional[asyncio.Lock] = None
+
+
+# a second import wait for the running one, instead of getting 503 after some of its rows were hashed
+# it is created at first use, inside the event loop of the server
+def bulk_hashing_lock() -> asyncio.Lock:
+    global _bulk_hashing_lock
+    if _bulk_hashing_lock is None:
+        _bulk_hashing_lock = asyncio.Lock()
+    return _bulk_hashing_lock
+
+
+async def hash_password_async(password: str):
+    return await password_hasher.hash(password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str):
+    return await password_hasher.verify(plain_password, hashed_password)
+
+
+async def hash_passwords_bulk(passwords: List[str]):
+    async with bulk_hashing_lock():
+        return await bulk_password_hasher.hash_many(passwords)
+
+
+def hashing_stats() -> dict:
+    stats = password_hasher.stats.dict()
+    stats["pool"] = password_hasher.pool
+    stats["pool_size"] = password_hasher.pool_size
+    stats["max_queue"] = password_hasher.max_queue
+    stats["pending"] = password_hasher.pending
+    stats["bulk"] = bulk_password_hasher.stats.dict()
+    return stats
@@ -1,5 +1,5 @@
-from fastapi import APIRouter, BackgroundTasks
-from blog_api.users.send_email_services import send_email_async, send_email_background
+from fastapi import APIRouter
+from blog_api.users.send_email_services import send_email_async
 from fastapi import Response, status
 
 PREFIX = "/send-email"
@@ -15,9 +15,3 @@ async def send_email_asynchronous_api(user_email: str):
     # that is because, application only waiting for send_email_async then goes to process another request
     # not waiting for send_email_async then return 'Success' response
     return f"Sucessfully send email to {user_email}, please go to your inbox and check!"
-
-@router.get('/send-email/background/{user_email}')
-def send_email_background_api(user_email: str,background_tasks: BackgroundTasks):
-    # difference with async function, background task and let send_email_background run and return 'Success' response immediately
-    send_email_background(background_tasks, 'Hello background task', user_email, {'title': 'Coolest title ever from background task', 'name': 'Long Huynh Le'})
-    return f"Sucessfully send email to {user_email}, please go to your inbox and check!"
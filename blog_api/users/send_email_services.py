@@ -1,10 +1,18 @@
 import os
-import time
-from fastapi import BackgroundTasks
+import logging
+from enum import Enum
+from typing import List, Tuple
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
+
+from blog_api import metrics
+from blog_api.models import EmailOutbox
 load_dotenv('.env')
 
+logger = logging.getLogger(__name__)
+
 # create a .env file to store sessitive data
 # then load and read data from it, don't commit .env file
 class Envs:
@@ -15,6 +23,9 @@ class Envs:
     MAIL_SERVER = os.getenv('MAIL_SERVER')
     MAIL_FROM_NAME = os.getenv('MAIL_FROM_NAME')
     SECRET_KEY = os.getenv('SECRET_KEY')
+    # a local SMTP server like MailHog has neither STARTTLS nor login, set both to 0 for it
+    MAIL_TLS = os.getenv('MAIL_TLS', '1') == '1'
+    MAIL_USE_CREDENTIALS = os.getenv('MAIL_USE_CREDENTIALS', '1') == '1'
 
 
 # to be able to use this feature, you'll need to
@@ -28,9 +39,9 @@ conf = ConnectionConfig(
     MAIL_PORT= Envs.MAIL_PORT,
     MAIL_SERVER= Envs.MAIL_SERVER,
     MAIL_FROM_NAME= Envs.MAIL_FROM_NAME,
-    MAIL_TLS=True,
+    MAIL_TLS=Envs.MAIL_TLS,
     MAIL_SSL=False,
-    USE_CREDENTIALS=True,
+    USE_CREDENTIALS=Envs.MAIL_USE_CREDENTIALS,
     TEMPLATE_FOLDER='blog_api/static/templates'
 )
 
@@ -48,21 +59,59 @@ async def send_email_async(subject: str, email_to: str, body: dict):
     await fm.send_message(message, template_name='active_account_email.html')
 
 
-def send_email_background(backgound_tasks: BackgroundTasks, subject: str, email_to: str, body: dict):
-    message = MessageSchema(
+class EmailStatusEnum(str, Enum):
+    pending = "pending"
+    sent = "sent"
+    failed = "failed"
+
+
+def email_template_name(body: dict) -> str:
+    return 'active_account_email.html' if body.get("code") else 'forgot_pass_email.html'
+
+
+# add an email to the outbox, it is written by the commit of the caller, together with the change which need it,
+# then blog_api.users.email_worker send it. Raise ValidationError when email_to is invalid
+def queue_email(db: AsyncSession, subject: str, email_to: str, body: dict) -> EmailOutbox:
+    MessageSchema(subject=subject, recipients=[email_to], template_body=body, subtype='html')
+
+    email = EmailOutbox(
+        recipient=email_to,
         subject=subject,
-        recipients=[email_to],
-        template_body=body,
-        subtype='html'
+        template_name=email_template_name(body),
+        body=body,
+    )
+    db.add(email)
+    return email
+
+
+# same as queue_email but for many emails, they are inserted by one executemany
+# bodies is a list of (email_to, body), emails must be validated by the caller
+async def queue_emails(db: AsyncSession, subject: str, bodies: List[Tuple[str, dict]]):
+    if not bodies:
+        return
+
+    await db.execute(
+        insert(EmailOutbox),
+        [
+            {"recipient": email_to, "subject": subject, "template_name": email_template_name(body), "body": body}
+            for email_to, body in bodies
+        ]
     )
 
-    fm = FastMail(conf)
 
-    if body["code"]:
-        template_name = 'active_account_email.html'
-    else:
-        template_name = 'forgot_pass_email.html'
+# emails are sent by another process, so email metrics are read from the outbox when /metrics is scraped
+# other metrics are still rendered when the database is down, email metrics keep their last values
+async def observe_outbox(db: AsyncSession):
+    try:
+        record = await db.execute(
+            select(EmailOutbox.status, func.count())
+            .where(EmailOutbox.status.in_([EmailStatusEnum.pending.value, EmailStatusEnum.failed.value]))
+            .group_by(EmailOutbox.status)
+        )
+    except Exception:
+        logger.warning("Unable to read email outbox metrics", exc_info=True)
+        return
 
-    backgound_tasks.add_task(
-        fm.send_message, message, template_name=template_name
-    )
\ No newline at end of file
+    counts = dict(record.all())
+    metrics.email_queue_depth.set(counts.get(EmailStatusEnum.pending.value, 0))
+    metrics.email_send_failures_total.set(counts.get(EmailStatusEnum.failed.value, 0))
@@ -1,8 +1,8 @@
 # We will run this file by uvicorn
-from typing import List
+from typing import List, Optional
 from datetime import timedelta
 
-from fastapi import Depends, HTTPException, APIRouter, BackgroundTasks, Security
+from fastapi import Depends, HTTPException, APIRouter, Security, Query
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -10,6 +10,8 @@ from blog_api import services
 from blog_api.schemas import(
     User,
     UserCreated,
+    UserImportReport,
+    UserListPage,
 )
 from blog_api.helper import ACCESS_TOKEN_EXPIRE_DAYS, create_access_token, get_current_user, CREDENTIAL_EXCEPTION, templates
 from blog_api.models import User as User_db
@@ -22,7 +24,6 @@ router = APIRouter()
 
 @router.post("/", response_model=User, status_code=201)
 async def create_user(
-    background_task: BackgroundTasks,
     user:UserCreated,
     db:AsyncSession = Depends(services.get_db)
 ):
@@ -33,17 +34,50 @@ async def create_user(
             status_code=400, detail="User with this infomation is already exist!"
         )
     
-    return await users_services.create_user(db, user, background_task)
+    return await users_services.create_user(db, user)
 
 
-@router.get("/", response_model=List[User])
-async def get_all_user(db:AsyncSession = Depends(services.get_db)):
-    data = await users_services.get_all_user(db)
-    return data
+@router.post("/bulk", response_model=UserImportReport, status_code=201)
+async def bulk_create_users(
+    users: List[UserCreated],
+    current_user: User_db = Security(get_current_user, scopes=["admin"]),
+    db: AsyncSession = Depends(services.get_db)
+):
+    if not current_user or current_user.role != "admin":
+        raise CREDENTIAL_EXCEPTION
+
+    if len(users) > users_services.MAX_BULK_IMPORT_USERS:
+        raise HTTPException(
+            status_code=413, detail=f"Only {users_services.MAX_BULK_IMPORT_USERS} users can be imported at once!"
+        )
+
+    rows = await users_services.bulk_create_users(db, users)
+    created = sum(row.success for row in rows)
+
+    return UserImportReport(created=created, failed=len(rows) - created, rows=rows)
+
+
+@router.get("/", response_model=UserListPage)
+async def get_all_user(
+    size: Optional[int] = Query(users_services.DEFAULT_USER_PAGING_SIZE, gt=0, le=1000, description="Page size"),
+    after: Optional[str] = Query(None, description="Cursor received from previous page"),
+    # posts and posts_like are not included unless they are asked for
+    embed: Optional[List[users_services.UserEmbedEnum]] = Query(None, description="Relationships to include"),
+    embed_limit: Optional[int] = Query(
+        users_services.DEFAULT_USER_EMBED_LIMIT, ge=0, le=50, description="Number of latest embedded posts per user"
+    ),
+    db:AsyncSession = Depends(services.get_read_db)
+):
+    try:
+        users, next_cursor = await users_services.get_all_user(db, size, after, embed, embed_limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return UserListPage(items=users, next_cursor=next_cursor)
 
 
-@router.get("/{user_email}/", response_model=User)
-async def get_single_user(user_email:str, db:AsyncSession = Depends(services.get_db)):
+@router.get("/{user_email}/", response_model=User, response_model_exclude_unset=True)
+async def get_single_user(user_email:str, db:AsyncSession = Depends(services.get_read_db)):
     record = await users_services.get_single_user(db, user_email)
     if not record:
         raise HTTPException(
@@ -121,7 +155,7 @@ async def login_for_access_token(
 @router.post("/{user_email}/active/{verify_code}")
 async def active_user(user_email: str, verify_code: str, db: AsyncSession = Depends(services.get_db)):
 
-    users_services.verify_user(user_email, db)
+    await users_services.verify_user(user_email, db)
     
     active_check = await users_services.active_user(user_email, verify_code, db)
 
@@ -159,11 +193,11 @@ async def change_user_password(
 
 
 @router.post("/{user_email}/forgotpass")
-async def forgot_user_password(background_task: BackgroundTasks, user_email: str, db: AsyncSession = Depends(services.get_db)):
+async def forgot_user_password(user_email: str, db: AsyncSession = Depends(services.get_db)):
 
-    users_services.verify_user(user_email, db)
+    await users_services.verify_user(user_email, db)
     
-    status = await users_services.forgot_password(user_email, db, background_task)
+    status = await users_services.forgot_password(user_email, db)
 
     if status:
         return f"New password was sent to email {user_email}, please use that new password to login. Remember to change your password after login."
@@ -182,7 +216,7 @@ async def delete_user(
     if not current_user:
         raise CREDENTIAL_EXCEPTION
     
-    users_services.verify_user(user_email, db)
+    await users_services.verify_user(user_email, db)
 
     status = await users_services.delete_user(user_email, db)
 
@@ -202,7 +236,7 @@ async def admin_active_user(
     if not current_user or current_user.role != "admin":
         raise CREDENTIAL_EXCEPTION
 
-    users_services.verify_user(user_email, db)
+    await users_services.verify_user(user_email, db)
 
     user = await users_services.admin_active_user(user_email, db)
 
@@ -1,43 +1,78 @@
+import os
 import json
 from pydantic.errors import IntegerError
-import redis, string, random
-from datetime import timedelta
+import string, random
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import List, Optional
 
 from sqlalchemy.orm import Session, selectinload
-from sqlalchemy import exc, update, select, delete
+from sqlalchemy import exc, update, select, delete, func, or_
 from sqlalchemy.ext.asyncio import AsyncSession
-from passlib.context import CryptContext
-from fastapi import BackgroundTasks, HTTPException
+from fastapi import HTTPException
+from pydantic import EmailStr
 from pydantic.error_wrappers import ValidationError
 
-from blog_api.models import User
-from blog_api.schemas import UserCreated
-from blog_api.users.send_email_services import send_email_background
+from blog_api.models import User, Post, Link_User_Post
+from blog_api import services
+from blog_api.schemas import UserCreated, UserPrincipal, UserImportRow, PostBase, User as UserSchema
+from blog_api.pagination import encode_cursor, decode_cursor
+from blog_api.users.send_email_services import queue_email, queue_emails
+from blog_api.cache import RedisCache
+from blog_api.redis_client import get_redis
+from blog_api.posts import posts_services, search_index
+# hash_password and verify_password are sync version, they block event loop so only use them outside of api
+from blog_api.users.hashing_services import (
+    hash_password,
+    verify_password,
+    hash_password_async,
+    verify_password_async,
+    hash_passwords_bulk,
+)
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# verification codes are stored in redis, see blog_api.redis_client for the shared asyncio client
+VERIFY_CODE_EXPIRE = timedelta(minutes=60)
 
-# config redis client, in order to interact with redis
-redis_client = redis.Redis(host="redis", port=6379, db=0)
-# in order to work without docker, we need to use localhost
-# redis_client = redis.Redis(host="localhost", port=6379, db=0)
+# authenticated users are cached by email, so a token check doesn't need to hit database every request
+# change_user_password, delete_user, admin_active_user and active_user invalidate it
+# the cache lives in redis, so a deleted or deactivated user is rejected by every worker right away,
+# not only by the worker which handled the change
+PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+
+principal_cache = RedisCache("principal", PRINCIPAL_CACHE_TTL)
+
+DEFAULT_USER_PAGING_SIZE = 100
+# number of embedded posts per user in list response
+DEFAULT_USER_EMBED_LIMIT = 5
+
+
+class UserEmbedEnum(str, Enum):
+    POSTS = "posts"
+    POSTS_LIKE = "posts_like"
+
+
+# number of users per multi row INSERT of bulk_create_users
+BULK_USER_INSERT_CHUNK_SIZE = 1000
+MAX_BULK_IMPORT_USERS = int(os.getenv("MAX_BULK_IMPORT_USERS", 10000))
 
 def _random_string():
     letters = string.digits
     letters += string.ascii_lowercase
     return (''.join(random.choice(letters) for _ in range(8)))
 
-async def create_user(db:AsyncSession, user:UserCreated, background_task: BackgroundTasks):
+async def create_user(db:AsyncSession, user:UserCreated):
     # workaround by adding posts field to User intance, because when response model validate this instance, it will require posts field
-    db_user = User(email=user.email, hashed_password=hash_password(user.password), posts=[], posts_like=[])
+    db_user = User(email=user.email, hashed_password=await hash_password_async(user.password), posts=[], posts_like=[])
     
     random_str = _random_string()
-    redis_client.set(user.email, random_str)
-    redis_client.expire(user.email, timedelta(minutes=60))
+    # value and expire time are set by one atomic command (SET key value EX seconds)
+    await get_redis().set(user.email, random_str, ex=VERIFY_CODE_EXPIRE)
 
     try:
-        send_email_background(
-            background_task, 
+        # sent by email_worker once this transaction is committed
+        queue_email(
+            db,
             "Verifycation Account Email!", 
             user.email, 
             {
@@ -58,14 +93,166 @@ async def create_user(db:AsyncSession, user:UserCreated, background_task: Backgr
     
     return db_user
 
-async def get_all_user(db:AsyncSession):
-    # https://docs.sqlalchemy.org/en/14/orm/extensions/asyncio.html Preventing Implicit IO when Using AsyncSession
-    # for relationship loading, eager loading should be applied.
-    stmt = select(User).options(selectinload(User.posts), selectinload(User.posts_like))
-    # we await session.execute() that will execute the query and hold the results. The scalars() method provides access to the results.
+# bulk version of create_user, used by admin to import many users at once
+# - invalid and duplicated emails (in the batch or already in database) are reported as failed rows, not as an error
+# - passwords are hashed by bulk_password_hasher, which use a process pool on every core
+# - users are inserted by multi row INSERT ... ON CONFLICT (email) DO NOTHING, so a concurrent register doesn't break the batch
+# - verification codes are written by one redis pipeline and emails are queued in the outbox by one executemany
+async def bulk_create_users(db:AsyncSession, users:List[UserCreated]):
+    rows = [UserImportRow(row=number, email=user.email, success=False) for number, user in enumerate(users)]
+
+    candidates = {}
+    for row in rows:
+        try:
+            EmailStr.validate(row.email)
+        except ValueError:
+            row.detail = f"Email {row.email} is invalid!"
+            continue
+        if row.email in candidates:
+            row.detail = f"Email {row.email} is duplicated in this batch!"
+            continue
+        candidates[row.email] = row
+
+    for chunk in _chunks(list(candidates), BULK_USER_INSERT_CHUNK_SIZE):
+        record = await db.execute(select(User.email).filter(User.email.in_(chunk)))
+        for email in record.scalars():
+            candidates.pop(email).detail = "User with this infomation is already exist!"
+
+    emails = list(candidates)
+    hashed_passwords = await hash_passwords_bulk([users[candidates[email].row].password for email in emails])
+
+    user_ids = {}
+    insert = services.dialect_insert(db)
+    for chunk in _chunks(list(zip(emails, hashed_passwords)), BULK_USER_INSERT_CHUNK_SIZE):
+        stmt = (
+            insert(User)
+            .values([{"email": email, "hashed_password": hashed_password, "is_active": False, "role": "user"} for email, hashed_password in chunk])
+            .on_conflict_do_nothing(index_elements=[User.email])
+        )
+        chunk_emails = [email for email, _ in chunk]
+        if services.dialect_name(db) == "sqlite":
+            # sqlite of SQLAlchemy 1.4 doesn't support RETURNING, ids are selected back inside the same transaction
+            await db.execute(stmt)
+            record = await db.execute(select(User.id, User.email).filter(User.email.in_(chunk_emails)))
+        else:
+            record = await db.execute(stmt.returning(User.id, User.email))
+        user_ids.update({email: user_id for user_id, email in record})
+
+    codes = {}
+    for email, row in candidates.items():
+        if email not in user_ids:
+            # it was registered by someone else between our select and insert
+            row.detail = "User with this infomation is already exist!"
+            continue
+        row.success = True
+        row.id = user_ids[email]
+        codes[email] = _random_string()
+
+    # emails are committed together with users, so an imported user always get its email
+    await queue_emails(
+        db,
+        "Verifycation Account Email!",
+        [
+            (email, {
+                'title': "Verifycation Account Email!",
+                'code': f'{code}',
+                'message': 'Verification code only valid for 5 minutes, so let\'s hurry up!'
+            })
+            for email, code in codes.items()
+        ]
+    )
+    await db.commit()
+
+    if codes:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for email, code in codes.items():
+                pipe.set(email, code, ex=VERIFY_CODE_EXPIRE)
+            await pipe.execute()
+
+    return rows
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# list users by keyset pagination on id, by default only users table is read
+# posts and posts_like are opt-in by embed, each of them cost one more query for the whole page
+# and only the latest embed_limit posts of every user are returned together with the total number
+async def get_all_user(
+    db:AsyncSession,
+    size: int = DEFAULT_USER_PAGING_SIZE,
+    after: Optional[str] = None,
+    embed: Optional[List[UserEmbedEnum]] = None,
+    embed_limit: int = DEFAULT_USER_EMBED_LIMIT
+):
+    stmt = select(User.id, User.email, User.is_active, User.role).order_by(User.id)
+    if after:
+        # raise ValueError when cursor is invalid
+        last_user_id, = decode_cursor(after, int)
+        stmt = stmt.where(User.id > last_user_id)
+
+    # fetch one more record to know whether next page is exist or not
+    record = await db.execute(stmt.limit(size + 1))
+    records = record.all()
+
+    next_cursor = None
+    if len(records) > size:
+        records = records[:size]
+        next_cursor = encode_cursor(records[-1].id)
+
+    users = [UserSchema(id=r.id, email=r.email, is_active=r.is_active, role=r.role) for r in records]
+    embed = embed or []
+
+    if users and UserEmbedEnum.POSTS in embed:
+        users_by_email = {user.email: user for user in users}
+        for user in users:
+            user.posts, user.posts_count = [], 0
+        partitions = await _latest_posts_per_user(
+            db, Post.owner_email, select(Post.owner_email.label("user_key")).where(Post.owner_email.in_(list(users_by_email))), embed_limit
+        )
+        for email, (posts, count) in partitions.items():
+            users_by_email[email].posts, users_by_email[email].posts_count = posts, count
+
+    if users and UserEmbedEnum.POSTS_LIKE in embed:
+        users_by_id = {user.id: user for user in users}
+        for user in users:
+            user.posts_like, user.posts_like_count = [], 0
+        partitions = await _latest_posts_per_user(
+            db,
+            Link_User_Post.user_id,
+            select(Link_User_Post.user_id.label("user_key"))
+            .join(Post, Post.id == Link_User_Post.post_id)
+            .where(Link_User_Post.user_id.in_(list(users_by_id))),
+            embed_limit
+        )
+        for user_id, (posts, count) in partitions.items():
+            users_by_id[user_id].posts_like, users_by_id[user_id].posts_like_count = posts, count
+
+    return users, next_cursor
+
+# latest posts of every user by one query, user_column is the column which link a post to user
+# base_query select user_column labeled as "user_key" and filter users of the page
+# row_number keep only `limit` posts per user, count over the same partition give the total number
+async def _latest_posts_per_user(db: AsyncSession, user_column, base_query: select, limit: int):
+    ranked = (
+        base_query
+        .add_columns(
+            Post.title,
+            Post.content,
+            func.row_number().over(partition_by=user_column, order_by=Post.id.desc()).label("position"),
+            func.count().over(partition_by=user_column).label("total"),
+        )
+        .subquery()
+    )
+    stmt = select(ranked).where(ranked.c.position <= max(limit, 1)).order_by(ranked.c.user_key, ranked.c.position)
     record = await db.execute(stmt)
-    records = record.scalars().all()
-    return records
+
+    partitions = {}
+    for row in record.all():
+        posts, _ = partitions.setdefault(row.user_key, ([], row.total))
+        if row.position <= limit:
+            posts.append(PostBase(title=row.title, content=row.content))
+    return partitions
 
 async def get_single_user(db:AsyncSession, email:str):
     # this only create a query string
@@ -74,18 +261,33 @@ async def get_single_user(db:AsyncSession, email:str):
     record = await db.execute(stmt)
     return record.scalar()
 
-def hash_password(password: str):
-    return pwd_context.hash(password)
+# slim version of get_single_user, only select columns which are needed to authorize a request
+# posts and posts_like are not loaded, use get_single_user in case you need them
+async def get_principal(db:AsyncSession, email:str):
+    cached = await principal_cache.get(email)
+    if cached is not None:
+        return UserPrincipal.parse_raw(cached)
 
-def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
+    stmt = select(User.id, User.email, User.role, User.is_active).filter(User.email == email)
+    record = await db.execute(stmt)
+    row = record.first()
+    if not row:
+        return None
+
+    principal = UserPrincipal(id=row.id, email=row.email, role=row.role, is_active=row.is_active)
+    await principal_cache.set(email, principal.json())
+
+    return principal
+
+async def invalidate_principal(email: str):
+    await principal_cache.delete(email)
 
 async def authenticate_user(user_email: str, password: str, db: AsyncSession):
     user = await get_single_user(db, user_email)
     
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password_async(password, user.hashed_password):
         return False
     if user.is_active == False:
         return False
@@ -93,9 +295,13 @@ async def authenticate_user(user_email: str, password: str, db: AsyncSession):
     return user
 
 async def active_user(user_email: str, verify_code: str, db: AsyncSession):
-    user_code = redis_client.get(user_email).decode("utf-8")
+    user_code = await get_redis().get(user_email)
 
-    if user_code == verify_code:
+    # code is expired or user never registered
+    if user_code is None:
+        return False
+
+    if user_code.decode("utf-8") == verify_code:
         stmt = (
             update(User).
             where(User.email == user_email).
@@ -103,6 +309,7 @@ async def active_user(user_email: str, verify_code: str, db: AsyncSession):
         )
         await db.execute(stmt)
         await db.commit()
+        await invalidate_principal(user_email)
         return True
     else:
         return False
@@ -112,23 +319,25 @@ async def change_user_password(password: str, db: AsyncSession, current_user: Us
     stmt = (
         update(User)
         .where(User.email == current_user.email)
-        .values(hashed_password = hash_password(password))
+        .values(hashed_password = await hash_password_async(password))
     )
 
     try:
         await db.execute(stmt)
         await db.commit()
+        await invalidate_principal(current_user.email)
         return True
     except IntegerError:
         return False
 
-async def forgot_password(user_email: str, db: AsyncSession, background_task: BackgroundTasks):
+async def forgot_password(user_email: str, db: AsyncSession):
     random_password = _random_string()
-    new_hashed_password = hash_password(random_password)
+    new_hashed_password = await hash_password_async(random_password)
 
     try:
-        send_email_background(
-            background_task,
+        # committed with the new password below, the user never get a password which was not saved
+        queue_email(
+            db,
             "Forgot password email!",
             user_email,
             {
@@ -156,8 +365,9 @@ async def forgot_password(user_email: str, db: AsyncSession, background_task: Ba
     except IntegerError:
         return False
 
+# only check the user exists, get_single_user would also load every post and liked post of the user
 async def verify_user(user_email: str, db: AsyncSession):
-    user_check = await get_single_user(db, user_email)
+    user_check = (await db.execute(select(User.id).filter(User.email == user_email))).scalar()
 
     if not user_check:
         raise HTTPException(
@@ -166,15 +376,48 @@ async def verify_user(user_email: str, db: AsyncSession):
 
 
 async def delete_user(user_email: str, db: AsyncSession):
+    # link_user_post has no ON DELETE CASCADE, so likes which would block the delete are removed here, in the same transaction:
+    # - likes of this user, like_count of those posts is decreased first
+    # - likes of posts of this user, those posts are deleted by the cascade of posts.owner_email
+    user_id = select(User.id).where(User.email == user_email).scalar_subquery()
+    liked_post_ids = select(Link_User_Post.post_id).where(Link_User_Post.user_id == user_id)
+    own_post_ids = select(Post.id).where(Post.owner_email == user_email)
+
+    # they are removed from post cache and search index once the delete is committed
+    deleted_post_ids = (await db.execute(own_post_ids)).scalars().all()
+    unliked_post_ids = (await db.execute(liked_post_ids)).scalars().all()
+
+    stmt = (
+        update(Post)
+        .where(Post.id.in_(liked_post_ids))
+        .values(like_count=Post.like_count - 1, date_last_activity=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    await db.execute(stmt)
+
+    stmt = (
+        delete(Link_User_Post)
+        .where(or_(Link_User_Post.user_id == user_id, Link_User_Post.post_id.in_(own_post_ids)))
+        .execution_options(synchronize_session=False)
+    )
+    await db.execute(stmt)
+
     stmt = delete(User).filter(User.email == user_email)
 
     try:
         await db.execute(stmt)
         await db.commit()
-        return True
-    except IntegerError:
+    except exc.IntegrityError:
+        await db.rollback()
         return False
 
+    await invalidate_principal(user_email)
+    for post_id in deleted_post_ids:
+        search_index.unindex_post(post_id)
+    for post_id in (*deleted_post_ids, *unliked_post_ids):
+        await posts_services.invalidate_post_cache(post_id)
+    return True
+
 
 async def admin_active_user(user_email: str, db: AsyncSession):
 
@@ -189,6 +432,7 @@ async def admin_active_user(user_email: str, db: AsyncSession):
     try:
         await db.execute(stmt)
         await db.commit()
+        await invalidate_principal(user_email)
     except IntegerError:
         return None
 
@@ -1,7 +1,23 @@
+import csv
+import io
+import json
 import string
 import random
+import asyncio
+import threading
+import pytest
+import aiosmtplib
+from datetime import datetime, timedelta
+from fastapi import HTTPException, Request
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
 
-from blog_api.schemas import User
+from blog_api import http_cache, replicas, services
+from blog_api.models import EmailOutbox, Link_User_Post, Post
+from blog_api.posts import posts_services, search_index
+from blog_api.schemas import PostCreate, User, UserCreated
+from blog_api.users import email_worker, hashing_services, send_email_services, users_services
+from . import helper
 
 
 def test_get_all_users(user_db, client):
@@ -10,10 +26,24 @@ def test_get_all_users(user_db, client):
 
     assert response.status_code == 200
 
-    response_orm = [User.parse_obj(x) for x in response.json()]
-    user_db_orm = [User.from_orm(x) for x in user_db]
+    # posts and posts_like are not embedded by default
+    response_orm = [User.parse_obj(x) for x in response.json()["items"]]
+    user_db_orm = [
+        User(id=x.id, email=x.email, is_active=x.is_active, role=x.role) for x in user_db
+    ]
 
     assert response_orm == user_db_orm
+    assert response.json()["next_cursor"] is None
+
+
+def test_get_all_users_paging(user_db, client):
+    size = max(len(user_db) - 1, 1)
+
+    first_page = client.get("/users/", params={"size": size}).json()
+    second_page = client.get("/users/", params={"size": size, "after": first_page["next_cursor"]}).json()
+
+    emails = [x["email"] for x in first_page["items"] + second_page["items"]]
+    assert emails == [x.email for x in user_db]
 
 
 # Note: don't specify id in data json file, because when we create new instance from User class, it's primary key will count from 1
@@ -29,6 +59,95 @@ def test_create_user(user_db, client):
     assert response.json()["email"] == sample_user["email"]
 
 
+
+# the only worker of the pool is busy and queue is empty, so the next job is rejected instead of waiting
+async def test_password_hasher_saturation():
+    hasher = hashing_services.PasswordHasher("thread", 1, 0)
+    release = threading.Event()
+    running = asyncio.ensure_future(hasher._run(release.wait))
+    await asyncio.sleep(0)
+
+    try:
+        with pytest.raises(HTTPException) as error:
+            await hasher.hash("password")
+    finally:
+        release.set()
+        await running
+        hasher.shutdown()
+
+    assert error.value.status_code == 503
+    assert error.value.headers == {"Retry-After": "1"}
+    assert hasher.stats.rejected == 1
+    assert hasher.pending == 0
+
+
+def test_create_user_password_hasher_busy(client, monkeypatch):
+    hasher = hashing_services.password_hasher
+    monkeypatch.setattr(hasher, "pending", hasher.pool_size + hasher.max_queue)
+
+    response = client.post("/users/", json={"email": _random_string() + "@mailinator.com", "password": "password"})
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+
+
+# bcrypt of a process pool is not needed by those tests, a thread is enough
+@pytest.fixture
+def bulk_password_hasher(monkeypatch):
+    hasher = hashing_services.PasswordHasher("thread", 1, 0)
+    monkeypatch.setattr(hashing_services, "bulk_password_hasher", hasher)
+
+    yield hasher
+
+    hasher.shutdown()
+
+
+def test_bulk_create_users_report(user_db, admin_db, client, bulk_password_hasher):
+    email = _random_string() + "@mailinator.com"
+    users = [
+        {"email": email, "password": "password"},
+        {"email": "not an email", "password": "password"},
+        {"email": email, "password": "password"},
+        {"email": user_db[0].email, "password": "password"},
+    ]
+
+    response = client.post("/users/bulk", json=users, headers=helper.auth_headers(admin_db.email, "admin"))
+
+    assert response.status_code == 201
+    report = response.json()
+    assert (report["created"], report["failed"]) == (1, 3)
+    rows = report["rows"]
+    assert [(row["row"], row["success"]) for row in rows] == [(0, True), (1, False), (2, False), (3, False)]
+    assert rows[0]["id"] == client.get(f"/users/{email}/").json()["id"]
+    assert "invalid" in rows[1]["detail"]
+    assert "duplicated" in rows[2]["detail"]
+    assert "already exist" in rows[3]["detail"]
+
+
+def test_bulk_create_users_limit_and_admin_only(user_db, admin_db, client, monkeypatch):
+    monkeypatch.setattr(users_services, "MAX_BULK_IMPORT_USERS", 1)
+    users = [{"email": f"{_random_string()}@mailinator.com", "password": "password"} for _ in range(2)]
+
+    response = client.post("/users/bulk", json=users, headers=helper.auth_headers(admin_db.email, "admin"))
+    assert response.status_code == 413
+
+    response = client.post("/users/bulk", json=users[:1], headers=helper.auth_headers(user_db[0].email))
+    assert response.status_code == 401
+    # admin scope in token is not enough, user must be an admin
+    response = client.post("/users/bulk", json=users[:1], headers=helper.auth_headers(user_db[0].email, "admin"))
+    assert response.status_code == 401
+
+
+# a second import wait for the first one instead of being rejected by the pool in the middle of its batch
+async def test_bulk_password_hashing_one_import_at_a_time(bulk_password_hasher):
+    first, second = await asyncio.gather(
+        hashing_services.hash_passwords_bulk(["first"]), hashing_services.hash_passwords_bulk(["second"])
+    )
+
+    assert hashing_services.verify_password("first", first[0])
+    assert hashing_services.verify_password("second", second[0])
+    assert bulk_password_hasher.stats.rejected == 0
+
 def test_get_single_user(user_db, client):
     user_sample = random.choice(user_db)
 
@@ -38,6 +157,655 @@ def test_get_single_user(user_db, client):
         assert getattr(user_sample, k) == v
 
 
+def test_metrics(user_db, client):
+    client.get("/users/")
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert 'http_requests_total{method="GET",route="/users/",status="200"}' in response.text
+    assert "http_request_db_statements_bucket" in response.text
+
+
+# posts page load comments and likes of the whole page at once, query count doesn't grow with page size
+# comments and their replies of the whole page are loaded in batch, query count doesn't grow with page size
+def test_get_all_posts_query_budget(post_db, client, query_budget):
+    query_counts = []
+    for size in (5, len(post_db)):
+        with query_budget(4, max_repeats=1) as counter:
+            response = client.get(f"/posts?size={size}")
+
+        assert response.status_code == 200
+        assert len(response.json()) == size
+        assert all(
+            [(comment["body"], len(comment["children"])) for comment in post["comments"]] == [("comment", 1)]
+            for post in response.json()
+        )
+        query_counts.append(len(counter))
+
+    assert query_counts[0] == query_counts[1]
+
+
+def test_get_post_single_query_budget(post_db, client, query_budget):
+    with query_budget(4, max_repeats=1):
+        response = client.get(f"/posts/{post_db[0].id}")
+
+    assert response.status_code == 200
+    assert [reply["body"] for reply in response.json()["comments"][0]["children"]] == ["reply"]
+
+
+def test_get_posts_from_one_user_query_budget(post_db, client, query_budget):
+    with query_budget(4, max_repeats=1):
+        response = client.get(f"/posts/{post_db[0].owner_email}/posts/")
+
+    assert response.status_code == 200
+    assert all(len(post["comments"][0]["children"]) == 1 for post in response.json())
+
+
+
+# ids are returned in the input order, every chunk of chunk_size rows is reported
+def test_bulk_create_posts(user_db, client):
+    headers = helper.auth_headers(user_db[0].email)
+    posts = [{"title": f"bulk {number}", "content": "content"} for number in range(5)]
+
+    response = client.post("/posts/bulk?chunk_size=2", json=posts, headers=headers)
+    assert response.status_code == 201
+    body = response.json()
+    assert body["count"] == 5
+    assert [chunk["rows"] for chunk in body["chunks"]] == [2, 2, 1]
+    assert [client.get(f"/posts/{post_id}").json()["title"] for post_id in body["ids"]] == [
+        post["title"] for post in posts
+    ]
+
+
+def test_bulk_create_posts_ndjson(user_db, client):
+    headers = {**helper.auth_headers(user_db[0].email), "content-type": "application/x-ndjson"}
+    # blank lines are skipped and the last line doesn't need a line break
+    lines = ['{"title": "ndjson 0", "content": "content"}', "", '{"title": "ndjson 1", "content": "content"}']
+
+    response = client.post("/posts/bulk", data="\n".join(lines), headers=headers)
+    assert response.status_code == 201
+    body = response.json()
+    assert body["count"] == 2
+    assert [chunk["rows"] for chunk in body["chunks"]] == [2]
+    assert [client.get(f"/posts/{post_id}").json()["title"] for post_id in body["ids"]] == ["ndjson 0", "ndjson 1"]
+
+
+def test_bulk_create_posts_invalid(user_db, client):
+    headers = {**helper.auth_headers(user_db[0].email), "content-type": "application/x-ndjson"}
+
+    response = client.post("/posts/bulk", data='{"title": "title", "content": "content"}\n{"title": ', headers=headers)
+    assert response.status_code == 422
+    assert response.json()["detail"] == "Post number 2 is not a valid JSON!"
+
+    response = client.post("/posts/bulk", data='{"title": "title"}', headers=headers)
+    assert response.status_code == 422
+    assert response.json()["detail"].startswith("Post number 1 is invalid")
+
+    headers = helper.auth_headers(user_db[0].email)
+    response = client.post("/posts/bulk", json={"title": "title", "content": "content"}, headers=headers)
+    assert response.status_code == 422
+    assert response.json()["detail"] == "Body must be a JSON array of posts!"
+
+
+# only requested fields are returned, in the same order as the schema
+def test_get_posts_fields(post_db, user_db, client):
+    response = client.get("/posts", params={"size": 3, "fields": "like_count,title"})
+    assert response.status_code == 200
+    assert [list(post) for post in response.json()] == [["title", "like_count"]] * 3
+
+    response = client.get("/posts", params={"size": 3, "paging": "cursor", "fields": "id"})
+    assert response.status_code == 200
+    assert [list(post) for post in response.json()["items"]] == [["id"]] * 3
+    assert response.json()["next_cursor"]
+
+    post = post_db[0]
+    response = client.get(f"/posts/{post.id}", params={"fields": "title,like,comments"})
+    assert response.status_code == 200
+    body = response.json()
+    assert list(body) == ["title", "comments", "like"]
+    assert body["title"] == post.title
+    assert [user["email"] for user in body["like"]] == [user_db[1].email]
+    assert body["comments"][0]["children"][0]["body"] == "reply"
+
+    response = client.get(f"/posts/{post.owner_email}/posts/", params={"fields": "id,owner_email"})
+    assert response.status_code == 200
+    assert {(item["owner_email"], len(item)) for item in response.json()} == {(post.owner_email, 2)}
+
+
+def test_get_posts_unknown_fields(post_db, client):
+    post = post_db[0]
+    assert client.get("/posts", params={"fields": "title,password"}).status_code == 400
+    # like is a field of Post, not of PostSummary of listing
+    assert client.get("/posts", params={"fields": "like"}).status_code == 400
+    assert client.get(f"/posts/{post.id}", params={"fields": "unknown"}).status_code == 400
+    assert client.get(f"/posts/{post.owner_email}/posts/", params={"fields": "unknown"}).status_code == 400
+
+
+def test_get_post_not_modified(post_db, client):
+    post_id = post_db[0].id
+    response = client.get(f"/posts/{post_id}")
+    assert response.status_code == 200
+    etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+
+    response = client.get(f"/posts/{post_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert not response.content
+
+    response = client.get(f"/posts/{post_id}", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+    # If-None-Match take precedence, a stale ETag is answered in full even if date is recent
+    response = client.get(f"/posts/{post_id}", headers={"If-None-Match": '"stale"', "If-Modified-Since": last_modified})
+    assert response.status_code == 200
+
+    earlier = http_cache.http_date(datetime.utcnow() - timedelta(days=1))
+    assert client.get(f"/posts/{post_id}", headers={"If-Modified-Since": earlier}).status_code == 200
+
+    response = client.get("/posts", params={"size": 3})
+    response = client.get("/posts", params={"size": 3}, headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+
+
+# like and comment change date_last_activity of post, so the ETag of post and of listing change too
+def test_get_post_etag_changed_by_like_and_comment(post_db, user_db, client):
+    post_id = post_db[0].id
+    headers = helper.auth_headers(user_db[2].email)
+    etags = {client.get(f"/posts/{post_id}").headers["etag"]}
+    list_etags = {client.get("/posts").headers["etag"]}
+
+    assert client.post(f"/posts/{post_id}/like", headers=headers).status_code == 200
+    etags.add(client.get(f"/posts/{post_id}").headers["etag"])
+    list_etags.add(client.get("/posts").headers["etag"])
+
+    assert client.post(f"/posts/{post_id}/comment", params={"body": "new"}, headers=headers).status_code == 201
+    response = client.get(f"/posts/{post_id}", headers={"If-None-Match": ",".join(etags)})
+    assert response.status_code == 200
+    etags.add(response.headers["etag"])
+    list_etags.add(client.get("/posts").headers["etag"])
+
+    assert len(etags) == 3
+    assert len(list_etags) == 3
+
+# every page continue after the last post of previous one, no post is skipped or returned twice
+def test_get_all_posts_cursor_paging(post_db, user_db, client):
+    headers = helper.auth_headers(user_db[0].email)
+    new_post = client.post("/posts", json={"title": "title", "content": "content"}, headers=headers).json()
+
+    items, after = [], None
+    while True:
+        params = {"size": 4, "paging": "cursor"}
+        if after:
+            params["after"] = after
+        response = client.get("/posts", params=params)
+        assert response.status_code == 200
+        items += response.json()["items"]
+        after = response.json()["next_cursor"]
+        if not after:
+            break
+
+    ids = [item["id"] for item in items]
+    assert sorted(ids) == sorted([post.id for post in post_db] + [new_post["id"]])
+    assert len(set(ids)) == len(ids)
+    assert [(item["date_created"], item["id"]) for item in items] == sorted((item["date_created"], item["id"]) for item in items)
+    # date_created is the time of insert, not a time shared by every post of the process
+    assert ids[-1] == new_post["id"]
+    assert items[-1]["date_created"] > items[0]["date_created"]
+
+    response = client.get("/posts", params={"paging": "cursor", "after": "not a cursor"})
+    assert response.status_code == 400
+
+# search_value without search_field can't be answered by any search mode
+def test_get_all_posts_search_without_field(post_db, client, monkeypatch):
+    monkeypatch.setattr(search_index, "POST_SEARCH_INDEX_ENABLED", True)
+    monkeypatch.setattr(search_index.post_search_index, "ready", True)
+    assert not search_index.is_available(None)
+
+    for mode in ("ilike", "index"):
+        response = client.get(f"/posts?search_value=title&search_mode={mode}")
+        assert response.status_code == 422
+
+    response = client.get("/posts?search_field=title&search_value=title&search_mode=ilike")
+    assert response.status_code == 200
+
+async def _search_titles(db, search_value, operation):
+    return [record.title for record in await posts_services.get_all_posts(
+        db,
+        search_field="title",
+        search_value=search_value,
+        operation=operation,
+        search_mode=posts_services.SearchModeEnum.FULLTEXT,
+    ) or []]
+
+
+async def _add_titled_posts(db, email, titles):
+    db.add_all([Post(title=title, content="content", owner_email=email) for title in titles])
+    await db.commit()
+
+
+# "+" separate terms, they are joined by operation, on sqlite full text search fall back to ilike
+async def test_get_all_posts_fulltext_search(user_db, async_session):
+    await _add_titled_posts(async_session, user_db[0].email, ["alpha beta", "alpha", "beta", "gamma"])
+
+    assert sorted(await _search_titles(async_session, "alpha + beta", posts_services.OperatorEnum.OR)) == ["alpha", "alpha beta", "beta"]
+    assert await _search_titles(async_session, "alpha + beta", posts_services.OperatorEnum.AND) == ["alpha beta"]
+    assert await _search_titles(async_session, "delta", posts_services.OperatorEnum.OR) == []
+
+
+# posts which match more terms come first, ties are ordered by id
+async def test_get_all_posts_fulltext_search_ranking(user_db, async_session):
+    if services.dialect_name(async_session) != "postgresql":
+        pytest.skip("full text ranking need postgres")
+    await _add_titled_posts(async_session, user_db[0].email, ["alpha", "beta", "alpha beta", "gamma"])
+
+    assert await _search_titles(async_session, "alpha + beta", posts_services.OperatorEnum.OR) == ["alpha beta", "alpha", "beta"]
+
+
+# the first read fill post cache, the next one is a hit, a full cache evict the least recently used post
+async def test_post_cache_hit_miss_eviction(post_db, async_session, post_cache, monkeypatch):
+    first_id, second_id = post_db[0].id, post_db[1].id
+
+    post = await posts_services.get_post_single_cached(async_session, first_id)
+    assert post.id == first_id
+    assert await posts_services.get_post_single_cached(async_session, first_id) == post
+    assert post_cache.stats.dict() == {"hits": 1, "misses": 1, "evictions": 0}
+
+    monkeypatch.setattr(post_cache, "max_size", 1)
+    await posts_services.get_post_single_cached(async_session, second_id)
+    assert post_cache.stats.evictions == 1
+    assert list(post_cache._items) == [str(second_id)]
+
+
+async def test_post_cache_invalidated_by_writes(post_db, user_db, async_session, post_cache):
+    post_id, user = post_db[0].id, user_db[0]
+    writes = (
+        lambda: posts_services.update_post(post_id, PostCreate(title="new title", content="new content"), async_session),
+        lambda: posts_services.create_post_like(user.id, post_id, async_session),
+        lambda: posts_services.create_post_comment(user.email, post_id, "new comment", None, async_session),
+    )
+    for write in writes:
+        await posts_services.get_post_single_cached(async_session, post_id)
+        assert str(post_id) in post_cache._items
+
+        await write()
+        assert str(post_id) not in post_cache._items
+
+    # like a new request, not the objects which were changed in this session
+    async_session.expunge_all()
+    post = await posts_services.get_post_single_cached(async_session, post_id)
+    assert post.title == "new title"
+    assert len(post.like) == 2
+    assert len(post.comments) == 2
+
+
+
+async def test_update_post_utc_dates(post_db, async_session):
+    post = await posts_services.update_post(post_db[0].id, PostCreate(title="title", content="content"), async_session)
+
+    assert post.date_last_update == post.date_last_activity
+    assert abs(datetime.utcnow() - post.date_last_update) < timedelta(minutes=1)
+
+# post cache of every worker is only cleared by writes of that worker, write endpoints must not trust it
+def test_write_post_deleted_by_other_worker(user_db, client, monkeypatch):
+    headers = helper.auth_headers(user_db[0].email)
+    post_id = client.post("/posts", json={"title": "title", "content": "content"}, headers=headers).json()["id"]
+    assert client.get(f"/posts/{post_id}").status_code == 200
+
+    async def invalidate_other_worker(post_id):
+        pass
+
+    monkeypatch.setattr(posts_services, "invalidate_post_cache", invalidate_other_worker)
+    assert client.delete(f"/posts/{post_id}", headers=headers).status_code == 200
+    assert str(post_id) in posts_services.post_cache._items
+
+    assert client.patch(f"/posts/{post_id}", json={"title": "new", "content": "new"}, headers=headers).status_code == 400
+    assert client.post(f"/posts/{post_id}/like", headers=headers).status_code == 400
+    assert client.post(f"/posts/{post_id}/comment", params={"body": "comment"}, headers=headers).status_code == 400
+
+
+# like, unlike then like again, like_count follow link_user_post
+async def test_create_post_like_toggle(post_db, user_db, async_session):
+    post_id, user = post_db[0].id, user_db[0]
+
+    for expected_liked, expected_count in ((True, 2), (False, 1), (True, 2)):
+        assert await posts_services.create_post_like(user.id, post_id, async_session) is expected_liked
+        post = (await async_session.execute(select(Post).where(Post.id == post_id))).scalar_one()
+        await async_session.refresh(post)
+        assert post.like_count == expected_count
+
+
+
+# posts of populate_post are liked by another user, the like doesn't block the delete
+def test_delete_post_with_likes(post_db, client):
+    post = post_db[0]
+    headers = helper.auth_headers(post.owner_email)
+
+    assert client.delete(f"/posts/{post.id}", headers=headers).status_code == 200
+    assert client.get(f"/posts/{post.id}").status_code == 400
+
+
+# populated post has a comment with one reply, a second thread get 5 replies and a nested reply
+async def test_get_comment_page_replies(post_db, user_db, async_session):
+    post_id, email = post_db[0].id, user_db[0].email
+    thread = await posts_services.create_post_comment(email, post_id, "thread", None, async_session)
+    replies = [
+        await posts_services.create_post_comment(email, post_id, f"reply {number}", thread.id, async_session)
+        for number in range(5)
+    ]
+    await posts_services.create_post_comment(email, post_id, "nested", replies[0].id, async_session)
+
+    items, next_cursor = await posts_services.get_comment_page(async_session, post_id, None, size=1, replies_size=2)
+    assert [item.body for item in items] == ["comment"]
+    assert (items[0].replies_count, items[0].replies_cursor) == (1, None)
+
+    items, next_cursor = await posts_services.get_comment_page(
+        async_session, post_id, None, size=1, after=next_cursor, replies_size=2
+    )
+    assert next_cursor is None
+    assert items[0].id == thread.id
+    assert items[0].replies_count == 5
+    assert [(reply.body, reply.replies_count) for reply in items[0].children] == [("reply 0", 1), ("reply 1", 0)]
+
+    # the rest of replies continue after replies_cursor
+    items, next_cursor = await posts_services.get_comment_page(
+        async_session, post_id, thread.id, size=10, after=items[0].replies_cursor, replies_size=0
+    )
+    assert [item.body for item in items] == ["reply 2", "reply 3", "reply 4"]
+    assert next_cursor is None
+
+
+def test_get_comment_replies_unknown_ids(post_db, client):
+    post_id, other_post_id = post_db[0].id, post_db[1].id
+    comment_id = client.get(f"/posts/{post_id}/comment").json()[0]["id"]
+
+    response = client.get(f"/posts/{post_id}/comment/{comment_id}/replies")
+    assert response.status_code == 200
+    assert [item["body"] for item in response.json()["items"]] == ["reply"]
+
+    assert client.get(f"/posts/{other_post_id}/comment/{comment_id}/replies").status_code == 400
+    assert client.get(f"/posts/{post_id}/comment/0/replies").status_code == 400
+    assert client.get(f"/posts/0/comment/{comment_id}/replies").status_code == 400
+
+
+# first thread of a post followed down through its first reply at every level
+def _first_comment_chain(client, post_id: int):
+    chain = []
+    comments = client.get(f"/posts/{post_id}/comment").json()
+    while comments:
+        chain.append(comments[0])
+        comments = comments[0]["children"]
+    return chain
+
+
+def test_create_comment_deep_replies(post_db, client, monkeypatch):
+    monkeypatch.setattr(posts_services, "MAX_COMMENT_DEPTH", 4)
+    post = post_db[0]
+    headers = helper.auth_headers(post.owner_email)
+
+    # populated thread has 2 levels, replies go down to the limit
+    for level in (3, 4):
+        parent_id = _first_comment_chain(client, post.id)[-1]["id"]
+        response = client.post(
+            f"/posts/{post.id}/comment", params={"body": f"level {level}", "parent_id": parent_id}, headers=headers
+        )
+        assert response.status_code == 201
+
+    chain = _first_comment_chain(client, post.id)
+    assert [comment["body"] for comment in chain] == ["comment", "reply", "level 3", "level 4"]
+
+    response = client.post(
+        f"/posts/{post.id}/comment", params={"body": "level 5", "parent_id": chain[-1]["id"]}, headers=headers
+    )
+    assert response.status_code == 400
+    assert len(_first_comment_chain(client, post.id)) == 4
+
+
+def test_create_comment_parent_from_other_post(post_db, client):
+    post, other_post = post_db[0], post_db[1]
+    headers = helper.auth_headers(post.owner_email)
+    parent_id = _first_comment_chain(client, other_post.id)[0]["id"]
+
+    response = client.post(f"/posts/{post.id}/comment", params={"body": "reply", "parent_id": parent_id}, headers=headers)
+    assert response.status_code == 400
+
+    response = client.post(f"/posts/{post.id}/comment", params={"body": "reply", "parent_id": 0}, headers=headers)
+    assert response.status_code == 400
+
+
+# deleting a reply delete all replies below it, its parent is kept
+def test_delete_comment_subtree(post_db, client):
+    post = post_db[0]
+    headers = helper.auth_headers(post.owner_email)
+    parent_id = _first_comment_chain(client, post.id)[-1]["id"]
+    client.post(f"/posts/{post.id}/comment", params={"body": "level 3", "parent_id": parent_id}, headers=headers)
+    top, reply, deepest = _first_comment_chain(client, post.id)
+
+    response = client.delete(f"/posts/{post.id}/comment/{reply['id']}", headers=headers)
+    assert response.status_code == 200
+
+    assert [comment["id"] for comment in _first_comment_chain(client, post.id)] == [top["id"]]
+    assert client.get(f"/posts/{post.id}/comment/{deepest['id']}/replies").status_code == 400
+
+
+def test_export_posts_ndjson(post_db, client, monkeypatch):
+    monkeypatch.setattr(posts_services, "EXPORT_BATCH_SIZE", 4)
+
+    response = client.get("/posts/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["id"] for row in rows] == sorted(post.id for post in post_db)
+    assert list(rows[0]) == list(posts_services.EXPORT_COLUMNS)
+    assert rows[0]["title"] == min(post_db, key=lambda post: post.id).title
+
+
+def test_export_posts_csv(post_db, client):
+    response = client.get("/posts/export", params={"format": "csv", "search_field": "title", "search_value": "Post 1"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    expected = sorted((post for post in post_db if post.title.startswith("Post 1 ")), key=lambda post: post.id)
+    assert [(int(row["id"]), row["title"]) for row in rows] == [(post.id, post.title) for post in expected]
+
+
+# an interrupted export is resumed from the last id which was received, nothing is sent twice
+def test_export_posts_resume_after_id(post_db, client):
+    post_ids = sorted(post.id for post in post_db)
+    after_id = post_ids[9]
+
+    response = client.get("/posts/export", params={"after_id": after_id})
+    assert response.status_code == 200
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == post_ids[10:]
+
+# user_db[1] like posts of user_db[0] and posts of user_db[1] are liked by user_db[2]
+async def test_delete_user_with_likes(post_db, user_db, async_session):
+    liked_owner, deleted = user_db[0], user_db[1]
+
+    assert await users_services.delete_user(deleted.email, async_session)
+
+    posts = (await async_session.execute(select(Post).where(Post.owner_email == liked_owner.email))).scalars().all()
+    for post in posts:
+        await async_session.refresh(post)
+    assert posts and all(post.like_count == 0 for post in posts)
+    assert not (await async_session.execute(select(Post).where(Post.owner_email == deleted.email))).scalars().all()
+    likes = await async_session.execute(select(Link_User_Post).where(Link_User_Post.user_id == deleted.id))
+    assert not likes.scalars().all()
+
+
+
+async def _enable_search_index(db, monkeypatch):
+    index = search_index.PostSearchIndex()
+    monkeypatch.setattr(search_index, "POST_SEARCH_INDEX_ENABLED", True)
+    monkeypatch.setattr(search_index, "post_search_index", index)
+    return await search_index.build_post_search_index(db, index)
+
+
+def test_post_search_index():
+    index = search_index.PostSearchIndex()
+    index.add(1, "hello world", "first")
+    index.add(2, "hello", "second")
+    index.add(3, "world", "third")
+
+    assert list(index.search("title", ["hello", "world"], use_and=False)) == [1, 2, 3]
+    assert list(index.search("title", ["hello", "world"], use_and=False, limit=2)) == [1, 2]
+    assert list(index.search("title", ["hello", "world"], use_and=True)) == [1]
+    # words of one term must all match
+    assert list(index.search("title", ["hello world"], use_and=False)) == [1]
+    assert list(index.search("content", ["second"], use_and=False)) == [2]
+
+    index.update(2, "goodbye", "second")
+    assert list(index.search("title", ["hello"], use_and=False)) == [1]
+    assert list(index.search("title", ["goodbye"], use_and=False)) == [2]
+
+    index.remove(1)
+    assert list(index.search("title", ["hello", "world"], use_and=False)) == [3]
+    assert "hello" not in index.postings["title"]
+    assert len(index) == 2
+
+
+# posts deleted by the cascade of a deleted user leave search index and post cache
+async def test_delete_user_unindex_posts(post_db, user_db, async_session, post_cache, monkeypatch):
+    index = await _enable_search_index(async_session, monkeypatch)
+    deleted = user_db[1]
+    deleted_ids = [post.id for post in post_db if post.owner_email == deleted.email]
+    await posts_services.get_post_single_cached(async_session, deleted_ids[0])
+
+    assert await users_services.delete_user(deleted.email, async_session)
+
+    assert not set(deleted_ids) & set(index.search("title", ["post"], use_and=False))
+    assert str(deleted_ids[0]) not in post_cache._items
+    size = len(post_db) - len(deleted_ids)
+    records = await posts_services.get_all_posts(
+        async_session, size, 1, "title", "post", search_mode=posts_services.SearchModeEnum.INDEX
+    )
+    assert len(records) == size
+
+
+# export hydrate matched ids by batches, after_id is applied before
+async def test_export_posts_search_index(post_db, async_session, monkeypatch):
+    await _enable_search_index(async_session, monkeypatch)
+    monkeypatch.setattr(posts_services, "EXPORT_BATCH_SIZE", 4)
+    after_id = sorted(post.id for post in post_db)[2]
+
+    batches = [
+        batch async for batch in posts_services.export_posts(
+            async_session, "title", "post", search_mode=posts_services.SearchModeEnum.INDEX, after_id=after_id
+        )
+    ]
+
+    assert all(len(batch) <= 4 for batch in batches)
+    assert [row["id"] for batch in batches for row in batch] == sorted(post.id for post in post_db if post.id > after_id)
+
+
+# one fake replica, it is never queried so an engine without tables is enough
+@pytest.fixture
+async def replica_router(async_engine, monkeypatch):
+    replica = create_async_engine("sqlite+aiosqlite://")
+    router = replicas.ReplicaRouter(async_engine, [replica], sticky_seconds=5)
+    monkeypatch.setattr(replicas, "db_router", router)
+
+    yield router
+
+    await replica.dispose()
+
+
+async def test_replica_read_routing(replica_router):
+    replica = replica_router.replicas[0]
+    assert await replica_router.engine_for("client") is replica
+    assert await replica_router.engine_for(None) is replica
+
+    replica_router.healthy[replica] = False
+    assert await replica_router.engine_for("client") is replica_router.primary
+
+
+# a request which committed a write send the next reads of the same client to primary, other clients keep the replica
+async def test_replica_primary_sticky_after_write(replica_router, post_db, user_db, async_session, fake_redis):
+    async def write_app(scope, receive, send):
+        replicas.track_writes(async_session)
+        await posts_services.create_post_like(user_db[0].id, post_db[0].id, async_session)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def read_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def call(app, authorization: bytes):
+        scope = {"type": "http", "method": "POST", "path": "/", "headers": [(b"authorization", authorization)]}
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await replicas.ReplicaStickyMiddleware(app)(scope, None, send)
+        return messages
+
+    key = replicas.client_key(Request({"type": "http", "headers": [(b"authorization", b"Bearer writer")]}))
+    await call(read_app, b"Bearer writer")
+    assert await replica_router.engine_for(key) is replica_router.replicas[0]
+
+    await call(write_app, b"Bearer writer")
+    assert 0 < await fake_redis.pttl(replicas.REPLICA_STICKY_KEY_PREFIX + key) <= 5000
+    assert await replica_router.engine_for(key) is replica_router.primary
+    assert await replica_router.engine_for("other client") is replica_router.replicas[0]
+
+    # stickiness end with the marker
+    await fake_redis.delete(replicas.REPLICA_STICKY_KEY_PREFIX + key)
+    assert await replica_router.engine_for(key) is replica_router.replicas[0]
+
+# principals are cached in redis which every worker share, deleting a user drop it for all of them
+async def test_delete_user_invalidate_shared_principal(user_db, async_session, fake_redis):
+    email = user_db[0].email
+    principal = await users_services.get_principal(async_session, email)
+    assert await fake_redis.get(f"cache:principal:{email}") == principal.json().encode()
+    assert await users_services.get_principal(async_session, email) == principal
+
+    assert await users_services.delete_user(email, async_session)
+
+    assert await fake_redis.get(f"cache:principal:{email}") is None
+    assert await users_services.get_principal(async_session, email) is None
+
+# the verification email is written with the user and sent by the worker, here to the in memory transport
+async def test_create_user_send_email_from_outbox(async_session):
+    email = _random_string() + "@mailinator.com"
+    await users_services.create_user(async_session, UserCreated(email=email, password=_random_string()))
+
+    transport = email_worker.MemoryTransport()
+    assert await email_worker.process_batch(async_session, transport) == 1
+
+    assert [message["To"] for message in transport.messages] == [email]
+    message = transport.messages[0]
+    assert message["Subject"] == "Verifycation Account Email!"
+    assert message["From"].endswith(f"<{send_email_services.conf.MAIL_FROM}>")
+    assert message.get_content_type() == "text/html"
+    assert "Verifycation Account Email!" in message.get_content()
+    outbox = (await async_session.execute(select(EmailOutbox))).scalar_one()
+    assert outbox.status == send_email_services.EmailStatusEnum.sent
+    assert outbox.attempts == 1
+    assert outbox.body is None
+
+
+class _DisconnectedTransport:
+    async def send(self, message):
+        raise aiosmtplib.SMTPServerDisconnected("Connection lost")
+
+
+async def test_email_worker_retry_with_backoff(async_session):
+    send_email_services.queue_email(async_session, "Subject", "retry@mailinator.com", {"title": "Title", "code": "code"})
+    await async_session.commit()
+
+    assert await email_worker.process_batch(async_session, _DisconnectedTransport()) == 1
+    # not due before the backoff delay
+    assert await email_worker.process_batch(async_session, email_worker.MemoryTransport()) == 0
+
+    outbox = (await async_session.execute(select(EmailOutbox))).scalar_one()
+    assert outbox.status == send_email_services.EmailStatusEnum.pending
+    assert outbox.attempts == 1
+    assert outbox.next_attempt_at > datetime.utcnow()
+    assert "Connection lost" in outbox.last_error
+
+
 def _random_string():
     letters = string.ascii_letters
     result = ''.join(random.choice(letters) for _ in range(10))
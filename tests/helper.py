@@ -1,11 +1,17 @@
 import json
+import random
+import fakeredis
+from jose import jwt
+from functools import lru_cache
+from sqlalchemy import insert, text
 from sqlalchemy.ext.asyncio import AsyncSession
 # ??? Path library
 from pathlib import Path
-from typing import Any, Dict, List, Union, Optional
-from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Union, Optional, Tuple
+from datetime import datetime, timedelta
 
-from blog_api.models import User
+from blog_api.helper import ALGORITHM, SECRET_KEY
+from blog_api.models import User, Post, Comments, Link_User_Post
 from blog_api.users.users_services import hash_password
 
 DATA_ROOT = Path("tests/data")
@@ -28,15 +34,209 @@ def load_data(
             return f.read()
 
 
+# bcrypt is slow on purpose, hash the password of test users once per test run instead of once per user
+@lru_cache()
+def hashed_test_password(password: str = "password") -> str:
+    return hash_password(password)
+
+
+# Authorization header of a populated user, the token has the same claims as the one of users/login
+def auth_headers(email: str, scope: str = "user") -> Dict[str, str]:
+    token = jwt.encode(
+        {"sub": email, "scopes": [scope], "exp": datetime.utcnow() + timedelta(days=1)}, SECRET_KEY, algorithm=ALGORITHM
+    )
+    return {"Authorization": f"Bearer {token}"}
+
+
 async def populate_user(session: AsyncSession):
     db_records = []
     records = load_data(DATA_FILES["user"])
     
     for record in records:
         # record.hashed_password = hash_password("password")
-        new_user = User(**record, hashed_password=hash_password("password"))
+        new_user = User(**record, hashed_password=hashed_test_password())
         session.add(new_user)
         db_records.append(new_user)
 
     await session.commit()
     return db_records
+
+
+# every user get posts_per_user posts, every post get a comment with a reply and a like from the next user
+async def populate_post(session: AsyncSession, users: List[User], posts_per_user: int = 5):
+    db_records = []
+    for position, user in enumerate(users):
+        liked_by = users[(position + 1) % len(users)]
+        for number in range(posts_per_user):
+            new_post = Post(title=f"Post {number} of {user.email}", content="content", owner_email=user.email, like_count=1)
+            new_post.like.append(liked_by)
+            session.add(new_post)
+            db_records.append(new_post)
+
+    await session.flush()
+    for post in db_records:
+        comment = Comments(post=post.id, name=post.owner_email, body="comment")
+        session.add(comment)
+        await session.flush()
+        session.add(Comments(post=post.id, name=post.owner_email, body="reply", parent_id=comment.id))
+
+    await session.commit()
+    return db_records
+
+
+# rows of populate_dataset, ids are in insert order
+class Dataset(NamedTuple):
+    admin_email: str
+    user_emails: List[str]
+    post_ids: List[int]
+    # (post id, top level comment id, deepest reply id)
+    comment_threads: List[Tuple[int, int, int]]
+
+
+DATASET_PASSWORD = "password"
+DATASET_START = datetime(2021, 1, 1)
+DATASET_INSERT_BATCH_SIZE = 5000
+
+
+async def _insert_rows(session: AsyncSession, model, rows: List[dict]):
+    for start in range(0, len(rows), DATASET_INSERT_BATCH_SIZE):
+        await session.execute(insert(model), rows[start:start + DATASET_INSERT_BATCH_SIZE])
+
+
+# ids are written explicitly, so postgres sequences must continue after them
+async def _reset_sequences(session: AsyncSession):
+    if session.sync_session.get_bind().dialect.name != "postgresql":
+        return
+    for table in ("users", "posts", "comments"):
+        await session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))"
+        ))
+
+
+# same seed give the same rows, ids and dates, so benchmark runs are comparable
+# the first user is an active admin, every user has the password DATASET_PASSWORD (hashed once, bcrypt is slow)
+# every post get likes_per_post likes and comments_per_post threads, each thread is a chain of reply_depth replies
+async def populate_dataset(
+    session: AsyncSession,
+    users: int = 100,
+    posts_per_user: int = 10,
+    likes_per_post: int = 5,
+    comments_per_post: int = 3,
+    reply_depth: int = 2,
+    seed: int = 2021,
+) -> Dataset:
+    rnd = random.Random(seed)
+    hashed_password = hash_password(DATASET_PASSWORD)
+    likes_per_post = min(likes_per_post, users)
+
+    user_rows = [
+        {
+            "id": number,
+            "email": f"user{number}@mailinator.com",
+            "hashed_password": hashed_password,
+            "is_active": True,
+            "role": "admin" if number == 1 else "user",
+        }
+        for number in range(1, users + 1)
+    ]
+
+    post_rows, like_rows, comment_rows, comment_threads = [], [], [], []
+    comment_id = 0
+    for post_id in range(1, users * posts_per_user + 1):
+        owner = user_rows[(post_id - 1) // posts_per_user]
+        date_created = DATASET_START + timedelta(minutes=post_id)
+        likers = rnd.sample(range(1, users + 1), likes_per_post)
+        post_rows.append({
+            "id": post_id,
+            "title": f"Post {post_id} " + " ".join(f"word{rnd.randint(1, 1000)}" for _ in range(5)),
+            "content": " ".join(f"word{rnd.randint(1, 5000)}" for _ in range(50)),
+            "owner_email": owner["email"],
+            "date_created": date_created,
+            "date_last_update": date_created,
+            "date_last_activity": date_created,
+            "like_count": likes_per_post,
+        })
+        like_rows.extend({"user_id": user_id, "post_id": post_id} for user_id in likers)
+
+        for _ in range(comments_per_post):
+            parent_id = None
+            for depth in range(reply_depth + 1):
+                comment_id += 1
+                comment_rows.append({
+                    "id": comment_id,
+                    "post": post_id,
+                    "name": user_rows[rnd.randrange(users)]["email"],
+                    "body": f"comment {comment_id} at depth {depth}",
+                    "date_created": date_created + timedelta(seconds=comment_id),
+                    "parent_id": parent_id,
+                })
+                parent_id = comment_id
+            comment_threads.append((post_id, comment_id - reply_depth, comment_id))
+
+    await _insert_rows(session, User, user_rows)
+    await _insert_rows(session, Post, post_rows)
+    await _insert_rows(session, Link_User_Post, like_rows)
+    await _insert_rows(session, Comments, comment_rows)
+    await _reset_sequences(session)
+    await session.commit()
+
+    return Dataset(
+        admin_email=user_rows[0]["email"] if user_rows else None,
+        user_emails=[row["email"] for row in user_rows],
+        post_ids=[row["id"] for row in post_rows],
+        comment_threads=comment_threads,
+    )
+
+
+# asyncio stand-in of aioredis.Redis backed by fakeredis, install it by blog_api.redis_client.set_redis
+# every command run against an in memory fakeredis server, so tests don't need a redis service
+class FakeAsyncRedis:
+    # nothing to disconnect in redis_client.close_redis
+    connection_pool = None
+
+    def __init__(self):
+        self._redis = fakeredis.FakeRedis()
+
+    def __getattr__(self, name):
+        command = getattr(self._redis, name)
+        if not callable(command):
+            return command
+
+        async def call(*args, **kwargs):
+            return command(*args, **kwargs)
+
+        return call
+
+    def pipeline(self, transaction: bool = True):
+        return FakeAsyncPipeline(self._redis.pipeline(transaction))
+
+    async def scan_iter(self, match: Optional[str] = None, count: Optional[int] = None):
+        for key in self._redis.scan_iter(match=match, count=count):
+            yield key
+
+    async def close(self):
+        pass
+
+
+# commands are buffered like aioredis pipeline and sent by execute
+class FakeAsyncPipeline:
+    def __init__(self, pipeline):
+        self._pipeline = pipeline
+
+    def __getattr__(self, name):
+        command = getattr(self._pipeline, name)
+
+        def call(*args, **kwargs):
+            command(*args, **kwargs)
+            return self
+
+        return call
+
+    async def execute(self, raise_on_error: bool = True):
+        return self._pipeline.execute(raise_on_error)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._pipeline.reset()